@@ -1,4 +1,6 @@
+import enum
 import contextlib
+import collections
 import asyncio
 import threading
 
@@ -10,33 +12,88 @@ def set_default_loop(l):
     loop = l
 
 
+class CompletionQueue:
+    """
+    CompletionQueue carries calls from other threads onto the event loop in
+    batches.  call() appends to a queue and wakes the loop only if a drain
+    is not already pending, so a burst of completions costs one wakeup; the
+    drain runs everything queued so far, in order.  Calls that block for a
+    result do not go through the queue (see call_soon), but drain it first.
+    depth, peak (the largest batch drained), calls and drains are kept for
+    monitoring.
+
+    The queue relies on deque.append() and popleft() being atomic: drain()
+    clears the scheduled flag before emptying the queue, so an item appended
+    by a producer that saw the flag set is always picked up.
+    """
+    def __init__(self):
+        self.items = collections.deque()
+        self.scheduled = False
+        self.calls = 0
+        self.drains = 0
+        self.peak = 0
+
+    @property
+    def depth(self):
+        return len(self.items)
+
+    def call(self, cb):
+        self.items.append(cb)
+        if not self.scheduled:
+            self.scheduled = True
+            loop.call_soon_threadsafe(self.drain)
+
+    def drain(self):
+        self.scheduled = False
+        self.drains += 1
+        items = self.items
+        if len(items) > self.peak:
+            self.peak = len(items)
+        while items:
+            cb = items.popleft()
+            self.calls += 1
+            try:
+                cb()
+            except Exception as e:
+                loop.call_exception_handler({
+                    'message': 'Exception in queued callback',
+                    'exception': e})
+
+
+completions = CompletionQueue()
+
+
 def call_soon(cb, block=False):
     """
-    Submit a Python callable to an event loop; thread-safe.
+    Submit a Python callable to an event loop; thread-safe.  If block, wait
+    for and return its result.  If block is None, run it at once when
+    called from the loop thread, and otherwise queue it without waiting.
     """
     if threading.current_thread() is threading.main_thread():
-        return cb() if block else loop.call_soon(cb)
-    if block:
-        mutex = threading.Lock()
-        cond = threading.Condition(mutex)
-        mutex.acquire()
+        return cb() if block or block is None else loop.call_soon(cb)
+    if not block:
+        return completions.call(cb)
+    mutex = threading.Lock()
+    cond = threading.Condition(mutex)
+    mutex.acquire()
     result, exception = None, None
 
     def wrapped_cb():
         nonlocal result, exception
+        if completions.items:
+            # run what was queued before, in order
+            completions.drain()
         try:
             result = cb()
         except Exception as e:
             exception = e
         finally:
-            if block:
-                mutex.acquire()
-                cond.notify()
-                mutex.release()
+            mutex.acquire()
+            cond.notify()
+            mutex.release()
     loop.call_soon_threadsafe(wrapped_cb)
-    if block:
-        cond.wait()
-        mutex.release()
+    cond.wait()
+    mutex.release()
     if exception is not None:
         raise exception
     return result
@@ -45,7 +102,7 @@ def call_soon(cb, block=False):
 def complete(future, result=None, exception=None, block=False):
     """
     Set completion status (either result or exception) of future; thread-safe.
-    If block, return success or failure.
+    If block, return success or failure.  block=None is as for call_soon.
     """
     if future is None:
         return False
@@ -80,7 +137,7 @@ class Fuse:
         self.listeners = set()
         self.triggered = False
 
-    def trigger(self, result=None, exception=None, block=True):
+    def trigger(self, result=None, exception=None, block=None):
         with self.lock:
             if not self.triggered:
                 self.triggered = True
@@ -116,19 +173,28 @@ class Fuse:
         return self.triggered
 
 
+class StreamClosed(Exception):
+    pass
+
+
+class StreamOverflowError(Exception):
+    pass
+
+
 class FutureStream:
     """
     FutureStream interfaces between an asyncio loop and another asynchronous
     source of results/exceptions.  Calls to claim() return futures which yield
     the results/exceptions passed to post() in order.  Calling set_exception()
     causes all pending and subsequent claim futures to complete with the
-    provided exception.
+    provided exception; end() does so with StreamClosed, which ends an
+    async for loop over the stream.
     """
     def __init__(self, futureFactory=asyncio.Future):
         self.lock = threading.Lock()
         self.factory = futureFactory
-        self.early = []  # FIFO of futures: claims that arrived before posts
-        self.late = []   # FIFO of futures: posts that arrived before claims
+        self.early = collections.deque()  # claims that arrived before posts
+        self.late = collections.deque()   # posts that arrived before claims
         self.exception = None
 
     def new_future(self):
@@ -139,6 +205,13 @@ class FutureStream:
         return x
 
     def set_exception(self, exception):
+        call_soon(lambda: self.close(exception), None)
+
+    def end(self):
+        self.set_exception(StreamClosed())
+
+    def close(self, exception):
+        """ Loop thread only. """
         with self.lock:
             self.exception = exception
             for f in self.early:
@@ -148,8 +221,8 @@ class FutureStream:
     def claim(self):
         with self.lock:
             if self.late:
-                x = self.late[0]
-                del self.late[0]
+                x = self.late.popleft()
+                self.consumed()
             else:
                 x = self.new_future()
                 if not x.done():
@@ -157,21 +230,107 @@ class FutureStream:
         return x
 
     def post(self, result=None, exception=None):
+        """
+        Does not wait when called from outside the loop thread; posts are
+        delivered in order, and a post to a closed stream raises on the loop.
+        """
+        call_soon(lambda: self.deliver(result, exception), None)
+
+    def deliver(self, result, exception):
+        """ Loop thread only. """
         with self.lock:
             while self.early:
-                x = self.early[0]
-                del self.early[0]
+                x = self.early.popleft()
                 if complete(x, result, exception, True):
+                    self.consumed()
                     break
             else:
                 if (exception is not None) or (self.exception is None):
                     x = self.new_future()
                     complete(x, result, exception, True)
                     self.late.append(x)
+                    self.stored()
                 else:
                     # results posted to a closed future stream are lost
+                    self.consumed()
                     raise self.exception
 
+    def consumed(self):
+        """ Called with self.lock held as a posted item leaves the stream. """
+
+    def stored(self):
+        """ Called with self.lock held when a posted item is queued. """
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        try:
+            return (yield from self.claim())
+        except StreamClosed:
+            raise StopAsyncIteration
+
+
+class Overflow(enum.Enum):
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop oldest'
+    ERROR = 'error'
+
+
+class BoundedFutureStream(FutureStream):
+    """
+    A FutureStream holding at most maxsize posted but unclaimed items.  When
+    it is full, post() either blocks the producer until a claim makes room
+    (Overflow.BLOCK), discards the oldest item (Overflow.DROP_OLDEST), or
+    raises StreamOverflowError (Overflow.ERROR).  A producer on the loop
+    thread cannot block, and gets StreamOverflowError instead; one blocked
+    when the stream is closed raises the stream's exception.  depth and
+    dropped show how far consumers are falling behind.
+    """
+    def __init__(self, maxsize, overflow=Overflow.BLOCK,
+                 futureFactory=asyncio.Future):
+        super().__init__(futureFactory)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.space = threading.Condition(self.lock)
+        self.depth = 0
+        self.dropped = 0
+
+    def post(self, result=None, exception=None):
+        with self.lock:
+            if self.depth >= self.maxsize:
+                if self.overflow is Overflow.BLOCK and \
+                        threading.current_thread() is not \
+                        threading.main_thread():
+                    while self.depth >= self.maxsize and \
+                            self.exception is None:
+                        self.space.wait()
+                    if self.exception is not None and exception is None:
+                        raise self.exception
+                elif self.overflow is not Overflow.DROP_OLDEST:
+                    self.dropped += 1
+                    raise StreamOverflowError(
+                            'Stream holds %d items' % self.depth)
+            self.depth += 1
+        super().post(result, exception)
+
+    def close(self, exception):
+        super().close(exception)
+        with self.lock:
+            self.space.notify_all()
+
+    def consumed(self):
+        self.depth -= 1
+        self.space.notify()
+
+    def stored(self):
+        if self.overflow is Overflow.DROP_OLDEST:
+            while len(self.late) > self.maxsize:
+                self.late.popleft()
+                self.dropped += 1
+                self.consumed()
+
 
 class KeyedEvent:
     """
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+import sys
+import time
+import random
+import timeit
+import asyncio
+import threading
+
+from protocol import *
+from framing import Framer, Reassembler, ack, ACK
+import async
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport, SimulatedCentral
+import capture
+from fleet import Fleet
+from server import Server, Client
+from metrics import Metrics
+from upload import Uploader
+
+"""
+Microbenchmarks for the hot paths of the MT protocol stack.  Run with the
+names of the benchmarks to run, or with no arguments to run all of them.
+"""
+
+
+def crc8_bitwise(data, iv=0xaa, poly=0xa6):
+    """
+    Bit-serial reference implementation of crc8.
+    """
+    value = iv
+    for b in data:
+        for i in range(8):
+            x, value = (value >> 7) ^ (b >> (7-i)) & 1, (value << 1) & 0xff
+            if x:
+                value ^= poly
+    return value
+
+
+def report(name, seconds, count, unit):
+    print('%-32s %12.0f %s/s' % (name, count / seconds, unit), flush=True)
+
+
+def best(stmt, number, repeat=5):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+def bench_crc8():
+    rng = random.Random(0)
+    for length in range(64):
+        data = bytes(rng.randrange(256) for i in range(length))
+        assert crc8(data) == crc8_bitwise(data)
+        crc = CRC8()
+        for i in range(0, length, 19):
+            crc.update(data[i:i+19])
+        assert crc.digest() == crc8_bitwise(data)
+    # a full 0x51 getMeasurements response frame, 19 bytes per fragment
+    frame = bytes(rng.randrange(256) for i in range(2 + 2 + 7*33 + 1))
+    fragments = [frame[i:i+19] for i in range(0, len(frame), 19)]
+
+    def incremental():
+        crc = CRC8()
+        for fragment in fragments:
+            crc.update(fragment)
+        return crc.digest()
+    t0 = best(lambda: crc8_bitwise(frame), 200)
+    t1 = best(lambda: crc8(frame), 2000)
+    t2 = best(incremental, 2000)
+    report('crc8 bitwise', t0, len(frame), 'B')
+    report('crc8 table', t1, len(frame), 'B')
+    report('crc8 table, per fragment', t2, len(frame), 'B')
+    print('speedup: %.1fx' % (t0 / t1))
+
+
+def bench_framing():
+    rng = random.Random(0)
+    payload = bytes(rng.randrange(256) for i in range(2 + 7*33))
+    framer, reassembler = Framer(), Reassembler()
+    fragments = framer.response(0, payload)
+
+    def reassemble():
+        for fragment in fragments:
+            frame = reassembler.feed(fragment)
+        return frame
+    assert reassemble().payload == payload
+    n = len(fragments)
+    report('fragment, Framer', best(lambda: framer.request(0x51, payload),
+                                   2000), n, 'frag')
+    report('reassemble, Reassembler', best(reassemble, 2000), n, 'frag')
+
+
+def bench_bulk():
+    rng = random.Random(0)
+    count = 1000
+    data = bytes(rng.randrange(256) for i in range(33*count))
+    records = [data[i:i+33] for i in range(0, len(data), 33)]
+
+    def perRecord():
+        return [GLMSyncContainer.fromBytes(b) for b in records]
+    report('fromBytes per record', best(perRecord, 20), count, 'rec')
+    report('view per record, .result',
+           best(lambda: [GLMSyncContainerView(b).result for b in records],
+                20), count, 'rec')
+    report('view per record, all fields',
+           best(lambda: [tuple(GLMSyncContainerView(b)) for b in records],
+                20), count, 'rec')
+    try:
+        from bulk import decodeSyncContainers
+    except ImportError:  # no NumPy
+        print('bulk: skipped, requires NumPy')
+        return
+    report('bulk, record array', best(lambda: decodeSyncContainers(data),
+                                      200), count, 'rec')
+    report('bulk, namedtuples',
+           best(lambda: decodeSyncContainers(data, namedtuples=True), 20),
+           count, 'rec')
+
+
+def bench_simulator():
+    loop = asyncio.new_event_loop()
+    device = SimulatedGLM(loop=loop, measurements=50, seed=0)
+    framer, reassembler, pending = Framer(), Reassembler(), []
+
+    def notified(fragment):
+        if fragment[0] != ACK:
+            device.write(ack(fragment[0]), withResponse=False)
+            frame = reassembler.feed(fragment)
+            if frame is not None:
+                pending.pop(0).set_result(frame)
+    device.notify = notified
+
+    @asyncio.coroutine
+    def requests(command, payload, count):
+        for i in range(count):
+            f = asyncio.Future(loop=loop)
+            pending.append(f)
+            for fragment in framer.request(command, payload):
+                device.write(fragment, withResponse=False)
+            frame = yield from f
+            assert frame.status == 0
+    for name, command, payload, count in [
+            ('simulator, readSettings', 0x53, b'', 5000),
+            ('simulator, getMeasurements', 0x51, bytes([0, 6]), 1000)]:
+        t = time.perf_counter()
+        loop.run_until_complete(requests(command, payload, count))
+        report(name, time.perf_counter() - t, count, 'req')
+    loop.close()
+
+
+def bench_stack():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    device = SimulatedGLM(loop=loop, measurements=50, seed=0)
+    glm = PeripheralController(SimulatedTransport(device))
+
+    @asyncio.coroutine
+    def requests(method, count, *args):
+        for i in range(count):
+            yield from method(*args)
+    for name, method, count, args in [
+            ('stack, readSettings', glm.readSettings, 2000, (True,)),
+            ('stack, getMeasurements', glm.getMeasurements, 200, (0, 6))]:
+        t = time.perf_counter()
+        loop.run_until_complete(requests(method, count, *args))
+        report(name, time.perf_counter() - t, count, 'req')
+    loop.close()
+
+
+def bench_metrics():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    for name, metrics in [('metrics disabled', None),
+                          ('metrics enabled', Metrics())]:
+        device = SimulatedGLM(loop=loop, seed=0)
+        glm = PeripheralController(SimulatedTransport(device),
+                                   metrics=metrics)
+
+        @asyncio.coroutine
+        def requests(count):
+            for i in range(count):
+                yield from glm.readSettings(fresh=True)
+        t = time.perf_counter()
+        loop.run_until_complete(requests(2000))
+        report('stack, readSettings, ' + name, time.perf_counter() - t,
+               2000, 'req')
+    t = time.perf_counter()
+    metrics.snapshot()
+    print('snapshot: %.0f us' % ((time.perf_counter() - t) * 1e6))
+    loop.close()
+
+
+def bench_pipeline():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    for depth in (1, 4, 8):
+        device = SimulatedGLM(loop=loop, seed=0, latency=.005)
+        glm = PeripheralController(SimulatedTransport(device),
+                                   maxInFlight=depth)
+        count = 60
+        requests = [(glm.readSettings, glm.deviceInfo,
+                     glm.deviceRealTimeClock)[i % 3]() for i in range(count)]
+        t = time.perf_counter()
+        loop.run_until_complete(asyncio.gather(*requests, loop=loop))
+        report('pipeline, 5 ms link, depth %d' % depth,
+               time.perf_counter() - t, count, 'req')
+    loop.close()
+
+
+def bench_continuous():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    for depth in (1, 4, 8):
+        device = SimulatedGLM(loop=loop, seed=0, latency=.005)
+        glm = PeripheralController(SimulatedTransport(device),
+                                   maxInFlight=depth)
+
+        @asyncio.coroutine
+        def sample(count=200):
+            samples = glm.sample()
+            for i in range(count):
+                yield from samples.claim()
+            yield from samples.stop()
+            return samples.rate()
+        rate = loop.run_until_complete(sample())
+        print('%-32s %12.0f Hz' % ('continuous, 5 ms link, depth %d' %
+                                   depth, rate), flush=True)
+    loop.close()
+
+
+def bench_server():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    central = SimulatedCentral(loop=loop, latency=.005, seed=0,
+                               measurements=20)
+    fleet = Fleet(central.deviceFromUUIDString, ['A', 'B'], loop=loop)
+    fleet.start()
+    server = loop.run_until_complete(Server(fleet).start('127.0.0.1', 0))
+    port = server.server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def load(clients=50, count=20):
+        connections = yield from asyncio.gather(*[
+            Client.open('127.0.0.1', port, loop=loop)
+            for i in range(clients)], loop=loop)
+        yield from asyncio.gather(*[
+            connection.request('latest', 'AB'[i % 2])
+            for connection in connections for i in range(count)], loop=loop)
+        for connection in connections:
+            connection.close()
+        return clients * count
+    for coalesce in (False, True):
+        if not coalesce:
+            server.coalesce = set()
+        else:
+            server.coalesce = {'settings', 'deviceInfo', 'latest'}
+        sent = sum(device.requests for device in central.devices.values())
+        t = time.perf_counter()
+        count = loop.run_until_complete(load())
+        report('server, 5 ms link, %scoalesced' % ('' if coalesce else 'un'),
+               time.perf_counter() - t, count, 'req')
+        print('  device round trips: %d' %
+              (sum(device.requests for device in central.devices.values()) -
+               sent))
+    loop.run_until_complete(server.close())
+    fleet.stop()
+    loop.run_until_complete(asyncio.sleep(.01, loop=loop))
+    loop.close()
+
+
+def bench_replay():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    device = SimulatedGLM(loop=loop, measurements=50, seed=0)
+    glm = PeripheralController(SimulatedTransport(device),
+                               capture=capture.Capture(1 << 16))
+
+    @asyncio.coroutine
+    def session():
+        for i in range(100):
+            yield from glm.readSettings(fresh=True)
+            yield from glm.getMeasurements(0, 49)
+    loop.run_until_complete(session())
+    data = capture.dumps(glm.capture.records())
+    records = capture.loads(data)
+    frames = sum(1 for r, f in capture.replay(records))
+    print('capture: %d fragments, %d frames received, %d bytes' %
+          (len(records), frames, len(data)))
+    report('replay, Reassembler',
+           best(lambda: sum(1 for r, f in capture.replay(records)), 5),
+           frames, 'frame')
+
+    def controller():
+        transport = capture.ReplayTransport(records, loop=loop)
+        glm = PeripheralController(transport, readBacklog=frames,
+                                   negotiate=False)
+        loop.run_until_complete(transport.done)
+    report('replay, PeripheralController', best(controller, 5), frames,
+           'frame')
+    loop.close()
+
+
+def bench_upload():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    data = bytes(random.Random(0).randrange(256) for i in range(20000))
+    for window in (1, 4, 8, 16):
+        device = SimulatedGLM(loop=loop, seed=0, latency=.005)
+        glm = PeripheralController(SimulatedTransport(device),
+                                   maxInFlight=window)
+        uploader = Uploader(data, window=window)
+        progress = loop.run_until_complete(uploader.upload(glm))
+        report('upload, 5 ms link, window %d' % window, uploader.busyTime,
+               progress.bytes, 'B')
+    loop.close()
+
+
+def bench_completions():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async.set_default_loop(loop)
+    count, threads = 20000, 4
+    for name, complete in [
+            ('blocking, Lock/Condition',
+             lambda f: async.complete(f, 1, block=True)),
+            ('non-blocking, call_soon_threadsafe',
+             lambda f: loop.call_soon_threadsafe(f.set_result, 1)),
+            ('non-blocking, CompletionQueue',
+             lambda f: async.complete(f, 1))]:
+        futures = [asyncio.Future(loop=loop) for i in range(count)]
+        workers = [threading.Thread(target=lambda fs: [complete(f)
+                                                       for f in fs],
+                                    args=(futures[i::threads],))
+                   for i in range(threads)]
+        t = time.perf_counter()
+        for w in workers:
+            w.start()
+        loop.run_until_complete(asyncio.gather(*futures, loop=loop))
+        report(name, time.perf_counter() - t, count, 'completion')
+        print('  loop wakeups via CompletionQueue: %d' %
+              async.completions.drains)
+        async.completions.drains = 0
+        for w in workers:
+            w.join()
+    loop.close()
+
+
+BENCHMARKS = {name[6:]: f for name, f in globals().items()
+              if name.startswith('bench_')}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
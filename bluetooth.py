@@ -0,0 +1,314 @@
+import sys
+import asyncio
+import objc
+import Foundation
+import CoreBluetooth
+
+import osx
+import async
+from log import log
+from protocol import *
+from controller import PeripheralController
+from reconnect import Reconnector
+from framing import FRAGMENT_SIZE
+
+"""
+CoreBluetooth backend: a Transport for one connected GLM peripheral, and a
+central manager delegate that discovers and connects the wanted peripherals.
+"""
+
+GLM_SERVICE_UUID = CoreBluetooth.CBUUID.alloc() \
+                    .initWithString_(GLM_SERVICE_UUID_STRING)
+TX_CHARACTERISTIC_UUID = CoreBluetooth.CBUUID.alloc() \
+                    .initWithString_(TX_CHARACTERISTIC_UUID_STRING)
+RX_CHARACTERISTIC_UUID = CoreBluetooth.CBUUID.alloc() \
+                    .initWithString_(RX_CHARACTERISTIC_UUID_STRING)
+
+CBPeripheralDelegate = objc.protocolNamed('CBPeripheralDelegate')
+CBCentralManagerDelegate = objc.protocolNamed('CBCentralManagerDelegate')
+
+
+class CoreBluetoothTransport(Foundation.NSObject,
+                             protocols=[CBPeripheralDelegate]):
+    """
+    Transport (see transport.py) over the GLM service of a connected
+    CBPeripheral.  Delegate callbacks, and callables passed to schedule(),
+    run on the given dispatch queue.
+    """
+    def initWithPeripheral_queue_(self, peripheral, dispatchQueue):
+        self = objc.super(CoreBluetoothTransport, self).init()
+        if self is not None:
+            self.queue = dispatchQueue
+            self.peripheral = peripheral
+            self.controller = None
+            self.ready_gates = dict(txchar=False, rxchar=False, notify=False)
+        return self
+
+    @objc.python_method
+    def attach(self, controller):
+        self.controller = controller
+        self.peripheral.setDelegate_(self)
+        log(1, 'Scanning for services on %s' % self.peripheral)
+        self.peripheral.discoverServices_([GLM_SERVICE_UUID])
+
+    def peripheral_didDiscoverServices_(self, peripheral, services):
+        for service in peripheral.services():
+            if service.UUID() == GLM_SERVICE_UUID:
+                log(1, 'Scanning GLM service for characteristics')
+                peripheral.discoverCharacteristics_forService_(
+                        [TX_CHARACTERISTIC_UUID, RX_CHARACTERISTIC_UUID],
+                        service)
+
+    @objc.python_method
+    def updateReadiness(self, **kwargs):
+        self.ready_gates.update(kwargs)
+        if all(self.ready_gates.values()):
+            self.controller.transportReady()
+
+    def peripheral_didDiscoverCharacteristicsForService_error_(
+            self, peripheral, service, error):
+        if error:
+            self.controller.transportReady(error)
+        else:
+            for characteristic in service.characteristics():
+                if characteristic.UUID() == TX_CHARACTERISTIC_UUID:
+                    self.tx_characteristic = characteristic
+                    self.updateReadiness(txchar=True)
+                elif characteristic.UUID() == RX_CHARACTERISTIC_UUID:
+                    self.rx_characteristic = characteristic
+                    self.updateReadiness(rxchar=True)
+                    peripheral.setNotifyValue_forCharacteristic_(
+                            1, characteristic)
+
+    def peripheral_didUpdateNotificationStateForCharacteristic_error_(
+            self, peripheral, characteristic, error):
+        if not error:
+            self.updateReadiness(notify=True)
+
+    def peripheral_didUpdateValueForCharacteristic_error_(
+            self, peripheral, characteristic, error):
+        self.controller.didReceive(characteristic.value(), error)
+
+    def peripheral_didWriteValueForCharacteristic_error_(
+            self, peripheral, characteristic, error):
+        self.controller.didWrite(error)
+
+    def peripheralIsReadyToSendWriteWithoutResponse_(self, peripheral):
+        self.controller.sendChunk()
+
+    def peripheral_didReadRSSI_error_(self, peripheral, RSSI, error):
+        self.controller.didReadRSSI(RSSI, error)
+
+    def peripheralDidUpdateRSSI_error_(self, peripheral, error):
+        # before OS X 10.13
+        self.controller.didReadRSSI(peripheral.RSSI(), error)
+
+    @objc.python_method
+    def write(self, fragment, withResponse=True):
+        # CoreBluetooth copies the value into an NSData anyway
+        self.peripheral.writeValue_forCharacteristic_type_(
+                bytes(fragment), self.tx_characteristic,
+                CoreBluetooth.CBCharacteristicWriteWithResponse
+                if withResponse else
+                CoreBluetooth.CBCharacteristicWriteWithoutResponse)
+
+    @objc.python_method
+    def supportsWriteWithoutResponse(self):
+        return bool(
+            self.tx_characteristic.properties() &
+            CoreBluetooth.CBCharacteristicPropertyWriteWithoutResponse)
+
+    @objc.python_method
+    def canWriteWithoutResponse(self):
+        return self.peripheral.canSendWriteWithoutResponse()
+
+    @objc.python_method
+    def maximumWriteLength(self):
+        try:
+            return self.peripheral.maximumWriteValueLengthForType_(
+                    CoreBluetooth.CBCharacteristicWriteWithoutResponse)
+        except AttributeError:  # before OS X 10.12
+            return FRAGMENT_SIZE + 1
+
+    @objc.python_method
+    def readRSSI(self):
+        self.peripheral.readRSSI()
+        return True
+
+    @objc.python_method
+    def schedule(self, cb):
+        osx.dispatch_async(self.queue, cb)
+
+    @objc.python_method
+    def close(self):
+        self.peripheral.setDelegate_(None)
+
+
+class CentralController(Foundation.NSObject,
+                        protocols=[CBCentralManagerDelegate]):
+    """
+    Connects to the wanted peripherals and keeps them connected.  There is no
+    polling: a dropped peripheral is reconnected at once from the disconnect
+    callback, and failed attempts are retried with jittered exponential
+    backoff (see reconnect.py).  Scanning runs only while some wanted
+    peripheral has not been found.
+    """
+    def initWithQueue_knownDevices_(self, queue, known_devices):
+        self = objc.super(CentralController, self).init()
+        if self is not None:
+            self.queue = queue
+            self.wantedPeripherals = known_devices
+            self.knownPeripherals = {}
+            self.connectingPeripherals = {}
+            self.connectedPeripherals = {}
+            self.reconnector = Reconnector()
+            self.retries = {}  # uuidString -> generation of pending retry
+            self.centralManager = CoreBluetooth.CBCentralManager.alloc() \
+                .initWithDelegate_queue_(
+                    self, osx.dispatch_queue_from_id(queue))
+            self.connect = async.KeyedEvent()
+        return self
+
+    def centralManagerDidUpdateState_(self, centralManager):
+        state = centralManager.state()
+        if state < CoreBluetooth.CBCentralManagerStatePoweredOff:
+            self.knownPeripherals = {}
+            self.connectingPeripherals = {}
+            self.connectedPeripherals = {}
+        if state == CoreBluetooth.CBCentralManagerStatePoweredOn:
+            log(1, 'Bluetooth is on')
+            self.reconcile()
+        elif state == CoreBluetooth.CBCentralManagerStateUnsupported:
+            log(0, 'Bluetooth Low Energy not supported on this hardware')
+            sys.exit(-1)
+        elif state == CoreBluetooth.CBCentralManagerStateUnauthorized:
+            log(0, 'Permission denied to use Bluetooth Low Energy')
+            sys.exit(-1)
+        elif state == CoreBluetooth.CBCentralManagerStatePoweredOff:
+            log(1, 'Turning Bluetooth on')
+            osx.setBluetoothPowerState(1)
+
+    @objc.python_method
+    def reconcile(self):
+        """
+        Connect every wanted peripheral that is not connected, and scan while
+        any of them is unknown.
+        """
+        if self.centralManager.state() != \
+                CoreBluetooth.CBCentralManagerStatePoweredOn:
+            return
+        for peripheral in self.retrieveWantedPeripherals():
+            self.discovered(peripheral)
+
+        wanted = set(self.wantedPeripherals)
+        known = set(self.knownPeripherals.keys())
+        for uuidString in wanted.intersection(known):
+            self.discovered(self.knownPeripherals[uuidString])
+        if wanted - known:
+            log(1, 'Scanning for peripherals')
+            self.centralManager.scanForPeripheralsWithServices_options_(
+                    None, {})
+        else:
+            log(1, 'Stopping scan')
+            self.centralManager.stopScan()
+
+    @objc.python_method
+    def scheduleReconnect(self, uuidString, failed=False):
+        if uuidString not in self.wantedPeripherals:
+            return
+        delay = self.reconnector.lost(uuidString, failed)
+        generation = self.retries.get(uuidString, 0) + 1
+        self.retries[uuidString] = generation
+        if delay:
+            log(1, 'Reconnecting to %s in %.2f s' % (uuidString, delay))
+            osx.dispatch_after(delay, self.queue,
+                               lambda: self.reconnect(uuidString, generation))
+        else:
+            self.reconnect(uuidString, generation)
+
+    @objc.python_method
+    def reconnect(self, uuidString, generation):
+        if self.retries.get(uuidString) != generation:
+            return  # superseded
+        peripheral = self.knownPeripherals.get(uuidString)
+        if peripheral is not None and self.centralManager.state() == \
+                CoreBluetooth.CBCentralManagerStatePoweredOn:
+            self.discovered(peripheral)
+        else:
+            self.reconcile()
+
+    @objc.python_method
+    def discovered(self, peripheral):
+        uuidString = peripheral.identifier().UUIDString()
+        if uuidString in self.wantedPeripherals:
+            if uuidString not in self.knownPeripherals:
+                self.knownPeripherals[uuidString] = peripheral
+                if set(self.wantedPeripherals) <= \
+                        set(self.knownPeripherals):
+                    log(1, 'Stopping scan')
+                    self.centralManager.stopScan()
+            if uuidString not in self.connectingPeripherals and \
+               uuidString not in self.connectedPeripherals:
+                log(0, 'Connecting to %s' % peripheral)
+                self.connectingPeripherals[uuidString] = peripheral
+                self.centralManager.connectPeripheral_options_(peripheral, {})
+
+    def centralManager_didDiscoverPeripheral_advertisementData_RSSI_(
+            self, centralManager, peripheral, advertisementData, rssi):
+        self.discovered(peripheral)
+
+    def centralManager_didDisconnectPeripheral_error_(
+            self, centralManager, peripheral, error):
+        log(0, 'Disconnected %s %s' % (peripheral, error))
+        uuidString = peripheral.identifier().UUIDString()
+        # what cleanup is needed?
+        if uuidString in self.connectingPeripherals:
+            del self.connectingPeripherals[uuidString]
+        if uuidString in self.connectedPeripherals:
+            self.connectedPeripherals[uuidString].didDisconnect(error)
+            del self.connectedPeripherals[uuidString]
+        self.connect.trigger(uuidString, exception=Exception(error))
+        self.scheduleReconnect(uuidString)
+
+    def centralManager_didFailToConnectPeripheral_error_(
+            self, centralManager, peripheral, error):
+        log(0, 'Failed to connect %s %s' % (peripheral, error))
+        uuidString = peripheral.identifier().UUIDString()
+        if uuidString in self.connectingPeripherals:
+            del self.connectingPeripherals[uuidString]
+        self.connect.trigger(uuidString, exception=Exception(error))
+        self.scheduleReconnect(uuidString, failed=True)
+
+    def centralManager_didConnectPeripheral_(
+            self, centralManager, peripheral):
+        log(0, 'Connected %s' % peripheral)
+        uuidString = peripheral.identifier().UUIDString()
+        self.retries.pop(uuidString, None)
+        self.reconnector.connected(uuidString)
+        if uuidString not in self.connectedPeripherals:
+            p = PeripheralController(CoreBluetoothTransport.alloc()
+                                     .initWithPeripheral_queue_(
+                                         peripheral, self.queue))
+            self.connectedPeripherals[uuidString] = p
+        else:
+            p = self.connectedPeripherals[uuidString]
+        self.connect.trigger(uuidString, p)
+
+    @objc.python_method
+    def retrieveWantedPeripherals(self):
+        uuids = [Foundation.NSUUID.alloc()
+                 .initWithUUIDString_(s) for s in self.wantedPeripherals]
+        return self.centralManager.retrievePeripheralsWithIdentifiers_(uuids)
+
+    @objc.python_method
+    @asyncio.coroutine
+    def deviceFromUUIDString(self, uuidString):
+        if uuidString not in self.wantedPeripherals:
+            self.wantedPeripherals.append(uuidString)
+            osx.dispatch_async(self.queue, self.reconcile)
+        with self.connect(uuidString) as f:
+            try:
+                f.set_result(self.connectedPeripherals[uuidString])
+            except (KeyError, asyncio.futures.InvalidStateError):
+                pass
+            return (yield from f)
@@ -0,0 +1,223 @@
+import numpy as np
+
+from protocol import GLMSyncContainer, SYNC_CONTAINER_SIZE
+
+"""
+Vectorized decoding of concatenated GLMSyncContainer records, as returned by
+getMeasurements (command 0x51), using NumPy structured arrays, and a compact
+columnar table for holding many of them.
+"""
+
+# Wire layout of one 33-byte record; bitfields are packed into the three
+# flag bytes and unpacked below.
+SYNC_CONTAINER_WIRE_DTYPE = np.dtype([
+    ('typeFlags', 'u1'),         # measurementType:5, calcIndicator:3
+    ('referenceFlags', 'u1'),    # distReference:3, angleReference:3,
+                                 # distanceUnit:1
+    ('stateOfCharge', 'u1'),
+    ('temperature', 'u1'),
+    ('distance', '<f4', (3,)),
+    ('result', '<f4'),
+    ('angle', '<f4'),
+    ('timestamp', '<i4'),
+    ('laserFlags', 'u1'),        # laserOn:1, usabilityErrors:7
+    ('measurementListIndex', 'u1'),
+    ('compassHeading', '<i2'),
+    ('ndofSensorStatus', 'u1'),
+])
+assert SYNC_CONTAINER_WIRE_DTYPE.itemsize == SYNC_CONTAINER_SIZE
+
+# Decoded layout; field names and order match GLMSyncContainer.
+SYNC_CONTAINER_DTYPE = np.dtype([
+    ('measurementType', 'u1'),
+    ('calcIndicator', 'u1'),
+    ('distReference', 'u1'),
+    ('angleReference', 'u1'),
+    ('distanceUnit', 'u1'),
+    ('stateOfCharge', 'u1'),
+    ('temperature', 'u1'),
+    ('distance', '<f4', (3,)),
+    ('result', '<f4'),
+    ('angle', '<f4'),
+    ('timestamp', '<i4'),
+    ('laserOn', 'u1'),
+    ('usabilityErrors', 'u1'),
+    ('measurementListIndex', 'u1'),
+    ('compassHeading', '<i2'),
+    ('ndofSensorStatus', 'u1'),
+])
+assert SYNC_CONTAINER_DTYPE.names == GLMSyncContainer._fields
+
+
+def decodeSyncContainers(data, namedtuples=False):
+    """
+    Decode a buffer of concatenated 33-byte records in one pass.  Returns a
+    record array with SYNC_CONTAINER_DTYPE, or a list of GLMSyncContainer if
+    namedtuples is set.  Trailing bytes short of a whole record are ignored.
+    """
+    count = len(data) // SYNC_CONTAINER_SIZE
+    wire = np.frombuffer(data, dtype=SYNC_CONTAINER_WIRE_DTYPE, count=count)
+    records = np.empty(count, dtype=SYNC_CONTAINER_DTYPE)
+    typeFlags = wire['typeFlags']
+    records['measurementType'] = typeFlags & 0x1f
+    records['calcIndicator'] = typeFlags >> 5
+    referenceFlags = wire['referenceFlags']
+    records['distReference'] = referenceFlags & 7
+    records['angleReference'] = (referenceFlags >> 3) & 7
+    records['distanceUnit'] = (referenceFlags >> 6) & 1
+    laserFlags = wire['laserFlags']
+    records['laserOn'] = laserFlags & 1
+    records['usabilityErrors'] = laserFlags >> 1
+    for name in ('stateOfCharge', 'temperature', 'distance', 'result',
+                 'angle', 'timestamp', 'measurementListIndex',
+                 'compassHeading', 'ndofSensorStatus'):
+        records[name] = wire[name]
+    if namedtuples:
+        return toNamedTuples(records)
+    return records.view(np.recarray)
+
+
+def toNamedTuples(records):
+    """
+    Convert an array with SYNC_CONTAINER_DTYPE to a list of GLMSyncContainer.
+    """
+    distance = records['distance'].tolist()
+    return [GLMSyncContainer(*(fields[:7] + (tuple(d),) + fields[8:]))
+            for fields, d in zip(records.tolist(), distance)]
+
+
+class MeasurementTable:
+    """
+    MeasurementTable stores sync containers column by column in growable
+    NumPy arrays -- 41 bytes per record, including the serial number
+    of the device it came from -- for keeping large numbers of them in
+    memory.  Indexing with an integer returns a GLMSyncContainer; indexing
+    with a slice, a boolean mask or an array of indices returns a new table.
+    column() returns a read-only view of one column.
+    """
+    COLUMNS = [('device', np.dtype('<i4'), ())] + \
+        [(name, SYNC_CONTAINER_DTYPE.fields[name][0].base,
+          SYNC_CONTAINER_DTYPE.fields[name][0].shape)
+         for name in SYNC_CONTAINER_DTYPE.names]
+
+    CHUNK = 4096  # records decoded at a time by iteration
+
+    def __init__(self, capacity=1024):
+        self.length = 0
+        self.columns = {name: np.empty((capacity,) + shape, dtype=dtype)
+                        for name, dtype, shape in self.COLUMNS}
+
+    @classmethod
+    def fromBytes(cls, data, device=0):
+        table = cls(len(data) // SYNC_CONTAINER_SIZE)
+        table.appendBytes(data, device)
+        return table
+
+    @classmethod
+    def fromNamedTuples(cls, containers, device=0):
+        table = cls(len(containers))
+        table.extend(containers, device)
+        return table
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def capacity(self):
+        return len(self.columns['device'])
+
+    @property
+    def nbytes(self):
+        return sum(column[:self.length].nbytes
+                   for column in self.columns.values())
+
+    def reserve(self, capacity):
+        if capacity > self.capacity:
+            capacity = max(capacity, 2*self.capacity)
+            for name, column in self.columns.items():
+                grown = np.empty((capacity,) + column.shape[1:],
+                                 dtype=column.dtype)
+                grown[:self.length] = column[:self.length]
+                self.columns[name] = grown
+
+    def appendRecords(self, records, device=0):
+        """
+        Append an array with SYNC_CONTAINER_DTYPE.
+        """
+        start, end = self.length, self.length + len(records)
+        self.reserve(end)
+        self.columns['device'][start:end] = device
+        for name in SYNC_CONTAINER_DTYPE.names:
+            self.columns[name][start:end] = records[name]
+        self.length = end
+
+    def appendBytes(self, data, device=0):
+        """
+        Append concatenated 33-byte records, as from fetchMeasurements.
+        """
+        self.appendRecords(decodeSyncContainers(data), device)
+
+    def append(self, container, device=0):
+        self.extend([container], device)
+
+    def extend(self, containers, device=0):
+        records = np.array([tuple(c) for c in containers],
+                           dtype=SYNC_CONTAINER_DTYPE)
+        self.appendRecords(records, device)
+
+    def column(self, name):
+        view = self.columns[name][:self.length]
+        view.flags.writeable = False
+        return view
+
+    def records(self, start=0, stop=None):
+        """
+        Return the table, or the rows from start up to stop, as an array
+        with SYNC_CONTAINER_DTYPE.
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        records = np.empty(max(stop - start, 0), dtype=SYNC_CONTAINER_DTYPE)
+        for name in SYNC_CONTAINER_DTYPE.names:
+            records[name] = self.columns[name][start:stop]
+        return records
+
+    def toNamedTuples(self):
+        return toNamedTuples(self.records())
+
+    def __iter__(self):
+        for start in range(0, self.length, self.CHUNK):
+            yield from toNamedTuples(self.records(start, start + self.CHUNK))
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self.length
+            if not 0 <= key < self.length:
+                raise IndexError('MeasurementTable index out of range')
+            return GLMSyncContainer._make(
+                tuple(self.columns[name][key].tolist())
+                if name == 'distance' else self.columns[name][key].item()
+                for name in SYNC_CONTAINER_DTYPE.names)
+        table = MeasurementTable(0)
+        for name, column in self.columns.items():
+            table.columns[name] = column[:self.length][key].copy()
+        table.length = len(table.columns['device'])
+        return table
+
+    def select(self, device=None, measurementType=None, since=None,
+               until=None):
+        """
+        Return the records from device, of measurementType (a value or a
+        collection of values), with since <= timestamp < until.
+        """
+        mask = np.ones(self.length, dtype=bool)
+        if device is not None:
+            mask &= self.column('device') == device
+        if measurementType is not None:
+            mask &= np.in1d(self.column('measurementType'),
+                            np.atleast_1d(measurementType))
+        if since is not None:
+            mask &= self.column('timestamp') >= since
+        if until is not None:
+            mask &= self.column('timestamp') < until
+        return self[mask]
@@ -0,0 +1,227 @@
+import io
+import time
+import struct
+import asyncio
+import itertools
+import collections
+from collections import namedtuple
+
+from protocol import CRCError, StatusError, decodeRequest, decodeResponse, \
+    responseFits
+from framing import Reassembler, ACK, REQUEST
+from transport import Transport
+
+"""
+Wire capture.  A PeripheralController given a Capture records the raw
+fragments it sends and receives into it, a fixed-size ring buffer that costs
+one tuple per fragment and never formats anything.  A capture can be dumped
+to a compact binary file and loaded back, and replay() or a ReplayTransport
+feeds it through the reassembly and decoding path again, to reproduce a
+field incident or to benchmark against realistic traffic.
+"""
+
+RX, TX = 0, 1  # received from / sent to the device
+
+MAGIC = b'MTCAP\x02'
+RECORD_HEADER = struct.Struct('<dBH')  # timestamp, direction, length
+# version 1 files, whose length byte could not hold a large-MTU fragment
+MAGIC_V1 = b'MTCAP\x01'
+RECORD_HEADER_V1 = struct.Struct('<dBB')
+
+
+class CaptureRecord(namedtuple('CaptureRecord',
+                               'timestamp, direction, fragment')):
+    pass
+
+
+class Capture:
+    """
+    Capture keeps the last capacity fragments.  record() may be called from
+    any thread without locking: slots are claimed from an itertools.count,
+    whose next() is atomic.
+    """
+    def __init__(self, capacity=4096, clock=time.monotonic):
+        self.capacity = capacity
+        self.clock = clock
+        self.slots = [None] * capacity
+        self.counter = itertools.count()
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def record(self, direction, fragment):
+        i = next(self.counter)
+        self.slots[i % self.capacity] = (self.clock(), direction,
+                                         bytes(fragment))
+        self.count = i + 1
+
+    def clear(self):
+        self.slots = [None] * self.capacity
+        self.counter = itertools.count()
+        self.count = 0
+
+    def records(self):
+        """
+        Return the captured fragments as CaptureRecords, oldest first.
+        """
+        count = self.count
+        start = max(count - self.capacity, 0)
+        records = (self.slots[i % self.capacity] for i in range(start, count))
+        return [CaptureRecord(*r) for r in records if r is not None]
+
+    def dump(self, f):
+        """
+        Write the capture to a binary file object or path.
+        """
+        if isinstance(f, str):
+            with open(f, 'wb') as f:
+                return self.dump(f)
+        f.write(dumps(self.records()))
+
+
+def dumps(records):
+    out = io.BytesIO()
+    out.write(MAGIC)
+    for timestamp, direction, fragment in records:
+        out.write(RECORD_HEADER.pack(timestamp, direction, len(fragment)))
+        out.write(fragment)
+    return out.getvalue()
+
+
+def loads(data):
+    if data[:len(MAGIC)] == MAGIC:
+        header = RECORD_HEADER
+    elif data[:len(MAGIC_V1)] == MAGIC_V1:
+        header = RECORD_HEADER_V1
+    else:
+        raise ValueError('Not an MT protocol capture')
+    records = []
+    offset = len(MAGIC)
+    while offset < len(data):
+        timestamp, direction, length = header.unpack_from(data, offset)
+        offset += header.size
+        records.append(CaptureRecord(timestamp, direction,
+                                     bytes(data[offset:offset+length])))
+        offset += length
+    return records
+
+
+def load(f):
+    """
+    Read a list of CaptureRecords from a binary file object or path.
+    """
+    if isinstance(f, str):
+        with open(f, 'rb') as f:
+            return loads(f.read())
+    return loads(f.read())
+
+
+def replay(records, direction=RX):
+    """
+    Reassemble the fragments captured in one direction, ACKs excluded.
+    Yields (record, frame) for the last fragment of each frame, where frame
+    is a Frame, or a CRCError if the frame was corrupt.
+    """
+    reassembler = Reassembler()
+    for record in records:
+        if record.direction != direction or record.fragment[0] == ACK:
+            continue
+        try:
+            frame = reassembler.feed(record.fragment)
+        except CRCError as e:
+            frame = e
+        if frame is not None:
+            yield record, frame
+
+
+def transcript(records):
+    """
+    Decode the frames of a capture in both directions, using the command
+    schemas in protocol.py.  Yields (record, command, message) for the last
+    fragment of each frame.  Responses are matched with the host's requests
+    in order.  message is the decoded payload, the raw payload if it does
+    not fit its layout, a StatusError for an error response, or a CRCError.
+    command is None for a response that answers no request in the capture.
+    """
+    reassemblers = {RX: Reassembler(), TX: Reassembler()}
+    pending = collections.deque()  # commands the host awaits answers to
+    for record in records:
+        if record.fragment[0] == ACK:
+            continue
+        try:
+            frame = reassemblers[record.direction].feed(record.fragment)
+        except CRCError as e:
+            yield record, None, e
+            continue
+        if frame is None:
+            continue
+        if frame.frameType == REQUEST:
+            command = frame.command
+            if record.direction == TX:
+                pending.append(command)
+                message = decodeRequest(command, frame.payload)
+            elif responseFits(command, frame.payload):
+                # the device pushes requests laid out like responses
+                message = decodeResponse(command, frame.payload)
+            else:
+                message = None
+        else:
+            command = pending.popleft() if record.direction == RX and \
+                pending else None
+            if frame.status:
+                message = StatusError(frame.status)
+            elif command is None or \
+                    not responseFits(command, frame.payload):
+                message = None
+            else:
+                message = decodeResponse(command, frame.payload)
+        if message is None:
+            message = frame.payload
+        yield record, command, message
+
+
+class ReplayTransport(Transport):
+    """
+    Transport that plays the received side of a capture into a
+    PeripheralController, discarding what the controller writes.  Fragments
+    are delivered as fast as possible, or with their captured spacing scaled
+    by 1/speed.  Unsolicited responses land in the controller's read stream,
+    and pushed measurements reach its subscribers; create the controller
+    with negotiate=False, as nothing answers it.  done is a future that
+    completes when the capture has been played.
+    """
+    def __init__(self, records, speed=None, loop=None):
+        super().__init__()
+        self.loop = loop or asyncio.get_event_loop()
+        self.records = [r for r in records if r.direction == RX]
+        self.speed = speed
+        self.done = asyncio.Future(loop=self.loop)
+
+    def attach(self, controller):
+        super().attach(controller)
+        self.loop.create_task(self.run())
+
+    @asyncio.coroutine
+    def run(self):
+        self.controller.transportReady()
+        start = self.records[0].timestamp if self.records else 0.
+        began = self.loop.time()
+        for record in self.records:
+            if self.speed:
+                delay = (record.timestamp - start) / self.speed - \
+                    (self.loop.time() - began)
+                if delay > 0:
+                    yield from asyncio.sleep(delay, loop=self.loop)
+            self.controller.didReceive(record.fragment)
+        self.done.set_result(len(self.records))
+
+    def write(self, fragment, withResponse=True):
+        if withResponse:
+            self.loop.call_soon(self.controller.didWrite, None)
+
+    def supportsWriteWithoutResponse(self):
+        return True
+
+    def schedule(self, cb):
+        self.loop.call_soon(cb)
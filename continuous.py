@@ -0,0 +1,157 @@
+import time
+import asyncio
+import collections
+from collections import namedtuple
+
+import async
+from log import log
+from protocol import DistReference, DistanceUnit, StatusError, \
+    ResponseMismatchError
+
+"""
+Continuous measurement.  A ContinuousMeasurement configures the device once
+(metric units, laser pointer on) and then triggers measurements with
+control() back to back, pipelined up to the controller's in-flight limit, or
+paced to a target rate.  Readings arrive as Samples in an async stream.
+"""
+
+
+class Sample(namedtuple('Sample', 'container, time, latency, rate')):
+    """
+    A reading: the GLMSyncContainer(View) the device answered with, the
+    host's monotonic time of arrival, the round trip of its trigger, and the
+    rate achieved over the last few readings, in Hz.
+    """
+    pass
+
+
+class ContinuousMeasurement(async.BoundedFutureStream):
+    """
+    A stream of Samples taken at rate Hz, or as fast as the link allows if
+    rate is None.  depth triggers may be outstanding at once (by default the
+    controller's maxInFlight).  A trigger that fails with a timeout, a
+    response mismatch or a StatusError is counted in failures and skipped;
+    after maxFailures in a row, or on any other error such as a disconnect,
+    the stream fails with that exception.  Up to maxsize unread samples are
+    buffered, and older ones dropped after that (see dropped).
+
+    Start it with start(), or use glm.sample(); stop() cancels the
+    outstanding triggers, puts back the settings it changed if restore is
+    set, and ends the stream.  Iterate with async for.
+    """
+    def __init__(self, glm, rate=None, depth=None,
+                 distReference=DistReference.Tripod, maxsize=64,
+                 maxFailures=10, restore=True, window=32,
+                 clock=time.monotonic):
+        super().__init__(maxsize, async.Overflow.DROP_OLDEST)
+        self.glm = glm
+        self.interval = None if rate is None else 1. / rate
+        self.triggers = depth or glm.max_in_flight
+        self.distReference = distReference
+        self.maxFailures = maxFailures
+        self.restore = restore
+        self.clock = clock
+        self.arrivals = collections.deque(maxlen=window)
+        self.settings = None  # as they were before configure()
+        self.task = None
+        self.samples = 0
+        self.failures = 0
+
+    def rate(self):
+        """
+        The rate achieved over the last window readings, in Hz.
+        """
+        arrivals = self.arrivals
+        if len(arrivals) < 2 or arrivals[-1] == arrivals[0]:
+            return 0.
+        return (len(arrivals) - 1) / (arrivals[-1] - arrivals[0])
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.run())
+        return self
+
+    @asyncio.coroutine
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            yield from asyncio.wait([self.task])
+        if self.exception is None:
+            if self.restore and self.settings is not None:
+                settings, self.settings = self.settings, None
+                yield from self.glm.writeSettings(settings)
+            self.end()
+
+    @asyncio.coroutine
+    def configure(self):
+        """
+        Make every control() trigger a measurement in metric units.
+        """
+        settings = yield from self.glm.readSettings(fresh=True)
+        if settings.measurementUnit != DistanceUnit.Metric or \
+                not settings.laserPointerEnabled:
+            self.settings = settings
+            yield from self.glm.writeSettings(
+                    settings, measurementUnit=DistanceUnit.Metric,
+                    laserPointerEnabled=True)
+
+    @asyncio.coroutine
+    def trigger(self):
+        started = self.clock()
+        container = yield from self.glm.control(
+                switchMode=0, measurementType=1,
+                distReference=self.distReference)
+        return started, container
+
+    @asyncio.coroutine
+    def run(self):
+        loop = asyncio.get_event_loop()
+        pending = collections.deque()  # trigger tasks, oldest first
+        consecutive = 0
+        try:
+            yield from self.configure()
+            due = loop.time()
+            while True:
+                while len(pending) < self.triggers and \
+                        (self.interval is None or loop.time() >= due):
+                    pending.append(loop.create_task(self.trigger()))
+                    if self.interval is not None:
+                        # fall behind by at most one interval, not a burst
+                        due = max(due, loop.time() - self.interval) + \
+                            self.interval
+                if len(pending) < self.triggers:
+                    timeout = max(due - loop.time(), 0.)
+                else:
+                    timeout = None
+                if pending:
+                    yield from asyncio.wait([pending[0]], timeout=timeout)
+                else:
+                    yield from asyncio.sleep(timeout)
+                while pending and pending[0].done():
+                    task = pending.popleft()
+                    try:
+                        started, container = task.result()
+                    except (asyncio.TimeoutError, ResponseMismatchError,
+                            StatusError) as e:
+                        self.failures += 1
+                        consecutive += 1
+                        log(1, 'Measurement failed: %r' % e)
+                        if consecutive >= self.maxFailures:
+                            raise
+                        continue
+                    consecutive = 0
+                    now = self.clock()
+                    self.arrivals.append(now)
+                    self.samples += 1
+                    self.post(Sample(container, now, now - started,
+                                     self.rate()))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.set_exception(e)
+        finally:
+            for task in pending:
+                if task.done():
+                    task.cancelled() or task.exception()
+                else:
+                    task.cancel()
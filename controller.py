@@ -0,0 +1,839 @@
+import time
+import queue
+import asyncio
+import collections
+import threading
+
+import async
+from log import log, Hex
+from protocol import *
+from capture import Capture, RX, TX
+from reconnect import Backoff
+from continuous import ContinuousMeasurement
+from framing import Framer, Reassembler, TransmitWindow, ack, ACK, \
+                    FRAGMENT_SIZE, RESPONSE, REQUEST
+
+"""
+The MT protocol engine for one device, independent of how fragments reach it.
+"""
+
+
+class PendingRequest:
+    """
+    A request awaiting its response.
+    """
+    def __init__(self, command, seqno):
+        self.command = command
+        self.seqno = seqno
+        self.future = asyncio.Future()
+        self.started = self.responded = None  # see metrics.py
+        self.orphaned = False  # nobody awaits the response; see forget()
+
+    def accepts(self, status, payload):
+        # error responses carry no payload to go by
+        return status != 0 or responseFits(self.command, payload)
+
+
+class Subscription(async.BoundedFutureStream):
+    """
+    A stream of the GLMSyncContainers pushed by the device in 0x50 requests,
+    optionally only those with a measurementType in measurementTypes.  Up to
+    maxsize unread containers are buffered; older ones are dropped after
+    that.  Iterate with async for; unsubscribe() or leaving a with block
+    ends the stream.
+    """
+    def __init__(self, controller, measurementTypes=None, maxsize=64):
+        super().__init__(maxsize, async.Overflow.DROP_OLDEST)
+        self.controller = controller
+        self.measurementTypes = None if measurementTypes is None else \
+            frozenset(measurementTypes)
+
+    def wants(self, container):
+        return self.measurementTypes is None or \
+            container.measurementType in self.measurementTypes
+
+    def unsubscribe(self):
+        self.controller.subscribers.discard(self)
+        self.end()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unsubscribe()
+
+
+class PeripheralController:
+    """
+    PeripheralController implements acknowledgement, fragmentation,
+    reassembly and the GLM command set on top of a Transport (see
+    transport.py).  The transport delivers events by calling
+    transportReady(), didReceive(), didWrite(), didReadRSSI() and
+    didDisconnect(), from any thread.
+
+    Up to maxInFlight requests may be outstanding at once.  The device
+    answers in order, and each response goes to the oldest outstanding
+    request whose command it fits; see dispatchResponse().
+
+    Settings, device info, protocol version and payload size are cached for
+    the life of the connection, or for cacheTTL seconds if given; pass
+    fresh=True to bypass the cache.  Writes update it, and a disconnect
+    invalidates it.  The cached settings are also dropped when the device
+    writes its settings itself, or sends a sync container in a different
+    system of units (metric or imperial) than they show.
+
+    Each request must be answered within timeout seconds (None for no
+    limit).  Idempotent requests that time out, or that the device turns
+    away as busy, are retried up to retries times; see sendRequest().  A
+    request whose caller is cancelled stays in flight until answered, so
+    its response cannot be mistaken for the next request's.
+
+    Once the transport is ready, the device is asked for its payload sizes,
+    which set the size of fragments and of measurement pages; see
+    payloadSize().  Pass negotiate=False to send nothing unasked, as when
+    replaying a capture.
+
+    Every fragment sent and received is recorded in capture, by default a
+    Capture of the last 4096, so that an incident can be dumped and
+    replayed; pass capture=False to record nothing.
+    """
+    # cached responses made stale by a request from the device
+    INVALIDATES = {Command.WriteSettings: (Command.ReadSettings,)}
+
+    def __init__(self, transport, maxInFlight=4, readBacklog=64,
+                 cacheTTL=None, capture=None, metrics=None, timeout=10.,
+                 retries=2, retryBackoff=.1, negotiate=True):
+        self.transport = transport
+        self.ready = async.Fuse()
+        self.disconnected = async.Fuse()
+        # unsolicited responses nobody reads must not accumulate forever
+        self.read_stream = async.BoundedFutureStream(
+                readBacklog, async.Overflow.DROP_OLDEST)
+        self.write_lock = threading.Lock()
+        self.deferred_writes = queue.Queue()
+        self.submitted_writes = queue.Queue()
+        self.with_response = True
+        self.tx_window = TransmitWindow()
+        self.tx_fallbacks = 0
+        self.request_lock = threading.Lock()
+        self.in_flight = collections.deque()
+        self.late_responses = 0  # see forget()
+        self.max_in_flight = maxInFlight
+        self.request_slots = None  # created on the loop thread
+        self.timeout = timeout
+        self.max_retries = retries
+        self.retry_backoff = retryBackoff
+        self.request_timeouts = 0
+        self.request_retries = 0
+        self.framer = Framer()
+        self.reassembler = Reassembler()
+        self.cache = {}  # command -> (value, time fetched)
+        self.cache_ttl = cacheTTL
+        self.subscribers = set()
+        self.page_capacity = None  # see pageCapacity()
+        self.link_fragment_size = FRAGMENT_SIZE  # set when ready
+        self.negotiates = negotiate
+        # raw fragments in both directions; see capture.py
+        if capture is None:
+            capture = Capture()
+        self.capture = capture if capture is not False else None
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.attach(self)
+        self.telemetry = None  # see telemetry.py
+        self.rssi_waiters = collections.deque()
+        transport.attach(self)
+
+    def transportReady(self, error=None):
+        if error:
+            self.ready.trigger(exception=Exception(error))
+        else:
+            # fragments stay at the protocol's 19 bytes until the device
+            # reports what it accepts; see payloadSize()
+            self.link_fragment_size = \
+                self.transport.maximumWriteLength() - 1
+            self.ready.trigger()
+            if self.negotiates:
+                async.call_soon(
+                        lambda: asyncio.ensure_future(self.negotiate()),
+                        None)
+
+    def didReceive(self, value, error=None):
+        if error:
+            log(2, 'didUpdate: %s' % error)
+            self.failOldest(Exception(error))
+            return
+        if self.capture is not None:
+            self.capture.record(RX, value)
+        log(2, 'didUpdate:', Hex(value))
+        metrics = self.metrics
+        if value[0] == ACK:
+            if metrics is not None:
+                metrics.acked()
+            self.sendChunk(acked=True)
+            return
+        self.writeValue(ack(value[0]))
+        if metrics is not None:
+            started = metrics.clock()
+        try:
+            frame = self.reassembler.feed(value)
+        except CRCError as e:
+            if metrics is not None:
+                metrics.crcErrors += 1
+            self.failOldest(e)
+            return
+        if metrics is not None:
+            metrics.received(started)
+        if frame is None:
+            return
+        if frame.frameType == RESPONSE:
+            self.dispatchResponse(frame.status, frame.payload)
+        elif frame.frameType == REQUEST:
+            self.handleRequest(frame.status, frame.command, frame.payload)
+
+    def dispatchResponse(self, status, payload):
+        """
+        Complete the oldest in-flight request that accepts this response.
+        Requests passed over have lost their response and fail with
+        ResponseMismatchError.  A response that no request accepts fails the
+        oldest request, whose answer it must be.  The answer to an orphaned
+        request (see forget()) is handed to an idempotent retry of the same
+        command, if one is in flight; otherwise it is late.  Late responses,
+        and any that arrive when nothing is in flight, are unsolicited and
+        left for read().
+        """
+        late = False
+        with self.request_lock:
+            for i, request in enumerate(self.in_flight):
+                if request.accepts(status, payload):
+                    skipped = [self.in_flight.popleft() for _ in range(i)]
+                    self.in_flight.popleft()
+                    break
+            else:
+                skipped, request = [], None
+                if self.in_flight and self.in_flight[0].orphaned:
+                    request = self.in_flight.popleft()
+                elif self.in_flight:
+                    skipped = [self.in_flight.popleft()]
+            # orphans passed over have lost their response too
+            self.late_responses -= sum(r.orphaned for r in skipped)
+            skipped = [r for r in skipped if not r.orphaned]
+            if request is not None and request.orphaned:
+                self.late_responses -= 1
+                request = self.adopt(request)
+                late = request is None
+            idle = all(r.orphaned for r in self.in_flight)
+        if idle:
+            # every fragment sent has been received
+            with self.write_lock:
+                self.tx_window.idle()
+        metrics = self.metrics
+        if metrics is not None:
+            if idle:
+                metrics.idle()
+            metrics.mismatches += len(skipped)
+            if request is not None:
+                metrics.responded(request.command, request.started, status)
+                request.responded = metrics.clock()
+        for r in skipped:
+            async.complete(r.future, exception=ResponseMismatchError(
+                'No response to command 0x%02x (frame %d)' %
+                (r.command, r.seqno)))
+        if request is None and (late or not skipped):
+            log(1, '%s response: status %d, %d bytes' % (
+                'Late' if late else 'Unsolicited', status, len(payload)))
+            self.read_stream.post(result=(status, payload))
+        elif request is None:
+            log(1, 'Unexpected %d-byte response to command 0x%02x' %
+                (len(payload), skipped[0].command))
+        else:
+            async.complete(request.future, (status, payload))
+
+    def adopt(self, orphan):
+        """
+        Find an idempotent retry in flight for the orphan's command to take
+        its response.  The retry is orphaned in its place, since its own
+        response is still to come.  Call with request_lock held.
+        """
+        if not idempotent(orphan.command):
+            return None
+        for request in self.in_flight:
+            if request.command == orphan.command and not request.orphaned:
+                request.orphaned = True
+                self.late_responses += 1
+                return request
+        return None
+
+    def failOldest(self, exception):
+        with self.request_lock:
+            request = self.in_flight.popleft() if self.in_flight else None
+            if request is not None and request.orphaned:
+                self.late_responses -= 1
+        if request is not None and request.orphaned:
+            log(1, 'Late response lost: %r' % exception)
+        elif request is None:
+            self.read_stream.post(exception=exception)
+        else:
+            async.complete(request.future, exception=exception)
+
+    def handleRequest(self, status, command, payload):
+        if command == Command.Control:
+            payload = GLMSyncContainerView(payload)
+            log(0, 'sync:', payload)
+            if self.telemetry is not None:
+                observe = self.telemetry.observe
+                async.call_soon(lambda: observe(payload), None)
+            # the container only tells metric from imperial units
+            settings = self.cache.get(Command.ReadSettings)
+            if settings is not None and \
+                    (settings[0].measurementUnit != DistanceUnit.Metric) != \
+                    bool(payload.distanceUnit):
+                self.invalidate(Command.ReadSettings)
+            for subscription in list(self.subscribers):
+                if subscription.wants(payload):
+                    subscription.post(payload)
+        elif command in self.INVALIDATES:
+            self.invalidate(*self.INVALIDATES[command])
+
+    def didReadRSSI(self, rssi, error=None):
+        while self.rssi_waiters:
+            try:
+                f = self.rssi_waiters.popleft()
+            except IndexError:
+                break
+            if error:
+                async.complete(f, exception=Exception(error))
+            else:
+                async.complete(f, int(rssi))
+
+    def didWrite(self, error=None):
+        log(2, 'didWrite')
+        if error:
+            self.fallBack(error)
+        try:
+            async.complete(self.submitted_writes.get(False),
+                           exception=Exception(error) if error else None)
+        except queue.Empty:
+            log(2, 'unexpected write callback')
+            pass
+
+    def didDisconnect(self, error):
+        with self.request_lock:
+            requests = list(self.in_flight)
+            self.in_flight.clear()
+            self.late_responses = 0
+        for request in requests:
+            async.complete(request.future, exception=Exception(error))
+        self.invalidate()
+        for subscription in list(self.subscribers):
+            subscription.set_exception(Exception(error))
+        self.subscribers.clear()
+        self.read_stream.set_exception(Exception(error))
+        self.rssi_waiters.clear()  # the fuse fails them
+        self.disconnected.trigger(exception=Exception(error))
+
+    def writeValue(self, value, future=None):
+        """
+        Write a fragment to the device and arrange for future to complete
+        once it is sent.
+        """
+        if self.capture is not None:
+            self.capture.record(TX, value)
+        log(2, 'willWrite:', Hex(value))
+        if self.with_response:
+            self.submitted_writes.put(future)
+            self.transport.write(value, True)
+        else:
+            # no didWrite callback will follow
+            self.transport.write(value, False)
+            async.complete(future)
+
+    def sendChunk(self, acked=False):
+        with self.write_lock:
+            if acked:
+                self.tx_window.acked()
+            while self.tx_window.available():
+                if not self.with_response and \
+                        not self.transport.canWriteWithoutResponse():
+                    return  # the transport calls sendChunk when it can
+                try:
+                    future, item = self.deferred_writes.get(False)
+                except queue.Empty:
+                    return
+                if item is not None:
+                    self.tx_window.sent(len(item))
+                    if self.metrics is not None:
+                        self.metrics.sent()
+                    self.writeValue(item, future)
+                else:
+                    async.complete(future)
+
+    @asyncio.coroutine
+    def setTransmitMode(self, window=None, withoutResponse=False):
+        """
+        Allow at most window unacknowledged fragments in flight (None for no
+        bound), and use write-without-response if withoutResponse is set
+        and the transport supports it.  Any write error, request timeout or
+        transmission-related StatusError reverts to the default mode:
+        write-with-response and no window.
+        """
+        yield from self.waitUntilReady()
+        if withoutResponse and \
+                not self.transport.supportsWriteWithoutResponse():
+            log(1, 'Transport requires write with response')
+            withoutResponse = False
+        with self.write_lock:
+            self.tx_window.size = window
+            self.with_response = not withoutResponse
+        self.transport.schedule(self.sendChunk)
+
+    def fallBack(self, reason):
+        with self.write_lock:
+            if self.tx_window.size is None and self.with_response:
+                return
+            log(0, 'Reverting to default transmit mode: %s' % reason)
+            self.tx_window.size = None
+            self.tx_window.idle()
+            self.with_response = True
+            self.tx_fallbacks += 1
+        self.transport.schedule(self.sendChunk)
+
+    @asyncio.coroutine
+    def waitUntilReady(self):
+        with self.ready() as f:
+            yield from f
+
+    @asyncio.coroutine
+    def sendRequest(self, command, payload, timeout=None, retries=None):
+        """
+        Send a request and return the payload of its successful response.
+        Raises StatusError if the device reports an error, and
+        asyncio.TimeoutError if the response has not arrived within timeout
+        seconds (by default the controller's).  A request whose response is
+        lost to a timeout or a mismatch, or that the device turns away with a
+        transient StatusError, is sent again up to retries times, with
+        exponential backoff; by default idempotent commands (see COMMANDS)
+        get the controller's retries and others none.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if retries is None:
+            retries = self.max_retries if idempotent(command) else 0
+        backoff = None
+        while True:
+            try:
+                return (yield from self.sendOnce(command, payload, timeout))
+            except (asyncio.TimeoutError, ResponseMismatchError,
+                    StatusError) as e:
+                if retries <= 0 or \
+                        isinstance(e, StatusError) and not e.transient:
+                    raise
+                error = e
+            if backoff is None:
+                backoff = Backoff(initial=self.retry_backoff,
+                                  maximum=16*self.retry_backoff)
+            delay = backoff.next()
+            if isinstance(error, StatusError):
+                # the device is busy; even the first retry waits
+                delay = delay or backoff.initial
+            retries -= 1
+            self.request_retries += 1
+            if self.metrics is not None:
+                self.metrics.retries += 1
+            log(1, 'Retrying command 0x%02x in %.3f s: %r' %
+                (command, delay, error))
+            yield from asyncio.sleep(delay)
+
+    @asyncio.coroutine
+    def sendOnce(self, command, payload, timeout=None):
+        """
+        Send a request once, with no retries; see sendRequest.
+        """
+        yield from self.waitUntilReady()
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        if self.request_slots is None:
+            self.request_slots = asyncio.Semaphore(self.max_in_flight)
+        with (yield from self.request_slots):
+            request = None
+            with self.disconnected() as f:
+                if not f.done():
+                    with self.request_lock:
+                        request = PendingRequest(command, self.framer.seqno)
+                        if self.metrics is not None:
+                            request.started = self.metrics.clock()
+                        self.in_flight.append(request)
+                        fragments = self.framer.request(command, payload)
+                        for i, fragment in enumerate(fragments):
+                            self.deferred_writes.put(
+                                    (f if i == len(fragments)-1 else None,
+                                     fragment))
+                    self.transport.schedule(self.sendChunk)
+                try:
+                    yield from self.within(f, deadline)
+                except asyncio.CancelledError:
+                    self.abandon(request, deadline)
+                    raise
+                except Exception as e:
+                    self.forget(request, e)
+                    raise
+            try:
+                status, payload = yield from self.within(request.future,
+                                                         deadline)
+            except asyncio.CancelledError:
+                self.abandon(request, deadline)
+                raise
+            except asyncio.TimeoutError as e:
+                self.forget(request, e)
+                raise
+        if request.responded is not None:
+            self.metrics.handoff.observe(
+                    self.metrics.clock() - request.responded)
+        if status != 0:
+            if status & 7 in (1, 3):  # CommunicationTimeout, ChecksumError
+                self.fallBack(StatusError(status))
+            raise StatusError(status)
+        return payload
+
+    @asyncio.coroutine
+    def within(self, future, deadline):
+        if deadline is None:
+            return (yield from future)
+        remaining = deadline - asyncio.get_event_loop().time()
+        return (yield from asyncio.wait_for(future, max(remaining, 0.)))
+
+    def forget(self, request, error):
+        """
+        Drop a request whose write failed, or orphan one whose response is
+        overdue: it stays in flight, counted in late_responses, so that its
+        response, if it ever comes, is not mistaken for a later request's.
+        A timeout also reverts to the default transmit mode, since the ACK of
+        a lost fragment never comes to reopen the window.
+        """
+        if request is None:
+            return
+        with self.request_lock:
+            if request in self.in_flight and not request.orphaned:
+                if isinstance(error, asyncio.TimeoutError):
+                    request.orphaned = True
+                    self.late_responses += 1
+                else:
+                    self.in_flight.remove(request)
+        if isinstance(error, asyncio.TimeoutError):
+            self.request_timeouts += 1
+            if self.metrics is not None:
+                self.metrics.timeouts += 1
+            # an unacknowledged fragment may be holding the window shut
+            self.fallBack('timeout')
+        # nobody awaits the response; a disconnect may still fail it, so
+        # mark its exception retrieved
+        request.future.add_done_callback(
+                lambda f: f.cancelled() or f.exception())
+
+    def abandon(self, request, deadline):
+        """
+        Forget a request whose caller was cancelled.  The request was sent,
+        so it stays in flight, and its response is discarded rather than
+        taken for a later request's; it is orphaned at its deadline if the
+        response has not come by then.
+        """
+        if request is None:
+            return
+        request.future.add_done_callback(
+                lambda f: f.cancelled() or f.exception())
+        if deadline is not None:
+            asyncio.get_event_loop().call_at(deadline, self.expire, request)
+
+    def expire(self, request):
+        with self.request_lock:
+            if request not in self.in_flight or request.orphaned:
+                return
+            request.orphaned = True
+            self.late_responses += 1
+        self.fallBack('timeout')
+
+    @asyncio.coroutine
+    def flush(self):
+        yield from self.waitUntilReady()
+        with self.disconnected() as f:
+            if not f.done():
+                self.deferred_writes.put((f, None))
+            yield from f
+
+    @asyncio.coroutine
+    def read(self):
+        """
+        Return the next unsolicited (status, payload) response.
+        """
+        yield from self.waitUntilReady()
+        return (yield from self.read_stream.claim())
+
+    def invalidate(self, *commands):
+        """
+        Drop the cached responses to commands, or all of them.
+        """
+        if not commands:
+            self.cache.clear()
+        for command in commands:
+            self.cache.pop(command, None)
+
+    @asyncio.coroutine
+    def cachedRequest(self, command, fresh=False):
+        """
+        Send a request with no payload and decode the response, unless a
+        cached value is still valid.
+        """
+        entry = self.cache.get(command)
+        if entry is not None and not fresh and (
+                self.cache_ttl is None or
+                time.monotonic() - entry[1] < self.cache_ttl):
+            return entry[0]
+        value = decodeResponse(command,
+                               (yield from self.sendRequest(command, b'')))
+        self.cache[command] = (value, time.monotonic())
+        return value
+
+    @asyncio.coroutine
+    def call(self, command, *args, lazy=False, **kwargs):
+        """
+        Send command with a request payload built from args and kwargs, and
+        return the decoded response; see COMMANDS in protocol.py.
+        """
+        payload = yield from self.sendRequest(
+                command, encodeRequest(command, *args, **kwargs))
+        return decodeResponse(command, payload, lazy)
+
+    def measurements(self, measurementTypes=None, maxsize=64):
+        """
+        Subscribe to the measurements the device pushes as they are taken;
+        see turnOnAutoSync.  Returns a Subscription:
+
+            with glm.measurements() as subscription:
+                async for container in subscription:
+                    ...
+        """
+        subscription = Subscription(self, measurementTypes, maxsize)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def sample(self, rate=None, **kwargs):
+        """
+        Start taking measurements continuously, at rate Hz or as fast as the
+        link allows.  Returns a running ContinuousMeasurement; see
+        continuous.py.
+
+            samples = glm.sample(rate=10)
+            async for sample in samples:
+                ...
+            yield from samples.stop()
+        """
+        return ContinuousMeasurement(self, rate, **kwargs).start()
+
+    @asyncio.coroutine
+    def readSettings(self, fresh=False):
+        return (yield from self.cachedRequest(Command.ReadSettings, fresh))
+
+    @asyncio.coroutine
+    def writeSettings(self, settings=None, **kwargs):
+        if settings is None:
+            settings = yield from self.readSettings()
+        settings = settings._replace(**kwargs)
+        self.invalidate(Command.ReadSettings)
+        yield from self.call(Command.WriteSettings, *settings)
+        self.cache[Command.ReadSettings] = (settings, time.monotonic())
+
+    @asyncio.coroutine
+    def serialNumber(self):
+        return (yield from self.deviceInfo()).serialNumber
+
+    @asyncio.coroutine
+    def deviceInfo(self, fresh=False):
+        return (yield from self.cachedRequest(Command.DeviceInfo, fresh))
+
+    @asyncio.coroutine
+    def pageCapacity(self):
+        """
+        Return how many records fit in one 0x51 response, going by the
+        device's TXPayloadSize, or None if it rejects or ignores 0x00.
+        """
+        if self.page_capacity is None:
+            try:
+                payloadSize = yield from self.payloadSize()
+            except (StatusError, asyncio.TimeoutError):
+                self.page_capacity = 0
+            else:
+                self.page_capacity = (min(payloadSize.TXPayloadSize, 255) -
+                                      2) // SYNC_CONTAINER_SIZE
+        return self.page_capacity or None
+
+    @asyncio.coroutine
+    def negotiate(self):
+        """
+        Read the device's payload sizes, which sets the fragment and page
+        sizes for the connection.
+        """
+        try:
+            yield from self.pageCapacity()
+        except Exception as e:
+            log(1, 'Payload size negotiation failed: %r' % e)
+
+    @asyncio.coroutine
+    def fetchMeasurements(self, first, last):
+        """
+        Return the concatenated raw 33-byte records in [first, last].  The
+        range is split into pages of pageCapacity() indices, which are
+        fetched pipelined, up to maxInFlight at a time, each in one round
+        trip unless the device sends less than it should.  The device
+        numbers measurements consecutively, so a page with fewer records
+        than indices marks the end of those it holds: any beyond it, left
+        by clearing a range, are fetched by open-ended requests, which skip
+        the empty pages.
+        """
+        capacity = yield from self.pageCapacity()
+        if not capacity:
+            return (yield from self.fetchRange(first, last))
+        results = bytearray()
+        start = first
+        while start <= last:
+            starts = range(start, last + 1, capacity)[:self.max_in_flight]
+            pages = yield from asyncio.gather(*[
+                self.fetchRange(page, min(page + capacity - 1, last),
+                                capacity)
+                for page in starts])
+            for page in pages:
+                results += page
+            start = starts[-1] + capacity
+            if any(len(page) < capacity * SYNC_CONTAINER_SIZE
+                   for page in pages):
+                results += yield from self.fetchRange(start, last, capacity)
+                break
+        return results
+
+    @asyncio.coroutine
+    def fetchRange(self, first, last, capacity=None):
+        """
+        Fetch the records in [first, last] page by page, until the device
+        sends none, or fewer than the capacity of a page if known.
+        """
+        results = bytearray()
+        while first <= last:
+            payload = yield from self.sendRequest(
+                    Command.GetMeasurements, encodeRequest(
+                        Command.GetMeasurements, first, last))
+            count = (len(payload)-2) // SYNC_CONTAINER_SIZE
+            if count == 0 or payload[0] != first:
+                break
+            results += memoryview(payload)[2:2+count*SYNC_CONTAINER_SIZE]
+            if capacity is not None and count < capacity:
+                break  # that was all there is
+            first = payload[1]+1
+        return results
+
+    @asyncio.coroutine
+    def getMeasurements(self, first, last):
+        records = yield from self.fetchMeasurements(first, last)
+        try:
+            from bulk import decodeSyncContainers
+        except ImportError:  # no NumPy
+            size = SYNC_CONTAINER_SIZE
+            return [GLMSyncContainer.fromBytes(records[i:i+size])
+                    for i in range(0, len(records), size)]
+        return decodeSyncContainers(records, namedtuples=True)
+
+    @asyncio.coroutine
+    def getMeasurementRecords(self, first, last):
+        """
+        Like getMeasurements, but return a NumPy record array.
+        """
+        from bulk import decodeSyncContainers
+        return decodeSyncContainers(
+                (yield from self.fetchMeasurements(first, last)))
+
+    @asyncio.coroutine
+    def clearMeasurements(self, first, last):
+        return (yield from self.call(Command.ClearMeasurements, first, last))
+
+    @asyncio.coroutine
+    def control(self, **kwargs):
+        """
+        Send a GLMControl request with the given fields (all default to 0).
+        Returns a GLMSyncContainerView.
+        """
+        container = yield from self.call(Command.Control, lazy=True,
+                                         **kwargs)
+        if self.telemetry is not None:
+            self.telemetry.observe(container)
+        return container
+
+    @asyncio.coroutine
+    def readRSSI(self):
+        """
+        Return the signal strength of the link in dBm, or None if the
+        transport cannot measure it.
+        """
+        yield from self.waitUntilReady()
+        with self.disconnected() as f:
+            self.rssi_waiters.append(f)
+            if not self.transport.readRSSI():
+                self.rssi_waiters.remove(f)
+                return None
+            return (yield from f)
+
+    @asyncio.coroutine
+    def payloadSize(self, fresh=False):
+        """
+        Return the device's GLMPayloadSize, and from then on send fragments
+        as large as both it and the link accept.
+        """
+        payloadSize = yield from self.cachedRequest(Command.PayloadSize,
+                                                    fresh)
+        self.framer.fragmentSize = max(min(self.link_fragment_size,
+                                           payloadSize.RXPayloadSize), 1)
+        return payloadSize
+
+    @asyncio.coroutine
+    def MTProtocolVersion(self, fresh=False):
+        return (yield from self.cachedRequest(Command.ProtocolVersion,
+                                              fresh))
+
+    @asyncio.coroutine
+    def deviceRealTimeClock(self):
+        return (yield from self.call(Command.RealTimeClock))
+
+    @asyncio.coroutine
+    def deviceInfoString(self):
+        return (yield from self.call(Command.DeviceInfoString))
+
+    @asyncio.coroutine
+    def uploadBlock(self, blockNumber, blockType, chunkData):
+        return (yield from self.call(
+            Command.UploadBlock, blockType=blockType, blockNumber=blockNumber,
+            length=len(chunkData), chunkData=chunkData))
+
+    # setDeviceMaster(self):
+    #   yield from self.control(syncControl=1, signalOperation=1)
+
+    @asyncio.coroutine
+    def setLaserPower(self, value):
+        yield from self.writeSettings(laserPointerEnabled=value)
+
+    @asyncio.coroutine
+    def turnOnAutoSync(self):
+        yield from self.control(syncControl=1)
+
+    @asyncio.coroutine
+    def measureDistance(self, distReference=DistReference.Tripod, metric=True):
+        settings = yield from self.readSettings()
+        if settings.measurementUnit != DistanceUnit.Metric:
+            yield from self.writeSettings(
+                    settings, measurementUnit=DistanceUnit.Metric)
+        laserOn = settings.laserPointerEnabled
+        if not laserOn:
+            yield from self.control(
+                    switchMode=0,
+                    measurementType=1,
+                    distReference=distReference)
+        return (yield from self.control(
+            switchMode=0,
+            measurementType=1,
+            distReference=distReference)).result
@@ -0,0 +1,244 @@
+import asyncio
+import collections
+
+from log import log
+from reconnect import Reconnector
+from sync import syncMeasurements
+
+"""
+Concurrent control of many GLMs from one process.  A Fleet keeps a connection
+to each of its devices and runs jobs -- coroutine functions taking a
+PeripheralController -- on them, a few at a time per device.
+"""
+
+
+class DeviceHandle:
+    """
+    DeviceHandle keeps one device connected and runs the jobs submitted to
+    it, at most limit at once.  Each job waits for a connection.  Queued jobs
+    are taken round-robin by client, so a client with a long backlog (say, a
+    full sync) does not hold up the others' measurements.  Loop thread only.
+    """
+    def __init__(self, fleet, deviceId, limit=1):
+        self.fleet = fleet
+        self.deviceId = deviceId
+        self.limit = limit
+        self.glm = None
+        self.queues = collections.OrderedDict()  # client -> deque of jobs
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.connections = 0
+        self.changed = asyncio.Condition()
+        self.tasks = []
+
+    def __repr__(self):
+        return '<DeviceHandle %s%s>' % (
+            self.deviceId, '' if self.glm is not None else ' disconnected')
+
+    @property
+    def load(self):
+        return self.active + self.queued
+
+    def start(self):
+        loop = self.fleet.loop
+        self.tasks = [loop.create_task(self.maintain())]
+        for i in range(self.limit):
+            self.tasks.append(loop.create_task(self.work()))
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for jobs in self.queues.values():
+            for job, future in jobs:
+                if not future.done():
+                    future.cancel()
+        self.queues.clear()
+        self.queued = 0
+
+    def submit(self, job, client=None):
+        """
+        Queue job(glm) and return a future for its result.
+        """
+        future = asyncio.Future()
+        self.queues.setdefault(client, collections.deque()).append(
+                (job, future))
+        self.queued += 1
+        self.fleet.loop.create_task(self.notify())
+        return future
+
+    @asyncio.coroutine
+    def notify(self):
+        with (yield from self.changed):
+            self.changed.notify_all()
+
+    def take(self):
+        """
+        Take the next job round-robin by client, or return None.
+        """
+        if self.glm is None or not self.queues:
+            return None
+        client, jobs = next(iter(self.queues.items()))
+        job = jobs.popleft()
+        del self.queues[client]
+        if jobs:
+            self.queues[client] = jobs
+        self.queued -= 1
+        return job
+
+    @asyncio.coroutine
+    def maintain(self):
+        while True:
+            reconnector = self.fleet.reconnector
+            try:
+                glm = yield from self.fleet.connect(self.deviceId)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(0, 'Failed to connect %s: %s' % (self.deviceId, e))
+                yield from asyncio.sleep(
+                        reconnector.lost(self.deviceId, failed=True))
+                continue
+            reconnector.connected(self.deviceId)
+            self.glm = glm
+            self.connections += 1
+            telemetry = self.fleet.telemetry
+            poller = None if telemetry is None else \
+                telemetry.watch(glm, self.deviceId)
+            yield from self.notify()
+            try:
+                with glm.disconnected() as f:
+                    yield from f
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log(1, 'Disconnected %s: %s' % (self.deviceId, e))
+            finally:
+                if poller is not None:
+                    poller.cancel()
+            self.glm = None
+            delay = reconnector.lost(self.deviceId)
+            if delay:
+                yield from asyncio.sleep(delay)
+
+    @asyncio.coroutine
+    def work(self):
+        while True:
+            with (yield from self.changed):
+                yield from self.changed.wait_for(self.hasWork)
+                (job, future), glm = self.take(), self.glm
+            if future.cancelled():
+                continue
+            self.active += 1
+            try:
+                result = yield from job(glm)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.active -= 1
+
+    def hasWork(self):
+        return self.glm is not None and self.queued > 0
+
+
+class Fleet:
+    """
+    Fleet connects to deviceIds with the coroutine connect(deviceId), which
+    returns a connected PeripheralController -- for instance
+    CentralController.deviceFromUUIDString -- and is called again whenever
+    the controller disconnects: at once, then with backoff (see
+    reconnect.py).  Each device runs up to perDevice jobs at once.  Jobs
+    submitted without a device go to the connected device with the least
+    work.  If telemetry (see telemetry.py) is given, every connected device
+    is watched by it.
+    """
+    def __init__(self, connect, deviceIds=(), perDevice=1, reconnector=None,
+                 loop=None, telemetry=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.connect = connect
+        self.perDevice = perDevice
+        self.reconnector = reconnector or Reconnector()
+        self.telemetry = telemetry
+        self.devices = collections.OrderedDict()
+        self.running = False
+        for deviceId in deviceIds:
+            self.add(deviceId)
+
+    def __getitem__(self, deviceId):
+        return self.devices[deviceId]
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def __len__(self):
+        return len(self.devices)
+
+    def add(self, deviceId):
+        if deviceId not in self.devices:
+            handle = DeviceHandle(self, deviceId, self.perDevice)
+            self.devices[deviceId] = handle
+            if self.running:
+                handle.start()
+        return self.devices[deviceId]
+
+    def remove(self, deviceId):
+        self.devices.pop(deviceId).stop()
+        self.reconnector.forget(deviceId)
+
+    def start(self):
+        self.running = True
+        for handle in self:
+            handle.start()
+
+    def stop(self):
+        self.running = False
+        for handle in self:
+            handle.stop()
+
+    def connected(self):
+        return [handle for handle in self if handle.glm is not None]
+
+    def submit(self, job, deviceId=None, client=None):
+        """
+        Queue job(glm) on deviceId, or on the least loaded device, and return
+        a future for its result.
+        """
+        if deviceId is None:
+            handle = min(self.connected() or self, key=lambda h: h.load)
+        else:
+            handle = self.devices[deviceId]
+        return handle.submit(job, client)
+
+    @asyncio.coroutine
+    def broadcast(self, job, client=None):
+        """
+        Run job(glm) on every device.  Returns a dict of deviceId to result,
+        or to the exception raised.
+        """
+        futures = [handle.submit(job, client) for handle in self]
+        results = yield from asyncio.gather(*futures, return_exceptions=True)
+        return collections.OrderedDict(zip(self.devices, results))
+
+    @asyncio.coroutine
+    def measure(self, deviceId=None, client=None, **kwargs):
+        return (yield from self.submit(
+            lambda glm: glm.measureDistance(**kwargs), deviceId, client))
+
+    @asyncio.coroutine
+    def sync(self, store, clear=False, client=None):
+        """
+        Run an incremental measurement sync (see sync.py) on every device.
+        """
+        return (yield from self.broadcast(
+            lambda glm: syncMeasurements(glm, store, clear), client))
@@ -0,0 +1,162 @@
+import time
+from collections import namedtuple
+
+from protocol import CRC8, CRCError, crc8
+
+"""
+Fragmentation and reassembly of MT protocol frames, independent of the
+Bluetooth stack.  A frame is a header, a length-prefixed payload, and a CRC-8
+trailer; on the wire it is split into fragments of at most fragmentSize bytes,
+each prefixed with a byte holding a 4-bit frame sequence number in the high
+nibble and the count of fragments still to follow in the low nibble.  Every
+fragment is acknowledged by the receiver with a three-byte ACK fragment.
+"""
+
+RESPONSE, REQUEST = 0, 3  # frame types, top two bits of the first byte
+ACK = 0xff
+FRAGMENT_SIZE = 19
+MAX_FRAGMENTS = 16
+
+
+class Frame(namedtuple('Frame', 'frameType, status, command, payload')):
+    pass
+
+
+class TransmitStats(namedtuple('TransmitStats', 'fragments, bytes, acks, '
+                               'inFlight, throughput')):
+    pass
+
+
+def ack(seqno):
+    return bytes([ACK, seqno, 0x00])
+
+
+class Framer:
+    """
+    Framer encodes outgoing frames into lists of fragments.  The frame
+    sequence number advances with every frame.
+    """
+    def __init__(self, fragmentSize=FRAGMENT_SIZE, seqno=1):
+        self.fragmentSize = fragmentSize
+        self.seqno = seqno
+
+    def request(self, command, payload, status=0):
+        return self.encode(bytes([(REQUEST << 6) | status, command,
+                                  len(payload)]), payload)
+
+    def response(self, status, payload):
+        return self.encode(bytes([(RESPONSE << 6) | status, len(payload)]),
+                           payload)
+
+    def encode(self, header, payload):
+        size = self.fragmentSize
+        frame = header + payload
+        frame += bytes([crc8(frame)])
+        count = (len(frame) + size - 1) // size
+        if count > MAX_FRAGMENTS:
+            raise ValueError('%d-byte frame does not fit in %d fragments' %
+                             (len(frame), MAX_FRAGMENTS))
+        seqno = self.seqno << 4
+        self.seqno = (self.seqno + 1) % 15
+        return [bytes([seqno | (count-1-i)]) + frame[size*i:size*(i+1)]
+                for i in range(count)]
+
+
+class Reassembler:
+    """
+    Reassembler accumulates incoming fragments (ACKs excluded) and folds each
+    one into a running CRC as it arrives.  feed() returns a Frame when the
+    last fragment of a frame has been received and None otherwise; it raises
+    CRCError if the completed frame is corrupt.  A fragment that does not
+    continue the frame in progress starts a new one.
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.seqno = -1
+        self.crc = CRC8()
+
+    def reset(self):
+        self.buffer = b''
+        self.seqno = -1
+        self.crc.reset()
+
+    def feed(self, fragment):
+        seqno = fragment[0]
+        if seqno != self.seqno - 1:
+            self.buffer = b''
+            self.crc.reset()
+        data = fragment[1:]
+        self.buffer += data
+        self.crc.update(data)
+        if seqno & 0xf:
+            self.seqno = seqno
+            return None
+        frame, valid = self.buffer, self.crc.value == 0
+        self.reset()
+        if not valid:
+            raise CRCError()
+        return self.decode(frame)
+
+    @staticmethod
+    def decode(frame):
+        status = frame[0] & 0x3f
+        frameType = frame[0] >> 6
+        if frameType == RESPONSE:
+            command, headerLength = None, 0
+        else:
+            command, headerLength = frame[1], 1
+        start = 2 + headerLength
+        payload = bytes(frame[start:start+frame[1+headerLength]])
+        return Frame(frameType, status, command, payload)
+
+
+class TransmitWindow:
+    """
+    TransmitWindow bounds the number of outgoing fragments awaiting an ACK
+    from the receiver and keeps throughput counters.  A size of None places
+    no bound.  Throughput is measured over the time the window is non-empty,
+    so idle periods between requests do not count against it.  Callers
+    serialize access.
+    """
+    def __init__(self, size=None):
+        self.size = size
+        self.inFlight = 0
+        self.fragments = 0
+        self.bytes = 0
+        self.acks = 0
+        self.busyTime = 0.
+        self.busySince = None
+
+    def available(self):
+        return self.size is None or self.inFlight < self.size
+
+    def sent(self, length):
+        if self.busySince is None:
+            self.busySince = time.monotonic()
+        self.inFlight += 1
+        self.fragments += 1
+        self.bytes += length
+
+    def acked(self):
+        self.acks += 1
+        if self.inFlight > 0:
+            self.inFlight -= 1
+        if self.inFlight == 0:
+            self.idle()
+
+    def idle(self):
+        self.inFlight = 0
+        if self.busySince is not None:
+            self.busyTime += time.monotonic() - self.busySince
+            self.busySince = None
+
+    def stats(self):
+        return TransmitStats(self.fragments, self.bytes, self.acks,
+                             self.inFlight, self.throughput())
+
+    def throughput(self):
+        """ Bytes per second while busy. """
+        busyTime = self.busyTime
+        if self.busySince is not None:
+            busyTime += time.monotonic() - self.busySince
+        return self.bytes / busyTime if busyTime else 0.
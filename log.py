@@ -0,0 +1,21 @@
+import binascii
+
+LOG_LEVEL = 0
+
+
+def log(level, *args):
+    if level <= LOG_LEVEL:
+        print(*args, flush=True)
+
+
+class Hex:
+    """
+    Wraps bytes for log(); they are only converted to hex if printed.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(self.data).decode()
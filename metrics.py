@@ -0,0 +1,193 @@
+import time
+import bisect
+import collections
+from collections import namedtuple
+
+import async
+from protocol import StatusError
+
+"""
+Instrumentation for the protocol engine.  A PeripheralController created with
+metrics=Metrics() records request latency per command byte, per-fragment ACK
+round trips, reassembly time, the event loop handoff after each response,
+fragment counts, CRC failures, StatusError kinds, request timeouts and
+retries.  Without one, the only cost on the hot path is a test for None.
+snapshot() is cheap enough to poll; exposition() renders the Prometheus text
+format.  Counters are updated without locking from the transport's threads,
+so they are approximate under contention.
+"""
+
+# 10 us to about 84 s, doubling
+LATENCY_BOUNDS = tuple(1e-5 * 2**i for i in range(24))
+
+
+class HistogramSnapshot(namedtuple('HistogramSnapshot', 'count, sum, min, '
+                                   'max, buckets')):
+    def quantile(self, q):
+        """
+        Estimate the q-quantile as the upper bound of its bucket.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, cumulative in self.buckets:
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets, with sum, min and max.
+    """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        buckets, cumulative = [], 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return HistogramSnapshot(self.count, self.sum, self.min, self.max,
+                                 tuple(buckets))
+
+
+class Metrics:
+    """
+    Metrics for one PeripheralController; see the module docstring.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.controller = None
+        self.latency = collections.defaultdict(Histogram)  # command ->
+        self.ackRTT = Histogram()
+        self.reassembly = Histogram()
+        self.handoff = Histogram()
+        self.unacked = collections.deque()  # send times of unACKed fragments
+        self.fragments = {'rx': 0, 'tx': 0}
+        self.acks = 0
+        self.crcErrors = 0
+        self.statusErrors = collections.Counter()
+        self.mismatches = 0
+        self.timeouts = 0
+        self.retries = 0
+
+    def attach(self, controller):
+        self.controller = controller
+
+    def sent(self):
+        self.fragments['tx'] += 1
+        self.unacked.append(self.clock())
+
+    def acked(self):
+        self.acks += 1
+        if self.unacked:
+            self.ackRTT.observe(self.clock() - self.unacked.popleft())
+
+    def idle(self):
+        # every fragment sent has been answered; ACKs lost on the way cannot
+        # be matched any more
+        self.unacked.clear()
+
+    def received(self, started):
+        self.fragments['rx'] += 1
+        self.reassembly.observe(self.clock() - started)
+
+    def responded(self, command, started, status):
+        self.latency[command].observe(self.clock() - started)
+        if status:
+            self.statusErrors[StatusError(status).kind] += 1
+
+    def gauges(self):
+        controller = self.controller
+        gauges = collections.OrderedDict([
+            ('completion_queue_depth', async.completions.depth),
+            ('completion_queue_peak', async.completions.peak),
+            ('completion_queue_drains', async.completions.drains),
+        ])
+        if controller is not None:
+            gauges['in_flight'] = len(controller.in_flight)
+            gauges['deferred_writes'] = controller.deferred_writes.qsize()
+            gauges['tx_window_in_flight'] = controller.tx_window.inFlight
+            gauges['read_stream_depth'] = controller.read_stream.depth
+        return gauges
+
+    def snapshot(self):
+        """
+        Return a dict of the current counters, gauges and histograms.
+        """
+        return {
+            'latency': {command: h.snapshot()
+                        for command, h in list(self.latency.items())},
+            'ack_rtt': self.ackRTT.snapshot(),
+            'reassembly': self.reassembly.snapshot(),
+            'handoff': self.handoff.snapshot(),
+            'fragments': dict(self.fragments),
+            'acks': self.acks,
+            'crc_errors': self.crcErrors,
+            'status_errors': dict(self.statusErrors),
+            'mismatches': self.mismatches,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'gauges': self.gauges(),
+        }
+
+    def exposition(self, prefix='glm'):
+        """
+        Render a snapshot in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def histogram(name, h, labels=''):
+            for bound, cumulative in h.buckets:
+                lines.append('%s_%s_bucket{%sle="%s"} %d' %
+                             (prefix, name, labels + ',' if labels else '',
+                              '+Inf' if bound == float('inf') else
+                              '%g' % bound, cumulative))
+            lines.append('%s_%s_sum%s %g' %
+                         (prefix, name, '{%s}' % labels if labels else '',
+                          h.sum))
+            lines.append('%s_%s_count%s %d' %
+                         (prefix, name, '{%s}' % labels if labels else '',
+                          h.count))
+        lines.append('# TYPE %s_request_seconds histogram' % prefix)
+        for command, h in sorted(snapshot['latency'].items()):
+            histogram('request_seconds', h, 'command="0x%02x"' % command)
+        for name in ('ack_rtt', 'reassembly', 'handoff'):
+            lines.append('# TYPE %s_%s_seconds histogram' % (prefix, name))
+            histogram(name + '_seconds', snapshot[name])
+        lines.append('# TYPE %s_fragments_total counter' % prefix)
+        for direction, count in sorted(snapshot['fragments'].items()):
+            lines.append('%s_fragments_total{direction="%s"} %d' %
+                         (prefix, direction, count))
+        for name in ('acks', 'crc_errors', 'mismatches', 'timeouts',
+                     'retries'):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %d' % (prefix, name, snapshot[name]))
+        lines.append('# TYPE %s_status_errors_total counter' % prefix)
+        for kind, count in sorted(snapshot['status_errors'].items()):
+            lines.append('%s_status_errors_total{kind="%s"} %d' %
+                         (prefix, kind, count))
+        for name, value in snapshot['gauges'].items():
+            lines.append('# TYPE %s_%s gauge' % (prefix, name))
+            lines.append('%s_%s %d' % (prefix, name, value))
+        return '\n'.join(lines) + '\n'
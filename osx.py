@@ -36,6 +36,9 @@ f.restype, f.argtypes = ctypes.c_void_p, (ctypes.c_char_p, ctypes.c_void_p)
 f = libSystem.dispatch_async_f
 f.restype, f.argtypes = None, (ctypes.c_void_p, ctypes.c_void_p,
                                dispatch_function_t)
+f = libSystem.dispatch_after_f
+f.restype, f.argtypes = None, (dispatch_time_t, ctypes.c_void_p,
+                               ctypes.c_void_p, dispatch_function_t)
 f = libSystem.dispatch_source_set_event_handler_f
 f.restype, f.argtypes = None, (ctypes.c_void_p, dispatch_function_t)
 f = libSystem.dispatch_source_create
@@ -55,6 +58,9 @@ f.restype, f.argtypes = None, (ctypes.c_void_p,)
 del f
 DISPATCH_TIME_NOW = dispatch_time_t(0)
 NSEC_PER_SEC = 1000000000
+# function pointers submitted to libdispatch, kept alive until called; a
+# closure cycle alone could be collected before then
+pending_callbacks = set()
 
 
 class DispatchTimer:
@@ -86,15 +92,33 @@ def dispatch_async(queue, func):
     """
     Submit a Python callable to a dispatch queue.
     """
-    cb = None
-
     @dispatch_function_t
     def cb(context):
-        cb  # close over the function pointer object to extend its lifetime
-        func()
+        try:
+            func()
+        finally:
+            pending_callbacks.discard(cb)
+    pending_callbacks.add(cb)
     libSystem.dispatch_async_f(queue.__c_void_p__(), None, cb)
 
 
+def dispatch_after(delay, queue, func):
+    """
+    Submit a Python callable to a dispatch queue after delay seconds.
+    """
+    @dispatch_function_t
+    def cb(context):
+        try:
+            func()
+        finally:
+            pending_callbacks.discard(cb)
+    pending_callbacks.add(cb)
+    libSystem.dispatch_after_f(
+            libSystem.dispatch_time(DISPATCH_TIME_NOW,
+                                    int(delay * NSEC_PER_SEC)),
+            queue.__c_void_p__(), None, cb)
+
+
 def dispatch_get_global_queue(identifier, flags):
     return objc.objc_object(
             c_void_p=libSystem.dispatch_get_global_queue(identifier, flags))
@@ -1,98 +1,118 @@
-import struct
 import enum
-import objc
-import CoreBluetooth
 from collections import namedtuple
 
+from schema import Layout, message
+
 """
-Define structured datatypes for some MT protocol messages.
+Define structured datatypes for the MT protocol messages, and the schema of
+each command: the layouts of its request and response payloads.  Every
+message class is a namedtuple with fromBytes() and toBytes(), generated from
+its Layout, and a lazy MessageView counterpart as its View attribute.
 """
 
 
-class GLMSettings(namedtuple('GLMSettings', 'spiritLevelEnabled, '
-                             'dispRotationEnabled, speakerEnabled, '
-                             'laserPointerEnabled, backlightMode, '
-                             'angleUnit, measurementUnit')):
-    @staticmethod
-    def fromBytes(b):
-        return GLMSettings(*struct.unpack('????BBBxxxx', b))
-
-    def toBytes(self):
-        return struct.pack('????BBBxxxx', *tuple(self))
-
-
-class GLMDeviceInfo(namedtuple('GLMDeviceInfo', 'serialNumber, swRevision, '
-                               'swVersionMain, swVersionSub, swVersionBug, '
-                               'hwPCBVersion, hwPCBVariant, hwPCBBug, '
-                               'unknown')):
-    @staticmethod
-    def fromBytes(b):
-        return GLMDeviceInfo(*struct.unpack('xxxxihBBBBBB12sx', b))
-
-
-class GLMSyncContainer(namedtuple('GLMSyncContainer', 'measurementType, '
-                                  'calcIndicator, distReference, '
-                                  'angleReference, distanceUnit, '
-                                  'stateOfCharge, temperature, distance, '
-                                  'result, angle, timestamp, laserOn, '
-                                  'usabilityErrors, measurementListIndex, '
-                                  'compassHeading, ndofSensorStatus')):
-    @staticmethod
-    def fromBytes(b):
-        return GLMSyncContainer(
-            measurementType=b[0] & 0x1f,
-            calcIndicator=b[0] >> 5,
-            distReference=b[1] & 7,
-            angleReference=(b[1] >> 3) & 7,
-            distanceUnit=(b[1] >> 6) & 1,
-            stateOfCharge=b[2],
-            temperature=b[3],
-            distance=struct.unpack_from('fff', b, 4),
-            result=struct.unpack_from('f', b, 16)[0],
-            angle=struct.unpack_from('f', b, 20)[0],
-            timestamp=struct.unpack_from('i', b, 24)[0],
-            laserOn=b[28] & 1,
-            usabilityErrors=b[28] >> 1,
-            measurementListIndex=b[29],
-            compassHeading=struct.unpack_from('h', b, 30)[0],
-            ndofSensorStatus=b[32],
-        )
-
-
-class GLMPayloadSize(namedtuple('GLMPayloadSize', 'RXPayloadSize, '
-                                'TXPayloadSize')):
-    @staticmethod
-    def fromBytes(b):
-        return GLMPayloadSize(*struct.unpack('xxxxHH', b))
-
-
-class GLMProtocolVersion(namedtuple('GLMProtocolVersion', 'Main, Sub, Bug, '
-                                    'ProjMain, ProjSub, ProjBug')):
-    @staticmethod
-    def fromBytes(b):
-        return GLMProtocolVersion(*b)
-
-
-class GLMRealTimeClock(namedtuple('GLMRealTimeClock', 'clockSeconds')):
-    @staticmethod
-    def fromBytes(b):
-        return GLMRealTimeClock(*struct.unpack('I', b))
-
-
-class GLMUploadResult(namedtuple('GLMUploadResult', 'uploadErrorCode, '
-                                 'blockNumber')):
-    @staticmethod
-    def fromBytes(b):
-        return GLMUploadResult(uploadErrorCode=b[0] & 0xf,
-                               blockNumber=b[0] >> 4)
-
-
-GLM_SERVICE_UUID = CoreBluetooth.CBUUID.alloc() \
-                    .initWithString_("00005301-0000-0041-5253-534F46540000")
-TX_CHARACTERISTIC_UUID = CoreBluetooth.CBUUID.alloc() \
-                    .initWithString_("00004301-0000-0041-5253-534F46540000")
-RX_CHARACTERISTIC_UUID = CoreBluetooth.CBUUID.alloc() \
-                    .initWithString_("00004302-0000-0041-5253-534F46540000")
+GLMSettings = message('GLMSettings', Layout([
+    ('?', 'spiritLevelEnabled'),
+    ('?', 'dispRotationEnabled'),
+    ('?', 'speakerEnabled'),
+    ('?', 'laserPointerEnabled'),
+    ('B', 'backlightMode'),
+    ('B', 'angleUnit'),
+    ('B', 'measurementUnit'),
+    ('4x', None),
+]))
+
+GLMDeviceInfo = message('GLMDeviceInfo', Layout([
+    ('4x', None),
+    ('i', 'serialNumber'),
+    ('h', 'swRevision'),
+    ('B', 'swVersionMain'),
+    ('B', 'swVersionSub'),
+    ('B', 'swVersionBug'),
+    ('B', 'hwPCBVersion'),
+    ('B', 'hwPCBVariant'),
+    ('B', 'hwPCBBug'),
+    ('12s', 'unknown'),
+    ('x', None),
+]))
+
+GLMSyncContainer = message('GLMSyncContainer', Layout([
+    ('B', (('measurementType', 5), ('calcIndicator', 3))),
+    ('B', (('distReference', 3), ('angleReference', 3),
+           ('distanceUnit', 1))),
+    ('B', 'stateOfCharge'),
+    ('B', 'temperature'),
+    ('3f', 'distance'),
+    ('f', 'result'),
+    ('f', 'angle'),
+    ('i', 'timestamp'),
+    ('B', (('laserOn', 1), ('usabilityErrors', 7))),
+    ('B', 'measurementListIndex'),
+    ('h', 'compassHeading'),
+    ('B', 'ndofSensorStatus'),
+]))
+
+GLMPayloadSize = message('GLMPayloadSize', Layout([
+    ('4x', None),
+    ('H', 'RXPayloadSize'),
+    ('H', 'TXPayloadSize'),
+]))
+
+GLMProtocolVersion = message('GLMProtocolVersion', Layout([
+    ('B', 'Main'),
+    ('B', 'Sub'),
+    ('B', 'Bug'),
+    ('B', 'ProjMain'),
+    ('B', 'ProjSub'),
+    ('B', 'ProjBug'),
+]))
+
+GLMRealTimeClock = message('GLMRealTimeClock', Layout([
+    ('I', 'clockSeconds'),
+]))
+
+GLMUploadResult = message('GLMUploadResult', Layout([
+    ('B', (('uploadErrorCode', 4), ('blockNumber', 4))),
+]))
+
+# Request payloads
+
+GLMControl = message('GLMControl', Layout([
+    ('B', (('measurementType', 5), ('signalOperation', 1),
+           ('syncControl', 1), ('switchMode', 1))),
+    ('B', (('distReference', 3), ('angleReference', 3))),
+]), defaults=(0,) * 6)
+
+GLMMeasurementRange = message('GLMMeasurementRange', Layout([
+    ('B', 'first'),
+    ('B', 'last'),
+]))
+
+GLMUploadBlock = message('GLMUploadBlock', Layout([
+    ('B', (('blockType', 4), ('blockNumber', 4))),
+    ('B', 'length'),
+], tail='chunkData'))
+
+# A page of concatenated GLMSyncContainers, answering GLMMeasurementRange
+GLMMeasurementPage = message('GLMMeasurementPage', Layout([
+    ('B', 'first'),
+    ('B', 'last'),
+], tail='records', stride=GLMSyncContainer.layout.size))
+
+SYNC_CONTAINER_SIZE = GLMSyncContainer.layout.size
+
+GLMSettingsView = GLMSettings.View
+GLMDeviceInfoView = GLMDeviceInfo.View
+GLMSyncContainerView = GLMSyncContainer.View
+GLMPayloadSizeView = GLMPayloadSize.View
+GLMProtocolVersionView = GLMProtocolVersion.View
+GLMRealTimeClockView = GLMRealTimeClock.View
+GLMUploadResultView = GLMUploadResult.View
+
+
+GLM_SERVICE_UUID_STRING = "00005301-0000-0041-5253-534F46540000"
+TX_CHARACTERISTIC_UUID_STRING = "00004301-0000-0041-5253-534F46540000"
+RX_CHARACTERISTIC_UUID_STRING = "00004302-0000-0041-5253-534F46540000"
 
 
 class DistReference(enum.IntEnum):
@@ -107,13 +127,21 @@ class CRCError(Exception):
     pass
 
 
+class ResponseMismatchError(Exception):
+    pass
+
+
 class StatusError(Exception):
+    KINDS = [
+        'Success', 'CommunicationTimeout', 'ModeInvalid', 'ChecksumError',
+        'UnknownCommand', 'InvalidAccessLevel', 'InvalidDatabytes',
+        'Reserved'
+    ]
+
     def __init__(self, number):
-        string = [
-            'Success', 'CommunicationTimeout', 'ModeInvalid', 'ChecksumError',
-            'UnknownCommand', 'InvalidAccessLevel', 'InvalidDatabytes',
-            'Reserved'
-        ][number & 7]
+        self.number = number
+        self.kind = self.KINDS[number & 7]
+        string = self.kind
         if number & 8:
             string += ' | HardwareError'
         if number & 16:
@@ -122,12 +150,161 @@ class StatusError(Exception):
             string += ' | HandRaised'
         super().__init__(string)
 
+    @property
+    def transient(self):
+        """
+        Whether the device may well accept the same request again shortly
+        (CommunicationTimeout or DeviceNotReady).
+        """
+        return self.number & 7 == 1 or bool(self.number & 16)
+
+
+class Command(enum.IntEnum):
+    PayloadSize = 0x00
+    ProtocolVersion = 0x04
+    DeviceInfo = 0x06
+    RealTimeClock = 0x0f
+    DeviceInfoString = 0x3a
+    UploadBlock = 0x3b
+    Control = 0x50  # also pushed by the device, carrying a GLMSyncContainer
+    GetMeasurements = 0x51
+    ClearMeasurements = 0x52
+    ReadSettings = 0x53
+    WriteSettings = 0x54
+
+
+class CommandSchema(namedtuple('CommandSchema', 'command, request, '
+                               'response, idempotent')):
+    """
+    The message classes of a command's request and response payloads.  None
+    is an empty request or response; a response of bytes is passed on as
+    it is.  An idempotent command may be sent again if its response is
+    lost.
+    """
+    pass
+
+
+COMMANDS = {schema.command: schema for schema in [
+    CommandSchema(Command.PayloadSize, None, GLMPayloadSize, True),
+    CommandSchema(Command.ProtocolVersion, None, GLMProtocolVersion, True),
+    CommandSchema(Command.DeviceInfo, None, GLMDeviceInfo, True),
+    CommandSchema(Command.RealTimeClock, None, GLMRealTimeClock, True),
+    CommandSchema(Command.DeviceInfoString, None, bytes, True),
+    CommandSchema(Command.UploadBlock, GLMUploadBlock, GLMUploadResult,
+                  False),
+    CommandSchema(Command.Control, GLMControl, GLMSyncContainer, False),
+    CommandSchema(Command.GetMeasurements, GLMMeasurementRange,
+                  GLMMeasurementPage, True),
+    CommandSchema(Command.ClearMeasurements, GLMMeasurementRange, None,
+                  False),
+    CommandSchema(Command.ReadSettings, None, GLMSettings, True),
+    CommandSchema(Command.WriteSettings, GLMSettings, None, False),
+]}
+
+
+def idempotent(command):
+    schema = COMMANDS.get(command)
+    return schema is not None and schema.idempotent
+
+
+def encodeRequest(command, *args, **kwargs):
+    """
+    Build the request payload for command from its fields.
+    """
+    request = COMMANDS[command].request
+    if request is None:
+        return b''
+    return request(*args, **kwargs).toBytes()
+
+
+def decodeRequest(command, payload):
+    """
+    Decode the payload of a request for command, or return None if it does
+    not fit the command's layout.
+    """
+    schema = COMMANDS.get(command)
+    if schema is None or schema.request is None:
+        return None if payload else ()
+    if not schema.request.layout.fits(payload):
+        return None
+    return schema.request.fromBytes(payload)
+
+
+def decodeResponse(command, payload, lazy=False):
+    """
+    Decode a successful response to command, as a MessageView if lazy is
+    set.  Responses without a layout are returned as bytes.
+    """
+    schema = COMMANDS.get(command)
+    if schema is None or schema.response in (None, bytes):
+        return payload
+    if lazy:
+        return schema.response.View(payload)
+    return schema.response.fromBytes(payload)
+
+
+def responseFits(command, payload):
+    """
+    Return whether payload is plausible as a successful response to command.
+    """
+    schema = COMMANDS.get(command)
+    if schema is None or schema.response is bytes:
+        return True
+    if schema.response is None:
+        return not payload
+    return schema.response.layout.fits(payload)
+
+
+def crc8Table(poly):
+    """
+    Return the 256-entry lookup table for a (non-reflected) CRC-8 with the
+    given generator polynomial.
+    """
+    table = bytearray(256)
+    for i in range(256):
+        value = i
+        for _ in range(8):
+            value = ((value << 1) & 0xff) ^ (poly if value & 0x80 else 0)
+        table[i] = value
+    return bytes(table)
+
+
+class CRC8:
+    """
+    Table-driven, incremental CRC-8.  Feed data with update() as it arrives
+    and read the checksum with digest(); the result is identical to running
+    crc8() over the concatenation of everything passed to update().  A frame
+    with its trailing checksum byte appended digests to zero.
+    """
+    tables = {}
+
+    def __init__(self, data=b'', iv=0xaa, poly=0xa6):
+        table = self.tables.get(poly)
+        if table is None:
+            table = self.tables[poly] = crc8Table(poly)
+        self.table = table
+        self.iv = iv
+        self.value = iv
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        value, table = self.value, self.table
+        for b in data:
+            value = table[value ^ b]
+        self.value = value
+
+    def digest(self):
+        return self.value
+
+    def reset(self):
+        self.value = self.iv
+
+    def copy(self):
+        other = CRC8.__new__(CRC8)
+        other.table, other.iv, other.value = self.table, self.iv, self.value
+        return other
+
 
 def crc8(data, iv=0xaa, poly=0xa6):
-    value = iv
-    for b in data:
-        for i in range(8):
-            x, value = (value >> 7) ^ (b >> (7-i)) & 1, (value << 1) & 0xff
-            if x:
-                value ^= poly
-    return value
+    return CRC8(data, iv, poly).digest()
@@ -0,0 +1,100 @@
+import time
+import random
+from collections import namedtuple
+
+"""
+Reconnect scheduling shared by the CoreBluetooth central (bluetooth.py) and
+the Fleet (fleet.py): the first attempt after a drop is immediate, and
+failures after it back off exponentially with jitter.
+"""
+
+
+class ReconnectStats(namedtuple('ReconnectStats', 'disconnects, reconnects, '
+                                'failures, lastLatency, meanLatency, '
+                                'maxLatency')):
+    pass
+
+
+class Backoff:
+    """
+    Backoff yields the delays before successive attempts: 0 for the first,
+    then initial * factor**n capped at maximum, each scaled by a random
+    factor in [1 - jitter, 1] so that devices dropped together do not retry
+    in lockstep.
+    """
+    def __init__(self, initial=.25, maximum=30., factor=2., jitter=.5,
+                 rng=random):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.rng = rng
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        attempts, self.attempts = self.attempts, self.attempts + 1
+        if attempts == 0:
+            return 0.
+        delay = min(self.initial * self.factor ** (attempts-1), self.maximum)
+        return delay * (1 - self.jitter * self.rng.random())
+
+
+class Reconnector:
+    """
+    Reconnector tracks the link to each device by key: call lost() when a
+    device disconnects or fails to connect, to get the delay before the next
+    attempt, and connected() once it is back.  The time from the first drop
+    to the reconnection is recorded as the reconnect latency.
+    """
+    def __init__(self, clock=time.monotonic, **backoff):
+        self.clock = clock
+        self.backoff = backoff
+        self.backoffs = {}
+        self.since = {}  # key -> time the link was lost
+        self.disconnects = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.lastLatency = None
+        self.maxLatency = None
+        self.totalLatency = 0.
+
+    def pending(self):
+        """
+        Return the keys of devices awaiting reconnection.
+        """
+        return set(self.since)
+
+    def lost(self, key, failed=False):
+        if failed:
+            self.failures += 1
+        if key not in self.since:
+            self.disconnects += 1
+            self.since[key] = self.clock()
+        if key not in self.backoffs:
+            self.backoffs[key] = Backoff(**self.backoff)
+        return self.backoffs[key].next()
+
+    def connected(self, key):
+        if key in self.backoffs:
+            self.backoffs[key].reset()
+        since = self.since.pop(key, None)
+        if since is not None:
+            latency = self.clock() - since
+            self.reconnects += 1
+            self.lastLatency = latency
+            self.maxLatency = max(latency, self.maxLatency or 0.)
+            self.totalLatency += latency
+
+    def forget(self, key):
+        self.backoffs.pop(key, None)
+        self.since.pop(key, None)
+
+    def stats(self):
+        return ReconnectStats(
+            self.disconnects, self.reconnects, self.failures,
+            self.lastLatency,
+            self.totalLatency / self.reconnects if self.reconnects else None,
+            self.maxLatency)
@@ -0,0 +1,280 @@
+import sys
+import struct
+from collections import namedtuple
+
+"""
+Declarative message layouts.  A Layout lists the fields of a little-endian
+message in wire order and is compiled, once, into a single struct.Struct and
+a plan for splitting its values into fields; message() builds a namedtuple
+class from a Layout, with fromBytes() and toBytes(), and a MessageView class
+that decodes the same fields lazily.
+"""
+
+
+class Layout:
+    """
+    Layout of an encoded message.  spec is a sequence of (format, name) in
+    wire order, where format is a struct format code without byte order:
+
+        ('B', 'stateOfCharge')     one field
+        ('3f', 'distance')         a field holding a tuple of three values
+        ('4x', None)               padding
+        ('B', (('laserOn', 1),     bitfields of one integer, least
+               ('usabilityErrors', 7)))   significant first
+
+    If tail names a field, the message may continue past the fixed part and
+    that field holds the rest of it as bytes, whose length must be a multiple
+    of stride.
+    """
+    def __init__(self, spec, tail=None, stride=1):
+        self.fields = []
+        self.plan = []  # (value index, count, shift, mask) for each field
+        self.views = []  # (format, offset, shift, width) for each field
+        self.tail = tail
+        self.stride = stride
+        formats, index, offset = [], 0, 0
+        for fmt, name in spec:
+            unpacker = struct.Struct('<' + fmt)
+            count = len(unpacker.unpack(bytes(unpacker.size)))
+            if name is None:
+                pass
+            elif isinstance(name, str):
+                self.fields.append(name)
+                self.plan.append((index, count, 0, None))
+                self.views.append((fmt, offset, 0, None))
+            else:
+                shift = 0
+                for bitName, width in name:
+                    self.fields.append(bitName)
+                    self.plan.append((index, 1, shift, (1 << width) - 1))
+                    self.views.append((fmt, offset, shift, width))
+                    shift += width
+            formats.append(fmt)
+            index += count
+            offset += unpacker.size
+        self.struct = struct.Struct('<' + ''.join(formats))
+        self.size = self.struct.size
+        self.values = index
+        # with one plain field per value, the unpacked tuple needs no work
+        self.direct = len(self.plan) == index and \
+            all(plan == (position, 1, 0, None)
+                for position, plan in enumerate(self.plan))
+        if tail is not None:
+            self.fields.append(tail)
+
+    def fits(self, payload):
+        """
+        Return whether payload has a length this layout can decode.
+        """
+        if self.tail is None:
+            return len(payload) == self.size
+        return len(payload) >= self.size and \
+            (len(payload) - self.size) % self.stride == 0
+
+    def unpack(self, b):
+        """
+        Return a tuple of the field values encoded in b.
+        """
+        if self.tail is None:
+            raw = self.struct.unpack(b)
+        else:
+            raw = self.struct.unpack_from(b)
+        if self.direct:
+            values = raw
+        else:
+            values = []
+            for index, count, shift, mask in self.plan:
+                if mask is not None:
+                    values.append((raw[index] >> shift) & mask)
+                elif count == 1:
+                    values.append(raw[index])
+                else:
+                    values.append(raw[index:index+count])
+            values = tuple(values)
+        if self.tail is not None:
+            values += (bytes(b[self.size:]),)
+        return values
+
+    def pack(self, values):
+        """
+        Encode a sequence of field values; bitfields are truncated to their
+        widths.
+        """
+        if self.direct:
+            raw = values[:self.values]
+        else:
+            raw = [0] * self.values
+            for value, (index, count, shift, mask) in zip(values, self.plan):
+                if mask is not None:
+                    raw[index] |= (value & mask) << shift
+                elif count == 1:
+                    raw[index] = value
+                else:
+                    raw[index:index+count] = value
+        data = self.struct.pack(*raw)
+        if self.tail is not None:
+            data += bytes(values[-1])
+        return data
+
+
+class Message:
+    """
+    Mixin for the namedtuple classes made by message().
+    """
+    __slots__ = ()
+    layout = None
+    View = None
+
+    @classmethod
+    def fromBytes(cls, b):
+        return cls._make(cls.layout.unpack(b))
+
+    def toBytes(self):
+        return self.layout.pack(self)
+
+
+def message(name, layout, defaults=None):
+    """
+    Return a namedtuple class with layout's fields, fromBytes() and toBytes(),
+    and a lazy counterpart as its View attribute.  defaults, if given, are
+    the default values of the last fields.
+    """
+    module = sys._getframe(1).f_globals.get('__name__', '__main__')
+    cls = type(name, (Message, namedtuple(name, layout.fields)),
+               {'__slots__': (), 'layout': layout, '__module__': module})
+    if defaults is not None:
+        cls.__new__.__defaults__ = tuple(defaults)
+    namespace = {'__slots__': (), 'Tuple': cls, '_fields': cls._fields,
+                 'size': layout.size, '__module__': module}
+    for index, (field, view) in enumerate(zip(layout.fields, layout.views)):
+        namespace[field] = Field(index, *view)
+    if layout.tail is not None:
+        namespace[layout.tail] = Tail(len(layout.views), layout.size)
+    cls.View = type(name + 'View', (MessageView,), namespace)
+    return cls
+
+
+class Field:
+    """
+    Descriptor for one field of a MessageView: the value unpacked with fmt
+    at offset, optionally reduced to width bits starting at bit shift.
+    Decoded on first access and memoized in the view.
+    """
+    structs = {}
+
+    def __init__(self, index, fmt, offset, shift=0, width=None):
+        unpacker = self.structs.get(fmt)
+        if unpacker is None:
+            unpacker = self.structs[fmt] = struct.Struct('<' + fmt)
+        self.index = index
+        self.unpack_from = unpacker.unpack_from
+        self.single = len(unpacker.unpack(bytes(unpacker.size))) == 1
+        self.byte = fmt == 'B'  # indexing the memoryview is quicker
+        self.offset = offset
+        self.shift = shift
+        self.mask = None if width is None else (1 << width) - 1
+
+    def __get__(self, view, cls):
+        if view is None:
+            return self
+        value = view.values[self.index]
+        if value is None:
+            if self.byte:
+                value = view.data[self.offset]
+            else:
+                value = self.unpack_from(view.data, self.offset)
+                if self.single:
+                    value = value[0]
+            if self.mask is not None:
+                value = (value >> self.shift) & self.mask
+            view.values[self.index] = value
+        return value
+
+
+class Tail(Field):
+    """
+    Descriptor for the variable-length tail of a MessageView, as bytes.
+    """
+    def __init__(self, index, offset):
+        self.index = index
+        self.offset = offset
+
+    def __get__(self, view, cls):
+        if view is None:
+            return self
+        value = view.values[self.index]
+        if value is None:
+            value = view.values[self.index] = bytes(view.data[self.offset:])
+        return value
+
+
+class MessageView:
+    """
+    Read-only view of an encoded message that decodes fields as they are
+    read.  Wrapping a payload costs a memoryview and a list, so callers that
+    look at one or two fields (measureDistance reading result, sync checking
+    measurementListIndex and timestamp) skip decoding the rest.  A view
+    behaves like the namedtuple it is bound to: fields by name or index,
+    iteration, _fields, _asdict(), _replace(), toBytes(), and equality with
+    either.  toNamedTuple() decodes everything; a caller that needs every
+    field should use the namedtuple's fromBytes, which does it in fewer
+    steps.  The view keeps the payload it wraps alive.
+    """
+    __slots__ = ('data', 'values')
+    Tuple = None
+    _fields = ()
+    size = 0
+
+    def __init__(self, data):
+        data = memoryview(data)
+        if len(data) < self.size:
+            raise struct.error('%s requires a buffer of %d bytes' %
+                               (type(self).__name__, self.size))
+        self.data = data
+        self.values = [None] * len(self._fields)
+
+    @classmethod
+    def fromBytes(cls, b):
+        return cls(b)
+
+    def toBytes(self):
+        return bytes(self.data)
+
+    def toNamedTuple(self):
+        return self.Tuple._make(self)
+
+    def __iter__(self):
+        for name in self._fields:
+            yield getattr(self, name)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        return getattr(self, self._fields[index])
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, MessageView)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(self.toNamedTuple())
+
+    def __reduce__(self):
+        return (type(self), (self.toBytes(),))
+
+    def _asdict(self):
+        return self.toNamedTuple()._asdict()
+
+    def _replace(self, **kwargs):
+        return self.toNamedTuple()._replace(**kwargs)
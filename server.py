@@ -0,0 +1,390 @@
+import json
+import asyncio
+import collections
+
+from log import log
+from sync import MeasurementStore, syncMeasurements
+
+"""
+A network front end for a Fleet.  Clients connect over TCP or a Unix socket
+and exchange JSON objects, one per line:
+
+    {"id": 1, "op": "settings", "device": "32F6...", "fresh": true}
+    {"id": 1, "result": {"spiritLevelEnabled": 1, ...}}
+
+    {"id": 2, "op": "measure"}
+    {"id": 2, "error": "TimeoutError: ..."}
+
+id is echoed back so that a client may pipeline requests; responses come
+in the order requests complete.  Every other key but op and device is an
+argument of the operation (see Server.operations).  Messages are returned
+as objects, bytes as hex strings.
+
+Identical reads that are in progress at once -- settings, device info,
+the latest measurement -- share one trip to the device, unless they ask
+for fresh values.  Each client has
+its own outgoing queue and a limit on outstanding requests, so a client
+that stops reading only stalls itself.
+"""
+
+
+class RemoteError(Exception):
+    pass
+
+
+def encode(value):
+    """
+    Convert a result to something json can serialize.
+    """
+    if hasattr(value, '_asdict'):
+        return collections.OrderedDict(
+            (name, encode(v)) for name, v in value._asdict().items())
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, dict):
+        return collections.OrderedDict(
+            (str(k), encode(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    return value
+
+
+class Coalescer:
+    """
+    Runs at most one coroutine per key at a time: run() while one is in
+    progress returns the same task instead of starting another.  Callers
+    should await the task through asyncio.shield(), so that one giving up
+    does not cancel it for the rest.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.tasks = {}  # key -> Task
+        self.started = 0
+        self.coalesced = 0
+
+    def run(self, key, start):
+        task = self.tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        task = self.tasks[key] = self.loop.create_task(start())
+        self.started += 1
+        task.add_done_callback(lambda t: self.finished(key, t))
+        return task
+
+    def finished(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+        # every caller may have timed out
+        task.cancelled() or task.exception()
+
+
+class Session:
+    """
+    One client connection.  Requests are read as they come and run
+    concurrently, up to maxPending at once; their responses are queued for
+    a separate task that writes them out, and a request counts as pending
+    until its response is written.  So when the client stops reading, its
+    queue fills, it is no longer read from, and the other clients are left
+    alone.
+    """
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername') or \
+            writer.get_extra_info('sockname')
+        self.outbox = asyncio.Queue(loop=server.loop)
+        self.slots = asyncio.Semaphore(server.maxPending, loop=server.loop)
+        self.pending = set()  # request tasks
+        self.task = None
+        self.requests = 0
+
+    def __repr__(self):
+        return '<Session %s>' % (self.peer,)
+
+    @asyncio.coroutine
+    def run(self):
+        loop = self.server.loop
+        self.task = asyncio.Task.current_task(loop=loop)
+        sender = loop.create_task(self.send())
+        try:
+            while True:
+                yield from self.slots.acquire()
+                line = yield from self.reader.readline()
+                if not line:
+                    break
+                task = loop.create_task(self.handle(line))
+                self.pending.add(task)
+                task.add_done_callback(self.pending.discard)
+            # answer what was asked before the client hung up
+            if self.pending:
+                yield from asyncio.wait(list(self.pending), loop=loop)
+            self.outbox.put_nowait(None)
+            yield from sender
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log(1, '%r failed: %s' % (self, e))
+        finally:
+            for task in self.pending:
+                task.cancel()
+            sender.cancel()
+            self.writer.close()
+
+    @asyncio.coroutine
+    def handle(self, line):
+        requestId = None
+        try:
+            request = json.loads(line.decode())
+            if not isinstance(request, dict):
+                raise ValueError('Request is not an object')
+            requestId = request.pop('id', None)
+            self.requests += 1
+            result = yield from self.server.dispatch(self, request)
+            response = json.dumps({'id': requestId, 'result': encode(result)})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.server.errors += 1
+            response = json.dumps({'id': requestId, 'error': '%s: %s' % (
+                type(e).__name__, e)})
+        self.outbox.put_nowait(response.encode() + b'\n')
+
+    @asyncio.coroutine
+    def send(self):
+        try:
+            while True:
+                response = yield from self.outbox.get()
+                if response is None:
+                    break
+                self.writer.write(response)
+                yield from self.writer.drain()
+                self.slots.release()
+        except Exception as e:
+            log(1, '%r lost: %s' % (self, e))
+            self.task.cancel()
+
+
+class Server:
+    """
+    Serves the devices of fleet.  Device operations are submitted to the
+    Fleet as jobs on behalf of the client's Session, so they share devices
+    round-robin by client, and each must complete within timeout seconds.
+    Reads named in coalesce are shared between clients while in progress,
+    except those passing fresh, which must see the device's current state.
+    latest syncs each device's measurements into store (by default an
+    in-memory MeasurementStore) and returns the newest.  If telemetry is
+    given, it is queried by the telemetry operation.  Loop thread only.
+    """
+    def __init__(self, fleet, telemetry=None, store=None, maxPending=16,
+                 timeout=30., loop=None):
+        self.fleet = fleet
+        self.telemetry = telemetry
+        self.store = MeasurementStore() if store is None else store
+        self.maxPending = maxPending
+        self.timeout = timeout
+        self.loop = loop or fleet.loop
+        self.coalescer = Coalescer(self.loop)
+        self.server = None
+        self.sessions = set()
+        self.clients = 0
+        self.requests = 0
+        self.errors = 0
+        self.operations = {
+            'devices': self.devices,
+            'settings': self.readSettings,
+            'deviceInfo': self.deviceInfo,
+            'latest': self.latest,
+            'measure': self.measure,
+            'writeSettings': self.writeSettings,
+            'telemetry': self.queryTelemetry,
+            'stats': self.stats,
+        }
+        self.coalesce = {'settings', 'deviceInfo', 'latest'}
+
+    @asyncio.coroutine
+    def start(self, host=None, port=None, path=None):
+        """
+        Listen on a TCP address or, given path, a Unix socket.
+        """
+        if path is not None:
+            self.server = yield from asyncio.start_unix_server(
+                    self.accept, path, loop=self.loop)
+        else:
+            self.server = yield from asyncio.start_server(
+                    self.accept, host, port, loop=self.loop)
+        for sock in self.server.sockets:
+            log(0, 'Listening on %s' % (sock.getsockname(),))
+        return self
+
+    @asyncio.coroutine
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            yield from self.server.wait_closed()
+        tasks = [session.task for session in self.sessions
+                 if session.task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            yield from asyncio.wait(tasks, loop=self.loop)
+
+    @asyncio.coroutine
+    def accept(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.add(session)
+        self.clients += 1
+        log(1, 'Connected %r' % session)
+        try:
+            yield from session.run()
+        finally:
+            self.sessions.discard(session)
+            log(1, 'Disconnected %r' % session)
+
+    @asyncio.coroutine
+    def dispatch(self, session, request):
+        op = request.pop('op', None)
+        operation = self.operations.get(op)
+        if operation is None:
+            raise ValueError('Unknown operation %r' % (op,))
+        device = request.pop('device', None)
+        self.requests += 1
+        if op in self.coalesce and not request.get('fresh'):
+            key = (op, device, json.dumps(request, sort_keys=True))
+            task = self.coalescer.run(
+                    key, lambda: operation(session, device, **request))
+            work = asyncio.shield(task, loop=self.loop)
+        else:
+            work = operation(session, device, **request)
+        return (yield from asyncio.wait_for(work, self.timeout,
+                                            loop=self.loop))
+
+    def submit(self, session, device, job):
+        return self.fleet.submit(job, device, session)
+
+    # Operations: coroutines taking the Session, the device (None for any),
+    # and the request's arguments
+
+    @asyncio.coroutine
+    def devices(self, session, device):
+        return [collections.OrderedDict([
+            ('device', handle.deviceId), ('connected', handle.glm is not None),
+            ('load', handle.load), ('completed', handle.completed),
+            ('failed', handle.failed)]) for handle in self.fleet]
+
+    @asyncio.coroutine
+    def readSettings(self, session, device, fresh=False):
+        return (yield from self.submit(
+            session, device, lambda glm: glm.readSettings(fresh)))
+
+    @asyncio.coroutine
+    def deviceInfo(self, session, device, fresh=False):
+        return (yield from self.submit(
+            session, device, lambda glm: glm.deviceInfo(fresh)))
+
+    @asyncio.coroutine
+    def latest(self, session, device):
+        @asyncio.coroutine
+        def job(glm):
+            yield from syncMeasurements(glm, self.store)
+            return self.store.newest((yield from glm.serialNumber()))
+        return (yield from self.submit(session, device, job))
+
+    @asyncio.coroutine
+    def measure(self, session, device, **kwargs):
+        return (yield from self.fleet.measure(device, session, **kwargs))
+
+    @asyncio.coroutine
+    def writeSettings(self, session, device, **kwargs):
+        @asyncio.coroutine
+        def job(glm):
+            yield from glm.writeSettings(**kwargs)
+            return (yield from glm.readSettings())
+        return (yield from self.submit(session, device, job))
+
+    @asyncio.coroutine
+    def queryTelemetry(self, session, device, metric=None, since=None,
+                       until=None, resolution=None):
+        if self.telemetry is None:
+            raise ValueError('Telemetry is not enabled')
+        if metric is None:
+            latest = self.telemetry.latest()
+            return latest if device is None else latest.get(device, {})
+        return self.telemetry.query(device, metric, since, until, resolution)
+
+    @asyncio.coroutine
+    def stats(self, session, device):
+        return collections.OrderedDict([
+            ('clients', len(self.sessions)), ('accepted', self.clients),
+            ('requests', self.requests), ('errors', self.errors),
+            ('deviceReads', self.coalescer.started),
+            ('coalesced', self.coalescer.coalesced)])
+
+
+class Client:
+    """
+    A client of Server, for scripts and load tests.  request() may be
+    called concurrently; responses are matched to requests by id.
+    """
+    def __init__(self, reader, writer, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.reader = reader
+        self.writer = writer
+        self.nextId = 0
+        self.waiting = {}  # id -> Future
+        self.task = self.loop.create_task(self.receive())
+
+    @classmethod
+    @asyncio.coroutine
+    def open(cls, host=None, port=None, path=None, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        if path is not None:
+            reader, writer = yield from asyncio.open_unix_connection(
+                    path, loop=loop)
+        else:
+            reader, writer = yield from asyncio.open_connection(
+                    host, port, loop=loop)
+        return cls(reader, writer, loop)
+
+    @asyncio.coroutine
+    def request(self, op, device=None, **kwargs):
+        """
+        Return the result of op, or raise RemoteError with the server's
+        message.
+        """
+        if self.task.done():
+            raise ConnectionError('Connection closed')
+        self.nextId += 1
+        request = dict(kwargs, id=self.nextId, op=op)
+        if device is not None:
+            request['device'] = device
+        future = self.waiting[self.nextId] = asyncio.Future(loop=self.loop)
+        self.writer.write(json.dumps(request).encode() + b'\n')
+        try:
+            response = yield from future
+        finally:
+            self.waiting.pop(request['id'], None)
+        if 'error' in response:
+            raise RemoteError(response['error'])
+        return response['result']
+
+    @asyncio.coroutine
+    def receive(self):
+        try:
+            while True:
+                line = yield from self.reader.readline()
+                if not line:
+                    break
+                response = json.loads(line.decode())
+                future = self.waiting.get(response.get('id'))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection closed'))
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
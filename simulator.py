@@ -0,0 +1,533 @@
+import time
+import uuid
+import random
+import asyncio
+import threading
+
+from protocol import *
+from framing import Framer, Reassembler, ack, ACK, REQUEST
+from transport import Transport
+from controller import PeripheralController
+
+"""
+An in-process simulated GLM 100 C.  SimulatedGLM speaks the MT protocol at the
+fragment level -- per-fragment ACKs, CRC checking, status codes, and the
+0x00/0x04/0x06/0x0f/0x3a/0x3b/0x50-0x54 commands backed by a synthetic
+measurement memory -- over a radio link with configurable latency, loss,
+reordering and MTU.  SimulatedTransport connects it to a PeripheralController
+in-process, serve() exposes it to a StreamTransport over a socket, and
+SimulatedPeripheral puts it where a CBPeripheral would be, and
+SimulatedCentral where a CentralController would, so the rest of the stack
+can be exercised and benchmarked without the device.
+"""
+
+# CBCharacteristicWriteType
+WRITE_WITH_RESPONSE, WRITE_WITHOUT_RESPONSE = 0, 1
+# CBCharacteristicProperties
+PROPERTY_WRITE_WITHOUT_RESPONSE, PROPERTY_WRITE, PROPERTY_NOTIFY = 4, 8, 16
+
+# Status codes, see StatusError
+SUCCESS = 0
+COMMUNICATION_TIMEOUT = 1
+MODE_INVALID = 2
+CHECKSUM_ERROR = 3
+UNKNOWN_COMMAND = 4
+INVALID_DATABYTES = 6
+DEVICE_NOT_READY = 16
+
+
+def call_soon(loop, cb, *args):
+    """
+    Schedule cb on loop from any thread, avoiding the self-pipe write when
+    already on the main (loop) thread.
+    """
+    if threading.current_thread() is threading.main_thread():
+        loop.call_soon(cb, *args)
+    else:
+        loop.call_soon_threadsafe(cb, *args)
+
+
+class Link:
+    """
+    One direction of the simulated radio link.  Each fragment is delivered
+    after latency plus uniform jitter; with probability loss it is dropped,
+    and with probability reorder it is held back long enough to be overtaken
+    by the fragments behind it.  reset() loses whatever is in the air.  Must
+    be used from the loop thread.
+    """
+    def __init__(self, loop, deliver, rng, latency=0., jitter=0., loss=0.,
+                 reorder=0.):
+        self.loop = loop
+        self.deliver = deliver
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.last = 0.
+        self.epoch = 0
+        self.sent = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def send(self, fragment):
+        self.sent += 1
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        if self.reorder and self.rng.random() < self.reorder:
+            self.reordered += 1
+            delay += 2 * (self.latency + self.jitter) + .001
+            self.loop.call_later(delay, self.arrive, self.epoch, fragment)
+        elif delay:
+            # jitter alone never reorders: the link is FIFO
+            when = max(self.loop.time() + delay, self.last + 1e-6)
+            self.last = when
+            self.loop.call_at(when, self.arrive, self.epoch, fragment)
+        else:
+            self.loop.call_soon(self.arrive, self.epoch, fragment)
+
+    def arrive(self, epoch, fragment):
+        if epoch == self.epoch:
+            self.deliver(fragment)
+
+    def reset(self):
+        self.epoch += 1
+
+
+class SimulatedGLM:
+    """
+    SimulatedGLM is the device end of the link.  The host calls write() with
+    each outgoing fragment (from any thread); fragments from the device are
+    passed to the notify callback on the loop thread.  press() simulates the
+    measure button, pushing a 0x50 sync request to the host if auto sync has
+    been turned on.  The link and protocol counters are kept as attributes.
+    """
+    def __init__(self, loop=None, serialNumber=1234567, measurements=0,
+                 memorySize=50, mtu=20, rxPayloadSize=255, txPayloadSize=255,
+                 latency=0., jitter=0., loss=0., reorder=0., errorRate=0.,
+                 seed=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.rng = random.Random(seed)
+        self.notify = None
+        self.mtu = mtu
+        self.uplink = Link(self.loop, self.receive, self.rng, latency, jitter,
+                           loss, reorder)
+        self.downlink = Link(self.loop, self.deliver, self.rng, latency,
+                             jitter, loss, reorder)
+        self.framer = Framer(fragmentSize=mtu-1)
+        self.reassembler = Reassembler()
+        self.errorRate = errorRate
+        self.payloadSize = GLMPayloadSize(rxPayloadSize, txPayloadSize)
+        self.protocolVersion = GLMProtocolVersion(1, 0, 0, 1, 0, 0)
+        self.deviceInfo = GLMDeviceInfo(serialNumber, 1, 1, 2, 3, 1, 0, 0,
+                                        b'\0' * 12)
+        self.deviceInfoString = b'GLM 100 C'
+        self.settings = GLMSettings(
+                spiritLevelEnabled=True, dispRotationEnabled=True,
+                speakerEnabled=True, laserPointerEnabled=False,
+                backlightMode=0, angleUnit=0, measurementUnit=0)
+        self.laserOn = False
+        self.autoSync = False
+        self.stateOfCharge = 100
+        self.rssi = -60  # dBm, mean signal strength seen by the host
+        self.memorySize = memorySize
+        self.memory = []
+        self.nextIndex = 0
+        self.uploads = []
+        self.requests = 0
+        self.acks = 0
+        self.crcErrors = 0
+        self.handlers = {
+            Command.PayloadSize: self.handlePayloadSize,
+            Command.ProtocolVersion: self.handleProtocolVersion,
+            Command.DeviceInfo: self.handleDeviceInfo,
+            Command.RealTimeClock: self.handleRealTimeClock,
+            Command.DeviceInfoString: self.handleDeviceInfoString,
+            Command.UploadBlock: self.handleUploadBlock,
+            Command.Control: self.handleControl,
+            Command.GetMeasurements: self.handleGetMeasurements,
+            Command.ClearMeasurements: self.handleClearMeasurements,
+            Command.ReadSettings: self.handleReadSettings,
+            Command.WriteSettings: self.handleWriteSettings,
+        }
+        for i in range(measurements):
+            self.measure(1, DistReference.Tripod, 0)
+
+    # Link
+
+    def write(self, fragment, withResponse=True, completion=None):
+        """
+        Submit a host fragment; thread-safe.  completion, if given, is called
+        on the loop thread with None once a write with response is done.
+        """
+        fragment = bytes(fragment)
+        if len(fragment) > self.mtu:
+            raise ValueError('%d-byte write exceeds the %d-byte MTU' %
+                             (len(fragment), self.mtu))
+        call_soon(self.loop, self.written, fragment,
+                  completion if withResponse else None)
+
+    def written(self, fragment, completion):
+        self.uplink.send(fragment)
+        if completion is not None:
+            self.loop.call_later(self.uplink.latency, completion, None)
+
+    def signalStrength(self):
+        return int(round(self.rng.gauss(self.rssi, 3)))
+
+    def deliver(self, fragment):
+        if self.notify is not None:
+            self.notify(fragment)
+
+    def disconnect(self):
+        """
+        Drop the link state of the connection: fragments in flight are lost
+        and a partly received frame is discarded.  Loop thread only.
+        """
+        self.uplink.reset()
+        self.downlink.reset()
+        self.reassembler.reset()
+
+    def send(self, fragments):
+        for fragment in fragments:
+            self.downlink.send(bytes(fragment))
+
+    def receive(self, fragment):
+        if fragment[0] == ACK:
+            self.acks += 1
+            return
+        self.downlink.send(ack(fragment[0]))
+        try:
+            frame = self.reassembler.feed(fragment)
+        except CRCError:
+            self.crcErrors += 1
+            self.send(self.framer.response(CHECKSUM_ERROR, b''))
+            return
+        if frame is None or frame.frameType != REQUEST:
+            return
+        self.requests += 1
+        handler = self.handlers.get(frame.command)
+        request = decodeRequest(frame.command, frame.payload)
+        if handler is None:
+            status, payload = UNKNOWN_COMMAND, b''
+        elif self.errorRate and self.rng.random() < self.errorRate:
+            status, payload = COMMUNICATION_TIMEOUT, b''
+        elif request is None:
+            status, payload = INVALID_DATABYTES, b''
+        else:
+            status, payload = handler(request)
+        self.send(self.framer.response(status, payload))
+
+    # Device behaviour
+
+    def clock(self):
+        return int(time.time()) & 0x7fffffff
+
+    def measure(self, measurementType, distReference, angleReference):
+        """
+        Take a synthetic measurement and store it in the measurement memory.
+        """
+        distance = self.rng.uniform(.05, 100.)
+        if len(self.memory) >= self.memorySize:
+            del self.memory[0]
+        self.stateOfCharge = max(self.stateOfCharge - self.rng.random()*.1, 0)
+        container = GLMSyncContainer(
+            measurementType=measurementType, calcIndicator=0,
+            distReference=distReference, angleReference=angleReference,
+            distanceUnit=self.distanceUnit(),
+            stateOfCharge=int(self.stateOfCharge),
+            temperature=self.rng.randrange(20, 30),
+            distance=(distance, 0., 0.), result=distance,
+            angle=self.rng.uniform(-90., 90.), timestamp=self.clock(),
+            laserOn=1, usabilityErrors=0,
+            measurementListIndex=self.nextIndex,
+            compassHeading=self.rng.randrange(360), ndofSensorStatus=0)
+        # round the floats to what the wire carries
+        container = GLMSyncContainer.fromBytes(container.toBytes())
+        self.memory.append(container)
+        self.nextIndex = (self.nextIndex + 1) & 0xff
+        return container
+
+    def distanceUnit(self):
+        return int(self.settings.measurementUnit != DistanceUnit.Metric)
+
+    def press(self):
+        """
+        Simulate pressing the measure button.
+        """
+        container = self.measure(1, DistReference.Tripod, 0)
+        if self.autoSync:
+            self.send(self.framer.request(Command.Control,
+                                          container.toBytes()))
+        return container
+
+    # Command handlers: decoded request (see COMMANDS) -> (status, payload)
+
+    def handlePayloadSize(self, request):
+        return SUCCESS, self.payloadSize.toBytes()
+
+    def handleProtocolVersion(self, request):
+        return SUCCESS, self.protocolVersion.toBytes()
+
+    def handleDeviceInfo(self, request):
+        return SUCCESS, self.deviceInfo.toBytes()
+
+    def handleRealTimeClock(self, request):
+        return SUCCESS, GLMRealTimeClock(self.clock()).toBytes()
+
+    def handleDeviceInfoString(self, request):
+        return SUCCESS, self.deviceInfoString
+
+    def handleUploadBlock(self, request):
+        blockNumber, data = request.blockNumber, request.chunkData
+        errorCode = 0 if len(data) == request.length else 1
+        if not errorCode:
+            self.uploads.append((blockNumber, request.blockType, data))
+        return SUCCESS, GLMUploadResult(errorCode, blockNumber).toBytes()
+
+    def handleControl(self, request):
+        if request.syncControl:
+            self.autoSync = True
+        measurementType = request.measurementType
+        distReference = request.distReference
+        angleReference = request.angleReference
+        if measurementType and (self.laserOn or
+                                self.settings.laserPointerEnabled):
+            container = self.measure(measurementType, distReference,
+                                     angleReference)
+            self.laserOn = False
+        else:
+            self.laserOn = bool(measurementType)
+            container = GLMSyncContainer(
+                measurementType=measurementType, calcIndicator=0,
+                distReference=distReference, angleReference=angleReference,
+                distanceUnit=self.distanceUnit(),
+                stateOfCharge=int(self.stateOfCharge), temperature=25,
+                distance=(0., 0., 0.), result=0., angle=0.,
+                timestamp=self.clock(), laserOn=int(self.laserOn),
+                usabilityErrors=0, measurementListIndex=self.nextIndex,
+                compassHeading=0, ndofSensorStatus=0)
+        return SUCCESS, container.toBytes()
+
+    def handleGetMeasurements(self, request):
+        first, last = request
+        capacity = (self.payloadSize.TXPayloadSize - 2) // 33
+        page = sorted((c for c in self.memory
+                       if first <= c.measurementListIndex <= last),
+                      key=lambda c: c.measurementListIndex)[:capacity]
+        if not page:
+            return SUCCESS, bytes([first, first])
+        return SUCCESS, bytes([first, page[-1].measurementListIndex]) + \
+            b''.join(c.toBytes() for c in page)
+
+    def handleClearMeasurements(self, request):
+        first, last = request
+        self.memory = [c for c in self.memory
+                       if not first <= c.measurementListIndex <= last]
+        return SUCCESS, b''
+
+    def handleReadSettings(self, request):
+        return SUCCESS, self.settings.toBytes()
+
+    def handleWriteSettings(self, request):
+        self.settings = request
+        return SUCCESS, b''
+
+
+class SimulatedAttribute:
+    """
+    Stand-in for a CBService or CBCharacteristic.
+    """
+    def __init__(self, uuid, properties=0, characteristics=()):
+        self.uuid = uuid
+        self.props = properties
+        self.chars = list(characteristics)
+        self.data = None
+
+    def UUID(self):
+        return self.uuid
+
+    def properties(self):
+        return self.props
+
+    def characteristics(self):
+        return self.chars
+
+    def value(self):
+        return self.data
+
+
+class SimulatedIdentifier:
+    def __init__(self, uuidString):
+        self.uuidString = uuidString
+
+    def UUIDString(self):
+        return self.uuidString
+
+
+class SimulatedPeripheral:
+    """
+    SimulatedPeripheral implements the subset of CBPeripheral used by
+    PeripheralController on top of a SimulatedGLM.  The service and
+    characteristic UUID objects to report are passed in, so that they
+    compare equal to the CBUUIDs the controller looks for.  Delegate methods
+    are called on the loop thread.
+    """
+    def __init__(self, device, serviceUUID=GLM_SERVICE_UUID_STRING,
+                 txUUID=TX_CHARACTERISTIC_UUID_STRING,
+                 rxUUID=RX_CHARACTERISTIC_UUID_STRING, uuidString=None):
+        self.device = device
+        self.delegate = None
+        self.uuid = SimulatedIdentifier(uuidString or
+                                        str(uuid.uuid4()).upper())
+        self.tx = SimulatedAttribute(txUUID, PROPERTY_WRITE |
+                                     PROPERTY_WRITE_WITHOUT_RESPONSE)
+        self.rx = SimulatedAttribute(rxUUID, PROPERTY_NOTIFY)
+        self.service = SimulatedAttribute(serviceUUID,
+                                          characteristics=(self.tx, self.rx))
+
+    def callDelegate(self, selector, *args):
+        call_soon(self.device.loop,
+                  lambda: getattr(self.delegate, selector)(self, *args))
+
+    def setDelegate_(self, delegate):
+        self.delegate = delegate
+
+    def identifier(self):
+        return self.uuid
+
+    def services(self):
+        return [self.service]
+
+    def discoverServices_(self, uuids):
+        self.callDelegate('peripheral_didDiscoverServices_', None)
+
+    def discoverCharacteristics_forService_(self, uuids, service):
+        self.callDelegate(
+                'peripheral_didDiscoverCharacteristicsForService_error_',
+                service, None)
+
+    def setNotifyValue_forCharacteristic_(self, value, characteristic):
+        self.device.notify = self.notified if value else None
+        self.callDelegate(
+            'peripheral_didUpdateNotificationStateForCharacteristic_error_',
+            characteristic, None)
+
+    def maximumWriteValueLengthForType_(self, writeType):
+        return self.device.mtu
+
+    def canSendWriteWithoutResponse(self):
+        return True
+
+    def readRSSI(self):
+        self.callDelegate('peripheral_didReadRSSI_error_',
+                          self.device.signalStrength(), None)
+
+    def writeValue_forCharacteristic_type_(self, value, characteristic,
+                                           writeType):
+        def completion(error):
+            self.delegate.peripheral_didWriteValueForCharacteristic_error_(
+                    self, characteristic, error)
+        self.device.write(value, writeType == WRITE_WITH_RESPONSE,
+                          completion)
+
+    def notified(self, fragment):
+        self.rx.data = fragment
+        self.delegate.peripheral_didUpdateValueForCharacteristic_error_(
+                self, self.rx, None)
+
+
+class SimulatedTransport(Transport):
+    """
+    Transport connecting a PeripheralController directly to a SimulatedGLM.
+    disconnect() simulates the link dropping.
+    """
+    def __init__(self, device):
+        super().__init__()
+        self.device = device
+        self.connected = False
+
+    def attach(self, controller):
+        super().attach(controller)
+        self.connected = True
+        self.device.notify = controller.didReceive
+        call_soon(self.device.loop, controller.transportReady)
+
+    def write(self, fragment, withResponse=True):
+        if self.connected:
+            self.device.write(fragment, withResponse,
+                              self.controller.didWrite if withResponse
+                              else None)
+
+    def supportsWriteWithoutResponse(self):
+        return True
+
+    def maximumWriteLength(self):
+        return self.device.mtu
+
+    def readRSSI(self):
+        if self.connected:
+            call_soon(self.device.loop, self.controller.didReadRSSI,
+                      self.device.signalStrength())
+        return self.connected
+
+    def schedule(self, cb):
+        call_soon(self.device.loop, cb)
+
+    def disconnect(self, error='Simulated disconnect'):
+        if self.connected:
+            self.connected = False
+            if self.device.notify == self.controller.didReceive:
+                self.device.notify = None
+            call_soon(self.device.loop, self.device.disconnect)
+            call_soon(self.device.loop, self.controller.didDisconnect, error)
+
+    def close(self):
+        self.disconnect('Transport closed')
+
+
+class SimulatedCentral:
+    """
+    Stands in for CentralController (bluetooth.py): deviceFromUUIDString()
+    returns a ready PeripheralController on a SimulatedTransport, so it can
+    be passed to a Fleet.  Each uuidString gets its own SimulatedGLM, made
+    on first use with the given keyword arguments and kept across
+    reconnects, in devices.  Loop thread only.
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.devices = {}  # uuidString -> SimulatedGLM
+
+    @asyncio.coroutine
+    def deviceFromUUIDString(self, uuidString):
+        device = self.devices.get(uuidString)
+        if device is None:
+            device = self.devices[uuidString] = SimulatedGLM(**self.kwargs)
+        glm = PeripheralController(SimulatedTransport(device))
+        yield from glm.waitUntilReady()
+        return glm
+
+
+@asyncio.coroutine
+def serve(device, reader, writer):
+    """
+    Connect a SimulatedGLM to one StreamTransport client; pass to
+    asyncio.start_server() or start_unix_server() via functools.partial.
+    """
+    def notify(fragment):
+        writer.write(bytes([len(fragment)]) + fragment)
+    device.notify = notify
+    try:
+        while True:
+            length = (yield from reader.readexactly(1))[0]
+            device.write((yield from reader.readexactly(length)), False)
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        if device.notify is notify:
+            device.notify = None
+        writer.close()
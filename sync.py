@@ -0,0 +1,186 @@
+import time
+import asyncio
+import sqlite3
+
+from protocol import GLMSyncContainer, GLMSyncContainerView, Command, \
+    encodeRequest, SYNC_CONTAINER_SIZE
+
+"""
+Incremental measurement sync.  MeasurementStore keeps the raw 33-byte records
+fetched from each device in an SQLite file, keyed by the device's serial
+number and each record's (measurementListIndex, timestamp); syncMeasurements
+fetches only the records the store has not seen yet.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements (
+    serialNumber INTEGER NOT NULL,
+    measurementListIndex INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    measurementType INTEGER NOT NULL,
+    result REAL,
+    record BLOB NOT NULL,
+    synced REAL NOT NULL,
+    PRIMARY KEY (serialNumber, measurementListIndex, timestamp)
+        ON CONFLICT IGNORE
+)
+"""
+# result is NULL for a record without one, which SQLite stores for NaN
+SCHEMA_VERSION = 1
+
+
+class MeasurementStore:
+    """
+    MeasurementStore records measurements per device in the order they were
+    fetched, which is the order the device took them.  path is an SQLite
+    database file, created if need be; the default keeps the store in memory.
+    """
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path)
+        with self.db:
+            version = self.db.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                self.migrate()
+            self.db.execute(SCHEMA)
+            self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def migrate(self):
+        """
+        Bring a store made before the schema was versioned up to date: its
+        result column did not allow the NULL of a NaN result.
+        """
+        if self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'measurements'"
+                ).fetchone() is None:
+            return
+        self.db.execute('ALTER TABLE measurements RENAME TO old_measurements')
+        self.db.execute(SCHEMA)
+        self.db.execute('INSERT INTO measurements '
+                        'SELECT * FROM old_measurements')
+        self.db.execute('DROP TABLE old_measurements')
+
+    def close(self):
+        self.db.close()
+
+    def lastIndex(self, serialNumber):
+        """
+        Return the measurementListIndex of the newest stored record, or None.
+        """
+        row = self.db.execute(
+                'SELECT measurementListIndex FROM measurements '
+                'WHERE serialNumber = ? ORDER BY rowid DESC LIMIT 1',
+                (serialNumber,)).fetchone()
+        return None if row is None else row[0]
+
+    def newest(self, serialNumber):
+        """
+        Return the most recently fetched GLMSyncContainer, or None.
+        """
+        row = self.db.execute(
+                'SELECT record FROM measurements '
+                'WHERE serialNumber = ? ORDER BY rowid DESC LIMIT 1',
+                (serialNumber,)).fetchone()
+        return None if row is None else GLMSyncContainer.fromBytes(row[0])
+
+    def contains(self, serialNumber, container):
+        return self.db.execute(
+                'SELECT 1 FROM measurements WHERE serialNumber = ? AND '
+                'measurementListIndex = ? AND timestamp = ?',
+                (serialNumber, container.measurementListIndex,
+                 container.timestamp)).fetchone() is not None
+
+    def count(self, serialNumber):
+        return self.db.execute(
+                'SELECT COUNT(*) FROM measurements WHERE serialNumber = ?',
+                (serialNumber,)).fetchone()[0]
+
+    def add(self, serialNumber, records):
+        """
+        Store a sequence of (GLMSyncContainer, raw bytes) pairs in one
+        transaction, ignoring records already present.  Returns the number
+        of records added.
+        """
+        now = time.time()
+        with self.db:
+            # duplicate keys are ignored (see SCHEMA), anything else fails
+            cursor = self.db.executemany(
+                    'INSERT INTO measurements VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)',
+                    ((serialNumber, c.measurementListIndex, c.timestamp,
+                      c.measurementType, c.result, bytes(raw), now)
+                     for c, raw in records))
+        return cursor.rowcount
+
+    def measurements(self, serialNumber, since=None):
+        """
+        Return the stored GLMSyncContainers for a device, oldest first,
+        optionally only those with timestamp >= since.
+        """
+        query = 'SELECT record FROM measurements WHERE serialNumber = ?'
+        args = (serialNumber,)
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            args += (since,)
+        return [GLMSyncContainer.fromBytes(row[0])
+                for row in self.db.execute(query + ' ORDER BY rowid', args)]
+
+
+@asyncio.coroutine
+def syncMeasurements(glm, store, clear=False):
+    """
+    Fetch the measurements taken since the last sync and add them to store.
+    Indices are fetched in the order the device assigns them, starting after
+    the newest stored index and wrapping around at 255; each range stops
+    after the first page holding a record the store already has, so a sync
+    with nothing new costs one or two round trips.  If clear is set, the new
+    records are removed from the device once the store has committed them.
+    Returns the new GLMSyncContainers.
+    """
+    serialNumber = yield from glm.serialNumber()
+    last = store.lastIndex(serialNumber)
+    if last is None or last == 255:
+        ranges = [(0, 255)]
+    else:
+        ranges = [(last+1, 255), (0, last)]
+    new = []
+    for first, end in ranges:
+        known = False
+        while first <= end and not known:
+            payload = yield from glm.sendRequest(
+                    Command.GetMeasurements, encodeRequest(
+                        Command.GetMeasurements, first, end))
+            count = (len(payload)-2) // SYNC_CONTAINER_SIZE
+            if count == 0 or payload[0] != first:
+                break
+            view = memoryview(payload)
+            for i in range(2, 2+count*SYNC_CONTAINER_SIZE,
+                           SYNC_CONTAINER_SIZE):
+                raw = view[i:i+SYNC_CONTAINER_SIZE]
+                container = GLMSyncContainerView(raw)
+                if store.contains(serialNumber, container):
+                    known = True
+                else:
+                    new.append((container, raw))
+            first = payload[1]+1
+    store.add(serialNumber, new)
+    if clear and new:
+        if not all(store.contains(serialNumber, c) for c, raw in new):
+            raise RuntimeError('Measurements missing from store after sync')
+        for first, last in indexRuns(sorted(
+                c.measurementListIndex for c, raw in new)):
+            yield from glm.clearMeasurements(first, last)
+    return [c for c, raw in new]
+
+
+def indexRuns(indices):
+    """
+    Group sorted indices into inclusive (first, last) runs of consecutive
+    values.
+    """
+    runs = []
+    for i in indices:
+        if runs and i <= runs[-1][1] + 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return [tuple(run) for run in runs]
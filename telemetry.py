@@ -0,0 +1,297 @@
+import time
+import asyncio
+import collections
+from collections import namedtuple
+
+from log import log
+
+"""
+Device telemetry.  Battery charge and temperature are harvested from the
+GLMSyncContainers a device sends anyway -- pushed measurements and control()
+responses -- so collecting them costs no airtime; RSSI, which the device does
+not report, is read from the link on a schedule.  Records fetched from the
+measurement list by getMeasurements or sync are not observed: they describe
+the device as it was when each measurement was taken, not as it is now.
+The temperature the device reports is unsigned, in degrees Celsius.
+
+Each series is kept in fixed-size ring buffers at several resolutions, raw
+points and then minute and hour aggregates, so memory stays bounded however
+long a server runs.  Thresholds raise alerts as a value crosses them.
+"""
+
+BATTERY, TEMPERATURE, RSSI = 'battery', 'temperature', 'rssi'
+
+RESOLUTIONS = (60., 3600.)  # seconds per aggregate
+
+
+class Point(namedtuple('Point', 'time, value')):
+    pass
+
+
+class Bucket(namedtuple('Bucket', 'time, count, min, max, mean')):
+    """
+    Aggregate of the values recorded from time for one resolution.
+    """
+    pass
+
+
+class Alert(namedtuple('Alert', 'time, deviceId, metric, value, threshold')):
+    pass
+
+
+class Ring:
+    """
+    A sequence of at most capacity items; appending to a full ring overwrites
+    the oldest.  Iterates oldest first.
+    """
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, len(self.slots))
+
+    def __iter__(self):
+        capacity = len(self.slots)
+        for i in range(max(self.count - capacity, 0), self.count):
+            yield self.slots[i % capacity]
+
+    def append(self, item):
+        self.slots[self.count % len(self.slots)] = item
+        self.count += 1
+
+    def last(self):
+        return self.slots[(self.count - 1) % len(self.slots)] \
+            if self.count else None
+
+
+class Level:
+    """
+    Aggregates of one resolution: a ring of closed Buckets and the one
+    being filled, as [start, count, min, max, sum].
+    """
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.buckets = Ring(capacity)
+        self.open = None
+
+    def add(self, t, value):
+        start = t - t % self.resolution
+        bucket = self.open
+        if bucket is not None and bucket[0] == start:
+            bucket[1] += 1
+            if value < bucket[2]:
+                bucket[2] = value
+            if value > bucket[3]:
+                bucket[3] = value
+            bucket[4] += value
+            return
+        if bucket is not None:
+            self.buckets.append(self.close(bucket))
+        self.open = [start, 1, value, value, value]
+
+    @staticmethod
+    def close(bucket):
+        start, count, low, high, total = bucket
+        return Bucket(start, count, low, high, total / count)
+
+    def __iter__(self):
+        yield from self.buckets
+        if self.open is not None:
+            yield self.close(self.open)
+
+
+class Series:
+    """
+    A time series in fixed memory: the last capacity raw Points, and the last
+    capacity Buckets of each resolution.  A raw point is kept only when the
+    value changes or interval seconds have passed, so a fast stream of equal
+    readings does not flush the history, but every value counts towards the
+    aggregates.
+    """
+    def __init__(self, capacity=256, resolutions=RESOLUTIONS, interval=1.):
+        self.raw = Ring(capacity)
+        self.levels = collections.OrderedDict(
+                (resolution, Level(resolution, capacity))
+                for resolution in resolutions)
+        self.interval = interval
+
+    def add(self, t, value):
+        last = self.raw.last()
+        if last is None or last.value != value or \
+                t - last.time >= self.interval:
+            self.raw.append(Point(t, value))
+        for level in self.levels.values():
+            level.add(t, value)
+
+    def latest(self):
+        return self.raw.last()
+
+    def query(self, since=None, until=None, resolution=None):
+        """
+        Return the raw Points, or the Buckets of the given resolution, from
+        since up to until.
+        """
+        items = self.raw if resolution is None else self.levels[resolution]
+        return [item for item in items
+                if (since is None or item.time >= since) and
+                (until is None or item.time <= until)]
+
+
+class Threshold:
+    """
+    Alert when metric falls below below or rises above above.  The alert
+    fires once as the value crosses the threshold, and is re-armed when the
+    value comes back by more than hysteresis.
+    """
+    def __init__(self, metric, below=None, above=None, hysteresis=0.):
+        self.metric = metric
+        self.below = below
+        self.above = above
+        self.hysteresis = hysteresis
+
+    def breached(self, value, active):
+        margin = self.hysteresis if active else 0.
+        return (self.below is not None and value < self.below + margin) or \
+            (self.above is not None and value > self.above - margin)
+
+    def __repr__(self):
+        limits = []
+        if self.below is not None:
+            limits.append('< %g' % self.below)
+        if self.above is not None:
+            limits.append('> %g' % self.above)
+        return '%s %s' % (self.metric, ' or '.join(limits))
+
+
+class DeviceTelemetry:
+    """
+    The series of one device.  A PeripheralController with one attached
+    (see Telemetry.attach) passes every GLMSyncContainer it sees to
+    observe().
+    """
+    def __init__(self, telemetry, deviceId):
+        self.telemetry = telemetry
+        self.deviceId = deviceId
+        self.series = {}  # metric -> Series
+        self.active = set()  # Thresholds currently breached
+
+    def observe(self, container):
+        t = self.telemetry.clock()
+        self.record(BATTERY, container.stateOfCharge, t)
+        self.record(TEMPERATURE, container.temperature, t)
+
+    def record(self, metric, value, t=None):
+        telemetry = self.telemetry
+        if t is None:
+            t = telemetry.clock()
+        series = self.series.get(metric)
+        if series is None:
+            series = self.series[metric] = Series(
+                    telemetry.capacity, telemetry.resolutions,
+                    telemetry.interval)
+        series.add(t, value)
+        for threshold in telemetry.thresholds:
+            if threshold.metric != metric:
+                continue
+            active = threshold in self.active
+            if threshold.breached(value, active):
+                if not active:
+                    self.active.add(threshold)
+                    telemetry.raiseAlert(Alert(t, self.deviceId, metric,
+                                               value, threshold))
+            elif active:
+                self.active.discard(threshold)
+
+
+class Telemetry:
+    """
+    Telemetry for any number of devices, by deviceId.  attach() a controller
+    to harvest battery and temperature from its traffic, and watch() it to
+    also poll RSSI every rssiInterval seconds.  warn() adds a Threshold;
+    alerts are logged, kept in alerts, and passed to onAlert if given.
+    Query with series(), query() and latest().  Loop thread only.
+    """
+    def __init__(self, capacity=256, resolutions=RESOLUTIONS, interval=1.,
+                 rssiInterval=30., onAlert=None, clock=time.time):
+        self.capacity = capacity
+        self.resolutions = resolutions
+        self.interval = interval
+        self.rssiInterval = rssiInterval
+        self.onAlert = onAlert
+        self.clock = clock
+        # deviceId -> DeviceTelemetry
+        self.devices = collections.OrderedDict()
+        self.thresholds = []
+        self.alerts = collections.deque(maxlen=capacity)
+
+    def device(self, deviceId):
+        device = self.devices.get(deviceId)
+        if device is None:
+            device = self.devices[deviceId] = DeviceTelemetry(self, deviceId)
+        return device
+
+    def attach(self, glm, deviceId):
+        glm.telemetry = self.device(deviceId)
+        return glm.telemetry
+
+    def watch(self, glm, deviceId):
+        """
+        Attach glm and poll its RSSI until it disconnects.  Returns the
+        polling task.
+        """
+        self.attach(glm, deviceId)
+        return asyncio.get_event_loop().create_task(
+                self.pollRSSI(glm, deviceId))
+
+    @asyncio.coroutine
+    def pollRSSI(self, glm, deviceId):
+        device = self.device(deviceId)
+        while not glm.disconnected:
+            try:
+                rssi = yield from glm.readRSSI()
+            except Exception as e:
+                log(1, 'RSSI of %s unavailable: %s' % (deviceId, e))
+                return
+            if rssi is None:
+                return  # the transport cannot measure it
+            device.record(RSSI, rssi)
+            yield from asyncio.sleep(self.rssiInterval)
+
+    def warn(self, metric, below=None, above=None, hysteresis=0.):
+        threshold = Threshold(metric, below, above, hysteresis)
+        self.thresholds.append(threshold)
+        return threshold
+
+    def raiseAlert(self, alert):
+        log(0, 'Warning: %s %s = %g (%r)' % (alert.deviceId, alert.metric,
+                                             alert.value, alert.threshold))
+        self.alerts.append(alert)
+        if self.onAlert is not None:
+            self.onAlert(alert)
+
+    def record(self, deviceId, metric, value, t=None):
+        self.device(deviceId).record(metric, value, t)
+
+    def series(self, deviceId, metric):
+        device = self.devices.get(deviceId)
+        return None if device is None else device.series.get(metric)
+
+    def query(self, deviceId, metric, since=None, until=None,
+              resolution=None):
+        """
+        Return the Points (resolution None) or Buckets of one device's
+        metric from since up to until.
+        """
+        series = self.series(deviceId, metric)
+        return [] if series is None else \
+            series.query(since, until, resolution)
+
+    def latest(self):
+        """
+        Return {deviceId: {metric: Point}} of the latest values.
+        """
+        return collections.OrderedDict(
+            (deviceId, {metric: series.latest()
+                        for metric, series in device.series.items()})
+            for deviceId, device in self.devices.items())
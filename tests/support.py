@@ -0,0 +1,37 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import async
+
+
+class LoopTestCase(unittest.TestCase):
+    """
+    Runs each test on a fresh event loop, installed as the default loop of
+    both asyncio and async, with logging off.  wait() runs a coroutine on
+    it to completion, failing the test if that takes longer than timeout
+    seconds.
+    """
+    timeout = 10.
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        async.set_default_loop(self.loop)
+        quiet = mock.patch('log.LOG_LEVEL', -1)
+        quiet.start()
+        self.addCleanup(quiet.stop)
+        # after the test's own cleanups, which may still need the loop
+        self.addCleanup(self.closeLoop)
+
+    def closeLoop(self):
+        self.sleep(0)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def wait(self, coro, timeout=None):
+        return self.loop.run_until_complete(asyncio.wait_for(
+            coro, timeout or self.timeout, loop=self.loop))
+
+    def sleep(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds, loop=self.loop))
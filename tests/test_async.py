@@ -0,0 +1,110 @@
+import threading
+
+from async import BoundedFutureStream, Overflow, StreamClosed, \
+    StreamOverflowError
+from tests.support import LoopTestCase
+
+
+class BoundedFutureStreamTest(LoopTestCase):
+    def claimAll(self, stream):
+        results = []
+        while stream.late:
+            results.append(self.wait(stream.claim()))
+        return results
+
+    def producer(self, stream, items):
+        """
+        Post items to stream from another thread; returns the thread and the
+        list of what post() raised, if anything.
+        """
+        errors = []
+
+        def run():
+            try:
+                for item in items:
+                    stream.post(item)
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 1.)
+        return thread, errors
+
+    def test_early_claims(self):
+        stream = BoundedFutureStream(2)
+        claims = [stream.claim() for i in range(3)]
+        for i in range(3):
+            stream.post(i)
+        self.sleep(0)
+        self.assertEqual([f.result() for f in claims], [0, 1, 2])
+        self.assertEqual((stream.depth, stream.dropped), (0, 0))
+
+    def test_block_on_loop_thread(self):
+        stream = BoundedFutureStream(2)
+        stream.post(0)
+        stream.post(1)
+        with self.assertRaises(StreamOverflowError):
+            stream.post(2)
+        self.sleep(0)
+        self.assertEqual((stream.depth, stream.dropped), (2, 1))
+        self.assertEqual(self.wait(stream.claim()), 0)
+        self.assertEqual(stream.depth, 1)
+        stream.post(3)
+        self.sleep(0)
+        self.assertEqual(self.claimAll(stream), [1, 3])
+        self.assertEqual(stream.depth, 0)
+
+    def test_block(self):
+        stream = BoundedFutureStream(2)
+        thread, errors = self.producer(stream, range(5))
+        self.sleep(.05)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(stream.depth, 2)
+        results = [self.wait(stream.claim()) for i in range(5)]
+        thread.join(1.)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results, list(range(5)))
+        self.assertEqual((stream.depth, stream.dropped, errors), (0, 0, []))
+
+    def test_end_releases_producer(self):
+        stream = BoundedFutureStream(1)
+        thread, errors = self.producer(stream, range(2))
+        self.sleep(.05)
+        self.assertTrue(thread.is_alive())
+        stream.end()
+        thread.join(1.)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([type(e) for e in errors], [StreamClosed])
+        self.sleep(0)
+        self.assertEqual(self.wait(stream.claim()), 0)
+        with self.assertRaises(StreamClosed):
+            self.wait(stream.claim())
+
+    def test_drop_oldest(self):
+        stream = BoundedFutureStream(3, Overflow.DROP_OLDEST)
+        for i in range(10):
+            stream.post(i)
+        self.sleep(0)
+        self.assertEqual((stream.depth, stream.dropped), (3, 7))
+        self.assertEqual(self.claimAll(stream), [7, 8, 9])
+        self.assertEqual(stream.depth, 0)
+
+    def test_drop_oldest_from_thread(self):
+        stream = BoundedFutureStream(3, Overflow.DROP_OLDEST)
+        thread, errors = self.producer(stream, range(10))
+        thread.join(1.)
+        self.assertFalse(thread.is_alive())
+        self.sleep(0)
+        self.assertEqual((stream.dropped, errors), (7, []))
+        self.assertEqual(self.claimAll(stream), [7, 8, 9])
+
+    def test_error(self):
+        stream = BoundedFutureStream(2, Overflow.ERROR)
+        thread, errors = self.producer(stream, range(3))
+        thread.join(1.)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([type(e) for e in errors], [StreamOverflowError])
+        self.sleep(0)
+        self.assertEqual((stream.depth, stream.dropped), (2, 1))
+        self.assertEqual(self.claimAll(stream), [0, 1])
+        self.assertEqual(stream.depth, 0)
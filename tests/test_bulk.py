@@ -0,0 +1,72 @@
+import unittest
+
+try:
+    import numpy as np
+except ImportError:  # bulk is optional
+    np = None
+
+from protocol import GLMSyncContainer
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport
+from tests.support import LoopTestCase
+
+if np is not None:
+    from bulk import MeasurementTable, decodeSyncContainers
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class MeasurementTableTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(measurements=50, seed=0)
+        glm = PeripheralController(SimulatedTransport(self.device))
+        self.addCleanup(glm.transport.close)
+        self.data = self.wait(glm.fetchMeasurements(0, 49))
+        self.table = MeasurementTable.fromBytes(self.data, device=7)
+
+    def test_decode(self):
+        self.assertEqual(decodeSyncContainers(self.data, namedtuples=True),
+                         self.device.memory)
+
+    def test_index(self):
+        table, memory = self.table, self.device.memory
+        self.assertEqual(len(table), 50)
+        for i in (0, 1, 25, 49, -1, -50):
+            self.assertEqual(table[i], memory[i])
+            self.assertIsInstance(table[i], GLMSyncContainer)
+        self.assertEqual(table[np.int64(3)], memory[3])
+        for i in (50, -51):
+            with self.assertRaises(IndexError):
+                table[i]
+
+    def test_select(self):
+        table, memory = self.table, self.device.memory
+        self.assertEqual(list(table[10:20]), memory[10:20])
+        self.assertEqual(list(table[[3, 1, 4]]),
+                         [memory[3], memory[1], memory[4]])
+        mask = table.column('result') > 50.
+        self.assertEqual(list(table[mask]),
+                         [c for c in memory if c.result > 50.])
+        table.appendBytes(self.data, device=2**20)
+        self.assertEqual(len(table.select(device=2**20)), 50)
+        self.assertEqual(list(table.select(device=7)), memory)
+
+    def test_iteration(self):
+        table = self.table
+        table.CHUNK = 7
+        self.assertEqual(list(table), self.device.memory)
+        self.assertEqual(table.toNamedTuples(), self.device.memory)
+
+    def test_growth(self):
+        table = MeasurementTable(capacity=4)
+        for container in self.device.memory:
+            table.append(container, device=1)
+        self.assertEqual(list(table), self.device.memory)
+        self.assertGreaterEqual(table.capacity, 50)
+
+    def test_columns(self):
+        self.assertEqual(self.table.column('device').dtype, np.dtype('<i4'))
+        column = self.table.column('timestamp')
+        self.assertEqual(len(column), 50)
+        with self.assertRaises(ValueError):
+            column[0] = 0
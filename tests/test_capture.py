@@ -0,0 +1,104 @@
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import capture
+from capture import Capture, CaptureRecord, ReplayTransport, RX, TX
+from protocol import Command
+from framing import RESPONSE
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport
+from tests.support import LoopTestCase
+
+
+class CaptureTest(unittest.TestCase):
+    def test_ring(self):
+        ring = Capture(capacity=8, clock=iter(range(100)).__next__)
+        for i in range(20):
+            ring.record(i % 2, bytes([i]))
+        self.assertEqual(len(ring), 8)
+        self.assertEqual(ring.records(), [
+            CaptureRecord(i, i % 2, bytes([i])) for i in range(12, 20)])
+        ring.clear()
+        self.assertEqual(ring.records(), [])
+
+    def test_file_round_trip(self):
+        records = [CaptureRecord(1.5, RX, b'\x00' + bytes(range(19))),
+                   CaptureRecord(2.25, TX, bytes(512)),  # large MTU
+                   CaptureRecord(3., RX, b'\xff\x10\x00')]
+        self.assertEqual(capture.loads(capture.dumps(records)), records)
+        ring = Capture()
+        for record in records:
+            ring.record(record.direction, record.fragment)
+        out = io.BytesIO()
+        ring.dump(out)
+        loaded = capture.load(io.BytesIO(out.getvalue()))
+        self.assertEqual([r[1:] for r in loaded], [r[1:] for r in records])
+        fd, path = tempfile.mkstemp(suffix='.mtcap')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        ring.dump(path)
+        self.assertEqual(capture.load(path), loaded)
+
+    def test_version_1(self):
+        data = capture.MAGIC_V1 + \
+            capture.RECORD_HEADER_V1.pack(1., RX, 3) + b'abc'
+        self.assertEqual(capture.loads(data),
+                         [CaptureRecord(1., RX, b'abc')])
+        with self.assertRaises(ValueError):
+            capture.loads(b'garbage')
+        with self.assertRaises(struct.error):
+            capture.dumps([CaptureRecord(0., RX, bytes(70000))])
+
+
+class ControllerCaptureTest(LoopTestCase):
+    def connect(self, **kwargs):
+        self.device = SimulatedGLM(latency=.001, measurements=3, seed=0)
+        glm = PeripheralController(SimulatedTransport(self.device),
+                                   **kwargs)
+        self.addCleanup(glm.transport.close)
+        return glm
+
+    def test_default(self):
+        glm = self.connect()
+        self.wait(glm.readSettings())
+        directions = {r.direction for r in glm.capture.records()}
+        self.assertEqual(directions, {RX, TX})
+        self.assertIsNone(self.connect(capture=False).capture)
+        # an empty capture is falsy, but is still the one to record in
+        ring = capture.Capture(16)
+        self.assertIs(self.connect(capture=ring).capture, ring)
+
+    def test_replay(self):
+        glm = self.connect()
+        self.wait(glm.readSettings())
+        self.wait(glm.getMeasurements(0, 2))
+        records = capture.loads(capture.dumps(glm.capture.records()))
+        frames = [frame for record, frame in capture.replay(records)]
+        self.assertTrue(all(f.frameType == RESPONSE for f in frames))
+        self.assertIn(self.device.settings.toBytes(),
+                      [f.payload for f in frames])
+        transcript = [(command, message) for record, command, message
+                      in capture.transcript(records)]
+        self.assertIn((Command.ReadSettings, self.device.settings),
+                      transcript)
+        self.assertIn((Command.PayloadSize, self.device.payloadSize),
+                      transcript)
+
+    def test_replay_transport(self):
+        glm = self.connect()
+        self.wait(glm.turnOnAutoSync())
+        pushed = [self.device.press() for i in range(3)]
+        self.sleep(.05)
+        replayed = PeripheralController(ReplayTransport(
+            glm.capture.records(), loop=self.loop), capture=False,
+            negotiate=False)
+        subscription = replayed.measurements()
+        self.wait(replayed.transport.done)
+        received = []
+        while len(received) < 3:
+            received.append(self.wait(subscription.claim()))
+        self.assertEqual([tuple(c) for c in received],
+                         [tuple(c) for c in pushed])
@@ -0,0 +1,56 @@
+from protocol import Command, StatusError, DistanceUnit
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport, MODE_INVALID
+from tests.support import LoopTestCase
+
+
+class ContinuousTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(latency=.001, seed=0)
+        self.glm = PeripheralController(SimulatedTransport(self.device))
+        self.addCleanup(self.glm.transport.close)
+
+    def failing(self, count):
+        """
+        Make the next count measurements fail.
+        """
+        control = self.device.handlers[Command.Control]
+        failures = [count]
+
+        def handler(request):
+            if failures[0]:
+                failures[0] -= 1
+                return MODE_INVALID, b''
+            return control(request)
+        self.device.handlers[Command.Control] = handler
+
+    def test_samples(self):
+        self.device.settings = self.device.settings._replace(
+                measurementUnit=DistanceUnit.Imperial)
+        stream = self.glm.sample(depth=2)
+        samples = [self.wait(stream.claim()) for i in range(5)]
+        # a trigger may still be in flight
+        self.assertGreaterEqual(len(self.device.memory), stream.samples)
+        self.assertGreaterEqual(stream.samples, 5)
+        self.assertTrue(all(s.container.distanceUnit == 0 for s in samples))
+        self.wait(stream.stop())
+        # the settings are put back
+        self.assertEqual(self.device.settings.measurementUnit,
+                         DistanceUnit.Imperial)
+
+    def test_max_failures(self):
+        self.failing(3)
+        stream = self.glm.sample(depth=1, maxFailures=3)
+        with self.assertRaises(StatusError):
+            self.wait(stream.claim())
+        self.assertEqual(stream.failures, 3)
+        self.assertEqual(stream.samples, 0)
+
+    def test_fewer_failures(self):
+        self.failing(2)
+        stream = self.glm.sample(depth=1, maxFailures=3)
+        sample = self.wait(stream.claim())
+        self.assertEqual(sample.container.measurementListIndex, 0)
+        self.assertEqual(stream.failures, 2)
+        self.wait(stream.stop())
@@ -0,0 +1,385 @@
+import asyncio
+import unittest
+
+from protocol import Command, DistanceUnit, ResponseMismatchError, \
+    StatusError, responseFits
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport
+from tests.support import LoopTestCase
+
+
+class ResponseFitsTest(unittest.TestCase):
+    def test_fits(self):
+        self.assertTrue(responseFits(Command.WriteSettings, b''))
+        self.assertFalse(responseFits(Command.WriteSettings, b'\x01'))
+        self.assertTrue(responseFits(Command.DeviceInfoString, b'GLM'))
+        self.assertFalse(responseFits(Command.ReadSettings, b'\x01\x02'))
+
+
+class CorrelationTest(LoopTestCase):
+    def connect(self, device, **kwargs):
+        glm = PeripheralController(SimulatedTransport(device), **kwargs)
+        self.wait(glm.waitUntilReady())
+        self.addCleanup(glm.transport.close)
+        return glm
+
+    def test_pipelined(self):
+        device = SimulatedGLM(latency=.005, seed=0)
+        glm = self.connect(device)
+        settings, info, name = self.wait(asyncio.gather(
+            glm.readSettings(fresh=True), glm.deviceInfo(fresh=True),
+            glm.deviceInfoString(), loop=self.loop))
+        self.assertEqual(settings, device.settings)
+        self.assertEqual(info, device.deviceInfo)
+        self.assertEqual(name, device.deviceInfoString)
+
+    def test_late_response(self):
+        device = SimulatedGLM(latency=.03, seed=0)
+        glm = self.connect(device, retries=0)
+        glm.timeout = .04  # less than a round trip
+        with self.assertRaises(asyncio.TimeoutError):
+            self.wait(glm.readSettings(fresh=True))
+        self.assertEqual(glm.late_responses, 1)
+        glm.timeout = 1.
+        # the settings that were too late must not answer this request
+        self.wait(glm.writeSettings(laserPointerEnabled=True))
+        self.assertEqual(glm.late_responses, 0)
+        self.assertTrue(device.settings.laserPointerEnabled)
+        status, payload = self.wait(glm.read())
+        self.assertEqual((status, payload[:4]), (0, b'\x01\x01\x01\x00'))
+        settings = self.wait(glm.readSettings(fresh=True))
+        self.assertTrue(settings.laserPointerEnabled)
+
+    def test_late_response_to_retry(self):
+        device = SimulatedGLM(latency=.02, seed=0)
+        glm = self.connect(device, retries=1, retryBackoff=0.)
+        glm.timeout = .03
+        # the retry takes the first attempt's late answer
+        self.assertEqual(self.wait(glm.deviceInfo(fresh=True)),
+                         device.deviceInfo)
+        glm.timeout = 1.
+        # so the retry's own answer is late for the next request
+        clock = self.wait(glm.deviceRealTimeClock())
+        self.assertAlmostEqual(clock.clockSeconds, device.clock(), delta=1)
+        self.assertEqual(glm.late_responses, 0)
+
+    def test_wrong_length(self):
+        device = SimulatedGLM(latency=.001, seed=0)
+        device.handlers[Command.ReadSettings] = lambda request: (0, b'\x01')
+        glm = self.connect(device, retries=0)
+        start = self.loop.time()
+        with self.assertRaises(ResponseMismatchError):
+            self.wait(glm.readSettings(fresh=True))
+        # failed as soon as the reply came, not at the timeout
+        self.assertLess(self.loop.time() - start, glm.timeout / 2)
+        self.assertEqual(self.wait(glm.deviceInfo()), device.deviceInfo)
+
+    def test_error_status(self):
+        device = SimulatedGLM(latency=.001, seed=0)
+        device.handlers[Command.ReadSettings] = lambda request: (2, b'')
+        glm = self.connect(device, retries=0)
+        with self.assertRaises(StatusError):
+            self.wait(glm.readSettings(fresh=True))
+
+
+class RetryTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(latency=.01, seed=0)
+        self.dropping = []
+        send = self.device.send
+
+        def send_unless_dropped(fragments):
+            if self.dropping:
+                self.dropping.pop()
+                return
+            send(fragments)
+        self.device.send = send_unless_dropped
+
+    def connect(self, **kwargs):
+        glm = PeripheralController(SimulatedTransport(self.device), **kwargs)
+        self.wait(glm.waitUntilReady())
+        self.addCleanup(glm.transport.close)
+        return glm
+
+    def dropResponse(self, command):
+        """
+        Lose the response to the first request for command, and count the
+        requests the device handles.
+        """
+        handler = self.device.handlers[command]
+        requests = []
+
+        def handle(request):
+            requests.append(request)
+            if len(requests) == 1:
+                self.dropping.append(command)
+            return handler(request)
+        self.device.handlers[command] = handle
+        return requests
+
+    def test_idempotent(self):
+        glm = self.connect(timeout=.1, retries=1, retryBackoff=0.)
+        requests = self.dropResponse(Command.ReadSettings)
+        self.assertEqual(self.wait(glm.readSettings(fresh=True)),
+                         self.device.settings)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(glm.request_retries, 1)
+
+    def test_not_idempotent(self):
+        glm = self.connect(timeout=.1, retries=2, retryBackoff=0.)
+        requests = self.dropResponse(Command.WriteSettings)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.wait(glm.writeSettings(laserPointerEnabled=True))
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(glm.request_retries, 0)
+        self.assertTrue(self.device.settings.laserPointerEnabled)
+
+    def test_timed_out(self):
+        glm = self.connect(timeout=.015, retries=0)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.wait(glm.readSettings(fresh=True))
+        glm.timeout = 1.
+        # accepts any payload, so would take the settings if let
+        self.assertEqual(self.wait(glm.deviceInfoString()),
+                         self.device.deviceInfoString)
+        self.assertEqual(glm.late_responses, 0)
+
+    def test_cancelled(self):
+        glm = self.connect(timeout=1., retries=0)
+        task = asyncio.ensure_future(glm.readSettings(fresh=True))
+        self.sleep(.005)
+        task.cancel()
+        self.assertEqual(self.wait(glm.deviceInfoString()),
+                         self.device.deviceInfoString)
+        self.assertTrue(task.cancelled())
+        self.assertFalse(glm.in_flight)
+
+
+class CacheTest(LoopTestCase):
+    def connect(self, **kwargs):
+        self.device = SimulatedGLM(latency=.001, seed=0)
+        glm = PeripheralController(SimulatedTransport(self.device), **kwargs)
+        self.wait(glm.waitUntilReady())
+        self.addCleanup(glm.transport.close)
+        return glm
+
+    def age(self, glm, command, seconds):
+        value, fetched = glm.cache[command]
+        glm.cache[command] = (value, fetched - seconds)
+
+    def test_cached(self):
+        glm = self.connect()
+        info = self.wait(glm.deviceInfo())
+        requests = self.device.requests
+        self.assertEqual(self.wait(glm.deviceInfo()), info)
+        self.assertEqual(self.device.requests, requests)
+        self.age(glm, Command.DeviceInfo, 3600)
+        self.wait(glm.deviceInfo())
+        self.assertEqual(self.device.requests, requests)
+        self.wait(glm.deviceInfo(fresh=True))
+        self.assertEqual(self.device.requests, requests + 1)
+
+    def test_ttl(self):
+        glm = self.connect(cacheTTL=5.)
+        self.wait(glm.readSettings())
+        requests = self.device.requests
+        self.age(glm, Command.ReadSettings, 4)
+        self.wait(glm.readSettings())
+        self.assertEqual(self.device.requests, requests)
+        self.age(glm, Command.ReadSettings, 2)
+        self.device.settings = self.device.settings._replace(
+                speakerEnabled=False)
+        self.assertFalse(self.wait(glm.readSettings()).speakerEnabled)
+        self.assertEqual(self.device.requests, requests + 1)
+
+    def test_write_settings(self):
+        glm = self.connect()
+        self.wait(glm.writeSettings(backlightMode=2))
+        requests = self.device.requests
+        # the settings written are cached
+        self.assertEqual(self.wait(glm.readSettings()), self.device.settings)
+        self.assertEqual(self.device.requests, requests)
+
+    def test_invalidate(self):
+        glm = self.connect()
+        self.wait(glm.readSettings())
+        self.wait(glm.deviceInfo())
+        glm.invalidate(Command.ReadSettings)
+        self.assertNotIn(Command.ReadSettings, glm.cache)
+        self.assertIn(Command.DeviceInfo, glm.cache)
+        glm.invalidate()
+        self.assertEqual(glm.cache, {})
+
+    def test_unit_change(self):
+        glm = self.connect()
+        self.wait(glm.readSettings())
+        self.device.autoSync = True
+        # the unit is changed on the device itself
+        self.device.settings = self.device.settings._replace(
+                measurementUnit=DistanceUnit.Imperial)
+        self.device.press()
+        self.sleep(.02)
+        self.assertNotIn(Command.ReadSettings, glm.cache)
+        self.assertEqual(self.wait(glm.readSettings()).measurementUnit,
+                         DistanceUnit.Imperial)
+
+    def test_disconnect(self):
+        glm = self.connect()
+        self.wait(glm.readSettings())
+        glm.didDisconnect('gone')
+        self.assertEqual(glm.cache, {})
+
+
+class SubscriptionTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(latency=.001, seed=0)
+        self.glm = PeripheralController(SimulatedTransport(self.device))
+        self.addCleanup(self.glm.transport.close)
+        self.wait(self.glm.turnOnAutoSync())
+
+    def press(self, times=1):
+        containers = [self.device.press() for i in range(times)]
+        self.sleep(.02)
+        return containers
+
+    def claimAll(self, subscription):
+        containers = []
+        while subscription.depth:
+            containers.append(self.wait(subscription.claim()))
+        return containers
+
+    def indices(self, containers):
+        return [c.measurementListIndex for c in containers]
+
+    def test_subscribers(self):
+        first = self.glm.measurements()
+        second = self.glm.measurements()
+        pressed = self.press(2)
+        self.assertEqual(self.indices(self.claimAll(first)),
+                         self.indices(pressed))
+        self.assertEqual(self.indices(self.claimAll(second)),
+                         self.indices(pressed))
+
+    def test_measurement_types(self):
+        distances = self.glm.measurements(measurementTypes={1})
+        areas = self.glm.measurements(measurementTypes=[4, 5])
+        self.press(2)
+        self.assertEqual(distances.depth, 2)
+        self.assertEqual(areas.depth, 0)
+
+    def test_overflow(self):
+        subscription = self.glm.measurements(maxsize=2)
+        pressed = self.press(5)
+        self.assertEqual(subscription.dropped, 3)
+        self.assertEqual(self.indices(self.claimAll(subscription)),
+                         self.indices(pressed[-2:]))
+
+    def test_unsubscribe(self):
+        with self.glm.measurements() as subscription:
+            self.press()
+        self.assertEqual(self.glm.subscribers, set())
+        # what was pushed before is still read, then the stream ends
+        self.assertEqual(len(self.claimAll(subscription)), 1)
+        with self.assertRaises(StopAsyncIteration):
+            self.wait(subscription.__anext__())
+        self.press()
+        self.assertEqual(subscription.depth, 0)
+
+    def test_disconnect(self):
+        subscription = self.glm.measurements()
+        self.glm.didDisconnect('gone')
+        self.assertEqual(self.glm.subscribers, set())
+        with self.assertRaises(Exception) as cm:
+            self.wait(subscription.claim())
+        self.assertEqual(str(cm.exception), 'gone')
+
+
+class TransmitWindowTest(LoopTestCase):
+    def test_lost_fragment(self):
+        device = SimulatedGLM(latency=.002, seed=0)
+        glm = PeripheralController(SimulatedTransport(device), timeout=.1,
+                                   retries=0)
+        self.addCleanup(glm.transport.close)
+        self.wait(glm.setTransmitMode(window=1))
+        written = device.written
+        lost = []
+
+        def written_once(fragment, completion):
+            if not lost:
+                lost.append(fragment)
+                if completion is not None:
+                    self.loop.call_soon(completion, None)
+                return
+            written(fragment, completion)
+        device.written = written_once
+        with self.assertRaises(asyncio.TimeoutError):
+            self.wait(glm.readSettings(fresh=True))
+        self.assertEqual(len(lost), 1)
+        self.assertEqual(glm.tx_fallbacks, 1)
+        self.assertIsNone(glm.tx_window.size)
+        self.assertEqual(self.wait(glm.deviceInfo(fresh=True)),
+                         device.deviceInfo)
+        self.assertEqual(glm.deferred_writes.qsize(), 0)
+
+
+class PayloadSizeTest(LoopTestCase):
+    def connect(self, device, **kwargs):
+        glm = PeripheralController(SimulatedTransport(device), **kwargs)
+        self.addCleanup(glm.transport.close)
+        self.wait(glm.waitUntilReady())
+        return glm
+
+    def countPages(self, device):
+        handler = device.handlers[Command.GetMeasurements]
+        pages = []
+        device.handlers[Command.GetMeasurements] = \
+            lambda request: pages.append(request) or handler(request)
+        return pages
+
+    def test_negotiated(self):
+        device = SimulatedGLM(latency=.001, mtu=64, rxPayloadSize=40,
+                              txPayloadSize=100, seed=0)
+        glm = self.connect(device)
+        self.assertEqual(glm.framer.fragmentSize, 19)
+        self.sleep(.02)
+        # without being asked to
+        self.assertEqual(glm.framer.fragmentSize, 40)
+        self.assertEqual(glm.page_capacity, 2)
+        self.assertEqual(self.wait(glm.deviceInfoString()),
+                         device.deviceInfoString)
+        glm = self.connect(device, negotiate=False)
+        self.sleep(.02)
+        self.assertEqual(glm.framer.fragmentSize, 19)
+        self.assertIsNone(glm.page_capacity)
+
+    def test_not_supported(self):
+        device = SimulatedGLM(latency=.001, mtu=64, measurements=10, seed=0)
+        del device.handlers[Command.PayloadSize]
+        glm = self.connect(device)
+        self.sleep(.02)
+        self.assertEqual(glm.framer.fragmentSize, 19)
+        self.assertEqual(glm.page_capacity, 0)
+        self.assertEqual(len(self.wait(glm.getMeasurements(0, 255))), 10)
+
+    def test_dense(self):
+        device = SimulatedGLM(latency=.001, measurements=50, seed=0)
+        glm = self.connect(device)
+        pages = self.countPages(device)
+        containers = self.wait(glm.getMeasurements(0, 255))
+        self.assertEqual([tuple(c) for c in containers], device.memory)
+        # 7 records a page: 8 pages, and one more to see there are no more
+        self.assertEqual(len(pages), 9)
+
+    def test_sparse(self):
+        device = SimulatedGLM(latency=.001, measurements=50, seed=0)
+        glm = self.connect(device)
+        self.wait(glm.clearMeasurements(3, 45))
+        pages = self.countPages(device)
+        containers = self.wait(glm.getMeasurements(0, 255))
+        self.assertEqual([c.measurementListIndex for c in containers],
+                         [0, 1, 2, 46, 47, 48, 49])
+        # a first pipelined round, then what is left in one request
+        self.assertEqual(len(pages), glm.max_in_flight + 1)
+        self.assertEqual(pages[-1], (28, 255))
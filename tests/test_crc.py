@@ -0,0 +1,47 @@
+import random
+import unittest
+
+from protocol import CRC8, crc8
+
+
+def crc8Bitwise(data, iv=0xaa, poly=0xa6):
+    value = iv
+    for b in data:
+        for i in range(8):
+            x, value = (value >> 7) ^ (b >> (7-i)) & 1, (value << 1) & 0xff
+            if x:
+                value ^= poly
+    return value
+
+
+class CRC8Test(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.samples = [bytes(rng.randrange(256) for i in range(length))
+                        for length in range(64)]
+
+    def test_matches_bitwise(self):
+        for data in self.samples:
+            self.assertEqual(crc8(data), crc8Bitwise(data))
+
+    def test_incremental(self):
+        for data in self.samples:
+            for size in (1, 7, 19):
+                crc = CRC8()
+                for i in range(0, len(data), size):
+                    crc.update(data[i:i+size])
+                self.assertEqual(crc.digest(), crc8(data))
+
+    def test_residue(self):
+        # a frame followed by its CRC checks to zero, as Reassembler expects
+        for data in self.samples:
+            crc = CRC8()
+            crc.update(data + bytes([crc8(data)]))
+            self.assertEqual(crc.value, 0)
+
+    def test_reset(self):
+        crc = CRC8()
+        crc.update(b'garbage')
+        crc.reset()
+        crc.update(b'frame')
+        self.assertEqual(crc.digest(), crc8(b'frame'))
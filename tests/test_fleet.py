@@ -0,0 +1,80 @@
+import asyncio
+
+from fleet import Fleet
+from simulator import SimulatedCentral
+from tests.support import LoopTestCase
+
+DEVICES = ['DEVICE-A', 'DEVICE-B']
+
+
+class FleetTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.central = SimulatedCentral(latency=.001, seed=0)
+        self.fleet = Fleet(self.central.deviceFromUUIDString, DEVICES)
+        self.fleet.start()
+        self.addCleanup(self.stop)
+        self.wait(self.connected())
+
+    def stop(self):
+        self.fleet.stop()
+        for handle in self.fleet:
+            if handle.glm is not None:
+                handle.glm.transport.close()
+        self.sleep(.01)
+
+    @asyncio.coroutine
+    def connected(self):
+        while len(self.fleet.connected()) < len(DEVICES):
+            yield from asyncio.sleep(.001, loop=self.loop)
+
+    def test_submit(self):
+        settings = self.wait(self.fleet.submit(
+            lambda glm: glm.readSettings(), 'DEVICE-B'))
+        self.assertEqual(settings,
+                         self.central.devices['DEVICE-B'].settings)
+        self.assertEqual(self.fleet['DEVICE-B'].completed, 1)
+        results = self.wait(self.fleet.broadcast(
+            lambda glm: glm.deviceInfo()))
+        self.assertEqual(list(results), DEVICES)
+
+    def test_failed_job(self):
+        @asyncio.coroutine
+        def job(glm):
+            raise ValueError('job failed')
+        with self.assertRaises(ValueError):
+            self.wait(self.fleet.submit(job, 'DEVICE-A'))
+        self.assertEqual(self.fleet['DEVICE-A'].failed, 1)
+
+    def test_stop(self):
+        started = asyncio.Event(loop=self.loop)
+
+        @asyncio.coroutine
+        def forever(glm):
+            started.set()
+            yield from asyncio.sleep(3600, loop=self.loop)
+        handle = self.fleet['DEVICE-A']
+        running = self.fleet.submit(forever, 'DEVICE-A')
+        queued = self.fleet.submit(forever, 'DEVICE-A')
+        self.wait(started.wait())
+        tasks = handle.tasks
+        self.fleet.stop()
+        self.sleep(.01)
+        self.assertTrue(running.cancelled())
+        self.assertTrue(queued.cancelled())
+        self.assertTrue(all(task.done() for task in tasks))
+        self.assertEqual((handle.failed, handle.completed), (0, 0))
+        self.assertEqual((handle.active, handle.queued), (0, 0))
+
+    def test_cancelled_job(self):
+        @asyncio.coroutine
+        def slow(glm):
+            yield from asyncio.sleep(.05, loop=self.loop)
+            return 'done'
+        handle = self.fleet['DEVICE-B']
+        future = self.fleet.submit(slow, 'DEVICE-B')
+        future.cancel()
+        # a cancelled job is skipped, and the device goes on to the next
+        self.assertEqual(self.wait(self.fleet.submit(slow, 'DEVICE-B')),
+                         'done')
+        self.assertEqual((handle.failed, handle.completed), (0, 1))
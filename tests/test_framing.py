@@ -0,0 +1,104 @@
+import random
+import unittest
+
+from protocol import CRCError, Command, GLMSyncContainer
+from framing import Framer, Reassembler, ack, ACK, REQUEST, RESPONSE, \
+                    MAX_FRAGMENTS
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport, CHECKSUM_ERROR
+from tests.support import LoopTestCase
+
+
+class FramingTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def payload(self, length):
+        return bytes(self.rng.randrange(256) for i in range(length))
+
+    def feed(self, reassembler, fragments):
+        frames = [reassembler.feed(fragment) for fragment in fragments]
+        self.assertEqual(frames[:-1], [None] * (len(fragments) - 1))
+        return frames[-1]
+
+    def test_round_trip(self):
+        reassembler = Reassembler()
+        for size in (19, 100, 243):
+            framer = Framer(size)
+            for length in (0, 1, 16, 17, 18, 100, 255):
+                payload = self.payload(length)
+                fragments = framer.request(Command.GetMeasurements, payload)
+                self.assertTrue(all(len(f) <= size + 1 for f in fragments))
+                frame = self.feed(reassembler, fragments)
+                self.assertEqual(frame, (REQUEST, 0,
+                                         Command.GetMeasurements, payload))
+                frame = self.feed(reassembler,
+                                  framer.response(6, payload))
+                self.assertEqual(frame, (RESPONSE, 6, None, payload))
+
+    def test_fragment_headers(self):
+        framer = Framer(seqno=14)
+        for seqno in (14, 0, 1):
+            fragments = framer.request(Command.Control, bytes(40))
+            self.assertEqual([f[0] for f in fragments],
+                             [seqno << 4 | i
+                              for i in reversed(range(len(fragments)))])
+
+    def test_corrupt_frame(self):
+        reassembler = Reassembler()
+        fragments = Framer().request(Command.ReadSettings, b'')
+        corrupt = bytearray(fragments[-1])
+        corrupt[-1] ^= 0x01
+        with self.assertRaises(CRCError):
+            self.feed(reassembler, fragments[:-1] + [bytes(corrupt)])
+        # and the next frame is unaffected
+        frame = self.feed(reassembler, fragments)
+        self.assertEqual(frame.command, Command.ReadSettings)
+
+    def test_interrupted_frame(self):
+        reassembler = Reassembler()
+        framer = Framer()
+        partial = framer.request(Command.Control, bytes(40))[:-1]
+        payload = self.payload(40)
+        fragments = framer.request(Command.Control, payload)
+        for fragment in partial:
+            self.assertIsNone(reassembler.feed(fragment))
+        self.assertEqual(self.feed(reassembler, fragments).payload, payload)
+
+    def test_frame_too_large(self):
+        with self.assertRaises(ValueError):
+            Framer(4).request(Command.Control, bytes(MAX_FRAGMENTS * 4))
+
+    def test_ack(self):
+        self.assertEqual(ack(0x31), bytes([ACK, 0x31, 0]))
+
+
+class SimulatedFramingTest(LoopTestCase):
+    def test_simulated_round_trip(self):
+        for mtu in (20, 60, 244):
+            device = SimulatedGLM(mtu=mtu, measurements=30, seed=mtu)
+            glm = PeripheralController(SimulatedTransport(device))
+            self.wait(glm.waitUntilReady())
+            info = self.wait(glm.deviceInfoString())
+            self.assertEqual(info, device.deviceInfoString)
+            containers = self.wait(glm.getMeasurements(0, 29))
+            self.assertEqual([GLMSyncContainer(*c) for c in containers],
+                             device.memory)
+            self.assertEqual(glm.framer.fragmentSize, mtu - 1)
+            self.assertEqual(device.crcErrors, 0)
+            glm.transport.close()
+            self.sleep(0)
+
+    def test_device_rejects_corrupt_frame(self):
+        device = SimulatedGLM(seed=0)
+        received = []
+        device.notify = received.append
+        fragments = Framer().request(Command.ReadSettings, b'')
+        corrupt = bytearray(fragments[-1])
+        corrupt[-1] ^= 0x80
+        device.write(bytes(corrupt))
+        self.sleep(.01)
+        reassembler = Reassembler()
+        frames = [reassembler.feed(f) for f in received if f[0] != ACK]
+        self.assertEqual(device.crcErrors, 1)
+        self.assertEqual(frames[-1], (RESPONSE, CHECKSUM_ERROR, None, b''))
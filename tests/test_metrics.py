@@ -0,0 +1,108 @@
+import re
+import unittest
+
+from protocol import Command, StatusError
+from controller import PeripheralController
+from metrics import Histogram, Metrics
+from simulator import SimulatedGLM, SimulatedTransport, MODE_INVALID
+from tests.support import LoopTestCase
+
+SAMPLE = re.compile(r'^(\w+)(\{[^}]*\})? (\S+)$')
+
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        h = Histogram(bounds=(1., 2., 4.))
+        for value in (.5, 1., 1.5, 3., 10.):
+            h.observe(value)
+        snapshot = h.snapshot()
+        # cumulative counts of observations <= each bound
+        self.assertEqual(snapshot.buckets, ((1., 2), (2., 3), (4., 4),
+                                            (float('inf'), 5)))
+        self.assertEqual((snapshot.count, snapshot.sum), (5, 16.))
+        self.assertEqual((snapshot.min, snapshot.max), (.5, 10.))
+        self.assertEqual(snapshot.mean, 3.2)
+
+    def test_quantile(self):
+        h = Histogram(bounds=(1., 2., 4.))
+        self.assertIsNone(h.snapshot().quantile(.5))
+        self.assertIsNone(h.snapshot().mean)
+        for value in (.5, .5, 1.5, 3.):
+            h.observe(value)
+        snapshot = h.snapshot()
+        self.assertEqual(snapshot.quantile(.5), 1.)
+        self.assertEqual(snapshot.quantile(.75), 2.)
+        # never above the largest observation
+        self.assertEqual(snapshot.quantile(1.), 3.)
+
+
+class MetricsTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(latency=.001, seed=0)
+        self.metrics = Metrics()
+        self.glm = PeripheralController(SimulatedTransport(self.device),
+                                        metrics=self.metrics, retries=0)
+        self.addCleanup(self.glm.transport.close)
+
+    def samples(self, text):
+        """
+        Parse the exposition into a dict of (name, labels) -> value,
+        checking each family is declared before its samples.
+        """
+        samples, types = {}, set()
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                name, kind = line.split()[2:]
+                self.assertIn(kind, ('counter', 'gauge', 'histogram'))
+                types.add(name)
+                continue
+            name, labels, value = SAMPLE.match(line).groups()
+            family = re.sub('_(bucket|sum|count)$', '', name)
+            self.assertTrue(name in types or family in types, line)
+            samples[name, labels or ''] = float(value)
+        return samples
+
+    def test_requests(self):
+        for i in range(3):
+            self.wait(self.glm.readSettings(fresh=True))
+        snapshot = self.metrics.snapshot()
+        latency = snapshot['latency'][Command.ReadSettings]
+        self.assertEqual(latency.count, 3)
+        self.assertGreaterEqual(snapshot['fragments']['tx'], 3)
+        self.assertGreaterEqual(snapshot['fragments']['rx'], 3)
+        self.assertEqual(snapshot['acks'], snapshot['fragments']['tx'])
+        self.assertEqual(snapshot['gauges']['in_flight'], 0)
+
+    def test_status_errors(self):
+        self.device.handlers[Command.ReadSettings] = \
+            lambda request: (MODE_INVALID, b'')
+        with self.assertRaises(StatusError):
+            self.wait(self.glm.readSettings(fresh=True))
+        self.assertEqual(self.metrics.snapshot()['status_errors'],
+                         {'ModeInvalid': 1})
+
+    def test_exposition(self):
+        self.wait(self.glm.readSettings(fresh=True))
+        self.wait(self.glm.deviceInfo(fresh=True))
+        samples = self.samples(self.metrics.exposition())
+        labels = '{command="0x%02x",le="+Inf"}' % Command.DeviceInfo
+        self.assertEqual(samples['glm_request_seconds_bucket', labels], 1)
+        labels = '{command="0x%02x"}' % Command.DeviceInfo
+        self.assertEqual(samples['glm_request_seconds_count', labels], 1)
+        self.assertEqual(samples['glm_fragments_total',
+                                 '{direction="tx"}'],
+                         self.metrics.fragments['tx'])
+        self.assertEqual(samples['glm_timeouts_total', ''], 0)
+        self.assertEqual(samples['glm_in_flight', ''], 0)
+        # buckets are cumulative
+        buckets = [value for (name, labels), value in sorted(samples.items())
+                   if name == 'glm_ack_rtt_seconds_bucket']
+        self.assertEqual(len(buckets), 25)
+        self.assertEqual(max(buckets), samples['glm_ack_rtt_seconds_count',
+                                               ''])
+
+    def test_prefix(self):
+        text = self.metrics.exposition(prefix='test')
+        self.assertTrue(all(name.startswith('test_')
+                            for name, labels in self.samples(text)))
@@ -0,0 +1,140 @@
+import asyncio
+import unittest
+
+from fleet import Fleet
+from reconnect import Backoff, Reconnector
+from simulator import SimulatedCentral
+from tests.support import LoopTestCase
+
+
+class FixedRandom:
+    def __init__(self, value):
+        self.value = value
+
+    def random(self):
+        return self.value
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.
+
+    def __call__(self):
+        return self.now
+
+
+class BackoffTest(unittest.TestCase):
+    def test_exponential(self):
+        backoff = Backoff(initial=.25, maximum=2., rng=FixedRandom(0.))
+        delays = [backoff.next() for i in range(7)]
+        self.assertEqual(delays, [0., .25, .5, 1., 2., 2., 2.])
+        backoff.reset()
+        self.assertEqual([backoff.next(), backoff.next()], [0., .25])
+
+    def test_jitter(self):
+        backoff = Backoff(initial=1., jitter=.5, rng=FixedRandom(1.))
+        self.assertEqual([backoff.next() for i in range(3)], [0., .5, 1.])
+        backoff = Backoff(initial=1., jitter=0., rng=FixedRandom(1.))
+        self.assertEqual([backoff.next() for i in range(3)], [0., 1., 2.])
+
+
+class ReconnectorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.reconnector = Reconnector(clock=self.clock, initial=1.,
+                                       jitter=0.)
+
+    def test_latency(self):
+        r = self.reconnector
+        self.assertEqual(r.lost('a'), 0.)
+        self.clock.now += 1.
+        self.assertEqual(r.lost('a', failed=True), 1.)
+        self.assertEqual(r.pending(), {'a'})
+        self.clock.now += 2.
+        r.connected('a')
+        self.assertEqual(r.pending(), set())
+        self.assertEqual(r.stats(), (1, 1, 1, 3., 3., 3.))
+        # the backoff starts over after a reconnection
+        self.assertEqual(r.lost('a'), 0.)
+        self.clock.now += 1.
+        r.connected('a')
+        self.assertEqual(r.stats(), (2, 2, 1, 1., 2., 3.))
+
+    def test_keys(self):
+        r = self.reconnector
+        r.lost('a')
+        r.lost('a')
+        # each device backs off on its own
+        self.assertEqual(r.lost('b'), 0.)
+        self.assertEqual(r.lost('a'), 2.)
+        r.forget('a')
+        self.assertEqual(r.pending(), {'b'})
+        self.assertEqual(r.lost('a'), 0.)
+        self.assertEqual(r.stats().reconnects, 0)
+        self.assertIsNone(r.stats().meanLatency)
+
+    def test_connected_without_loss(self):
+        r = self.reconnector
+        r.connected('a')
+        self.assertEqual(r.stats(), (0, 0, 0, None, None, None))
+
+
+class FleetReconnectTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.central = SimulatedCentral(latency=.001, seed=0)
+        self.refusals = 0
+        self.attempts = []
+        self.reconnector = Reconnector(initial=.02, jitter=0.)
+        self.fleet = Fleet(self.connect, ['DEVICE-A'],
+                           reconnector=self.reconnector)
+        self.addCleanup(self.stop)
+
+    @asyncio.coroutine
+    def connect(self, deviceId):
+        self.attempts.append(self.loop.time())
+        if self.refusals:
+            self.refusals -= 1
+            raise Exception('Connection refused')
+        return (yield from self.central.deviceFromUUIDString(deviceId))
+
+    def stop(self):
+        self.fleet.stop()
+        for handle in self.fleet:
+            if handle.glm is not None:
+                handle.glm.transport.close()
+        self.sleep(.01)
+
+    @asyncio.coroutine
+    def connected(self):
+        while not self.fleet.connected():
+            yield from asyncio.sleep(.001, loop=self.loop)
+
+    def test_backoff(self):
+        self.refusals = 3
+        self.fleet.start()
+        self.wait(self.connected())
+        self.assertEqual(len(self.attempts), 4)
+        gaps = [b - a for a, b in zip(self.attempts, self.attempts[1:])]
+        # the first retry is immediate
+        self.assertLess(gaps[0], .01)
+        for gap, delay in zip(gaps[1:], (.02, .04)):
+            self.assertGreaterEqual(gap, delay - .005)
+        stats = self.reconnector.stats()
+        self.assertEqual((stats.failures, stats.reconnects), (3, 1))
+        self.assertGreaterEqual(stats.lastLatency, .055)
+
+    def test_drop(self):
+        self.fleet.start()
+        self.wait(self.connected())
+        handle = self.fleet['DEVICE-A']
+        self.refusals = 1
+        handle.glm.transport.disconnect()
+        self.sleep(.005)
+        self.wait(self.connected())
+        # at once, then after the first delay
+        self.assertEqual(len(self.attempts), 3)
+        self.assertGreaterEqual(self.attempts[2] - self.attempts[1], .015)
+        self.assertEqual(handle.connections, 2)
+        stats = self.reconnector.stats()
+        self.assertEqual(stats[:3], (1, 1, 1))
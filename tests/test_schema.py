@@ -0,0 +1,170 @@
+import pickle
+import struct
+import unittest
+
+from protocol import COMMANDS, Command, DistReference, GLMControl, \
+    GLMDeviceInfo, GLMDeviceInfoView, GLMMeasurementPage, GLMSettings, \
+    GLMSyncContainer, GLMSyncContainerView, SYNC_CONTAINER_SIZE, \
+    decodeRequest, decodeResponse, encodeRequest
+from schema import Layout, message
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport
+from tests.support import LoopTestCase
+
+
+def container(index=7):
+    c = GLMSyncContainer(
+        measurementType=3, calcIndicator=1, distReference=DistReference.Back,
+        angleReference=2, distanceUnit=1, stateOfCharge=80, temperature=22,
+        distance=(1.5, .25, 0.), result=1.75, angle=-12.5,
+        timestamp=12345678, laserOn=1, usabilityErrors=5,
+        measurementListIndex=index, compassHeading=-90, ndofSensorStatus=3)
+    # with the floats as the wire carries them
+    return GLMSyncContainer.fromBytes(c.toBytes())
+
+
+class LayoutTest(unittest.TestCase):
+    def test_fields(self):
+        layout = GLMSyncContainer.layout
+        self.assertEqual(layout.size, 33)
+        self.assertEqual(layout.fields[:5], [
+            'measurementType', 'calcIndicator', 'distReference',
+            'angleReference', 'distanceUnit'])
+        self.assertEqual(len(layout.fields), 16)
+        # padding has no field
+        self.assertEqual(GLMSettings.layout.size, 11)
+        self.assertEqual(len(GLMSettings._fields), 7)
+
+    def test_direct(self):
+        self.assertTrue(GLMSettings.layout.direct)
+        self.assertFalse(GLMSyncContainer.layout.direct)
+        self.assertFalse(Layout([('2B', 'pair')]).direct)
+
+    def test_bitfields(self):
+        layout = Layout([('B', (('low', 3), ('high', 5))), ('h', 'word')])
+        self.assertEqual(layout.pack((5, 2, -2)), b'\x15\xfe\xff')
+        self.assertEqual(layout.unpack(b'\x15\xfe\xff'), (5, 2, -2))
+        # values wider than their bitfield are truncated
+        self.assertEqual(layout.pack((13, 33, 0)), b'\x0d\x00\x00')
+
+    def test_tail(self):
+        layout = Layout([('B', 'count')], tail='items', stride=2)
+        self.assertEqual(layout.fields, ['count', 'items'])
+        self.assertTrue(layout.fits(b'\x00'))
+        self.assertTrue(layout.fits(b'\x02abcd'))
+        self.assertFalse(layout.fits(b'\x02abc'))
+        self.assertFalse(layout.fits(b''))
+        self.assertEqual(layout.unpack(b'\x02abcd'), (2, b'abcd'))
+        self.assertEqual(layout.pack((2, b'abcd')), b'\x02abcd')
+
+    def test_message(self):
+        Pair = message('Pair', Layout([('H', 'first'), ('3f', 'rest'),
+                                       ('B', 'flag')]), defaults=(0,))
+        self.assertEqual(Pair.__module__, __name__)
+        pair = Pair(1, (.5, 1., 2.))
+        self.assertEqual(pair.flag, 0)
+        self.assertEqual(Pair.fromBytes(pair.toBytes()), pair)
+        self.assertEqual(Pair.View(pair.toBytes()), pair)
+        self.assertEqual(Pair.View.__name__, 'PairView')
+
+
+class CommandSchemaTest(unittest.TestCase):
+    def test_requests(self):
+        self.assertEqual(encodeRequest(Command.Control, measurementType=1,
+                                       distReference=DistReference.Tripod),
+                         b'\x01\x03')
+        self.assertEqual(encodeRequest(Command.GetMeasurements, 3, 9),
+                         b'\x03\x09')
+        self.assertEqual(encodeRequest(Command.ReadSettings), b'')
+        self.assertEqual(decodeRequest(Command.Control, b'\x41\x03'),
+                         GLMControl(measurementType=1, syncControl=1,
+                                    distReference=3))
+        self.assertIsNone(decodeRequest(Command.Control, b'\x01'))
+        self.assertEqual(decodeRequest(Command.ReadSettings, b''), ())
+        self.assertIsNone(decodeRequest(Command.ReadSettings, b'\x00'))
+
+    def test_responses(self):
+        c = container()
+        self.assertEqual(decodeResponse(Command.Control, c.toBytes()), c)
+        self.assertEqual(decodeResponse(Command.DeviceInfoString, b'GLM'),
+                         b'GLM')
+        self.assertEqual(decodeResponse(Command.WriteSettings, b''), b'')
+
+    def test_round_trips(self):
+        for command, schema in COMMANDS.items():
+            for cls in (schema.request, schema.response):
+                if cls in (None, bytes):
+                    continue
+                layout = cls.layout
+                payload = bytes(range(1, layout.size + 1))
+                if layout.tail is not None:
+                    payload += bytes(layout.stride)
+                value = cls.fromBytes(payload)
+                self.assertEqual(cls.fromBytes(value.toBytes()), value,
+                                 cls.__name__)
+                self.assertEqual(cls.View(payload), value, cls.__name__)
+
+
+class MessageViewTest(unittest.TestCase):
+    def test_fields(self):
+        c = container()
+        view = GLMSyncContainerView(c.toBytes())
+        for name in GLMSyncContainer._fields:
+            self.assertEqual(getattr(view, name), getattr(c, name), name)
+        self.assertEqual((view.measurementType, view.distReference,
+                          view.angleReference), (3, DistReference.Back, 2))
+        self.assertEqual(view[7], c.distance)
+        self.assertEqual(view[-2:], c[-2:])
+        self.assertEqual(len(view), len(c))
+
+    def test_lazy(self):
+        view = GLMSyncContainerView(container().toBytes())
+        self.assertEqual(view.values, [None] * len(view))
+        view.measurementListIndex
+        decoded = [name for name, value in zip(view._fields, view.values)
+                   if value is not None]
+        self.assertEqual(decoded, ['measurementListIndex'])
+
+    def test_tuple(self):
+        c = container()
+        view = GLMSyncContainerView(c.toBytes())
+        self.assertEqual(view, c)
+        self.assertEqual(c, view)
+        self.assertEqual(hash(view), hash(c))
+        self.assertNotEqual(view, c._replace(temperature=0))
+        self.assertEqual(view.toNamedTuple(), c)
+        self.assertIsInstance(view.toNamedTuple(), GLMSyncContainer)
+        self.assertEqual(view._asdict(), c._asdict())
+        self.assertEqual(view._replace(laserOn=0), c._replace(laserOn=0))
+        self.assertEqual(repr(view), repr(c))
+        self.assertEqual(view.toBytes(), c.toBytes())
+        self.assertEqual(pickle.loads(pickle.dumps(view)), view)
+
+    def test_buffer(self):
+        data = bytearray(container().toBytes() + b'\xff')
+        # a longer buffer is fine; the view reads its own fields
+        view = GLMSyncContainerView(memoryview(data))
+        self.assertEqual(view.measurementListIndex, 7)
+        with self.assertRaises(struct.error):
+            GLMSyncContainerView(data[:SYNC_CONTAINER_SIZE-1])
+
+    def test_tail(self):
+        records = b''.join(container(i).toBytes() for i in (4, 5))
+        page = GLMMeasurementPage(4, 5, records)
+        view = GLMMeasurementPage.View(page.toBytes())
+        self.assertEqual((view.first, view.last, view.records),
+                         (4, 5, records))
+        self.assertEqual(view, page)
+
+
+class LazyResponseTest(LoopTestCase):
+    def test_call(self):
+        device = SimulatedGLM(latency=.001, seed=0)
+        glm = PeripheralController(SimulatedTransport(device))
+        self.addCleanup(glm.transport.close)
+        view = self.wait(glm.call(Command.DeviceInfo, lazy=True))
+        self.assertIsInstance(view, GLMDeviceInfoView)
+        self.assertEqual(view, device.deviceInfo)
+        info = self.wait(glm.call(Command.DeviceInfo))
+        self.assertIs(type(info), GLMDeviceInfo)
+        self.assertEqual(info.serialNumber, view.serialNumber)
@@ -0,0 +1,123 @@
+import json
+import asyncio
+
+from fleet import Fleet
+from protocol import Command
+from server import Server, Client, RemoteError
+from simulator import SimulatedCentral
+from telemetry import Telemetry
+from tests.support import LoopTestCase
+
+DEVICE = 'DEVICE-A'
+
+
+class ServerTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.central = SimulatedCentral(latency=.002, measurements=5, seed=0)
+        telemetry = Telemetry()
+        self.fleet = Fleet(self.central.deviceFromUUIDString, [DEVICE],
+                           telemetry=telemetry)
+        self.fleet.start()
+        self.addCleanup(self.stopFleet)
+        self.server = self.wait(Server(self.fleet, telemetry).start(
+            '127.0.0.1', 0))
+        self.addCleanup(lambda: self.wait(self.server.close()))
+        self.port = self.server.server.sockets[0].getsockname()[1]
+        self.client = self.wait(Client.open('127.0.0.1', self.port,
+                                            loop=self.loop))
+        self.addCleanup(self.client.close)
+        self.device = self.central.devices[DEVICE]
+
+    def stopFleet(self):
+        self.fleet.stop()
+        for handle in self.fleet:
+            if handle.glm is not None:
+                handle.glm.transport.close()
+        self.sleep(.01)
+
+    def request(self, op, device=DEVICE, **kwargs):
+        return self.wait(self.client.request(op, device, **kwargs))
+
+    def test_settings(self):
+        settings = self.request('settings')
+        self.assertEqual(settings, self.device.settings._asdict())
+        settings = self.request('writeSettings', speakerEnabled=False)
+        self.assertFalse(settings['speakerEnabled'])
+        self.assertFalse(self.device.settings.speakerEnabled)
+
+    def test_devices(self):
+        devices = self.request('devices', None)
+        self.assertEqual([d['device'] for d in devices], [DEVICE])
+        self.assertTrue(devices[0]['connected'])
+
+    def test_latest(self):
+        latest = self.request('latest')
+        self.assertEqual(latest['measurementListIndex'],
+                         self.device.memory[-1].measurementListIndex)
+        self.device.press()
+        self.assertEqual(self.request('latest')['result'],
+                         self.device.memory[-1].result)
+
+    def test_errors(self):
+        with self.assertRaisesRegex(RemoteError, 'Unknown operation'):
+            self.request('explode')
+        with self.assertRaisesRegex(RemoteError, 'TypeError'):
+            self.request('settings', bogus=1)
+        # the session survives errors
+        self.assertIn('spiritLevelEnabled', self.request('settings'))
+        self.assertEqual(self.request('stats', None)['errors'], 2)
+
+    def test_malformed(self):
+        @asyncio.coroutine
+        def exchange():
+            reader, writer = yield from asyncio.open_connection(
+                    '127.0.0.1', self.port, loop=self.loop)
+            writer.write(b'not json\n[1, 2]\n')
+            responses = []
+            for i in range(2):
+                line = yield from reader.readline()
+                responses.append(json.loads(line.decode()))
+            writer.close()
+            return responses
+        for response in self.wait(exchange()):
+            self.assertIsNone(response['id'])
+            self.assertIn('error', response)
+
+    def test_pipelined(self):
+        results = self.wait(asyncio.gather(*[
+            self.client.request(op, DEVICE) for op in
+            ('settings', 'deviceInfo', 'settings', 'latest', 'deviceInfo')],
+            loop=self.loop))
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1]['serialNumber'],
+                         self.device.deviceInfo.serialNumber)
+        self.assertIn('measurementListIndex', results[3])
+
+    def test_coalescing(self):
+        reads = []
+        handler = self.device.handlers[Command.ReadSettings]
+        self.device.handlers[Command.ReadSettings] = \
+            lambda request: reads.append(request) or handler(request)
+        results = self.wait(asyncio.gather(*[
+            self.client.request('settings', DEVICE, fresh=False)
+            for i in range(10)], loop=self.loop))
+        self.assertEqual(len(set(map(json.dumps, results))), 1)
+        stats = self.request('stats', None)
+        self.assertEqual(stats['deviceReads'], 1)
+        self.assertEqual(stats['coalesced'], 9)
+        self.assertLessEqual(len(reads), 1)
+
+    def test_fresh(self):
+        self.request('settings')
+        before = self.device.requests
+        self.wait(asyncio.gather(*[
+            self.client.request('settings', DEVICE, fresh=True)
+            for i in range(5)], loop=self.loop))
+        self.assertEqual(self.device.requests - before, 5)
+
+    def test_telemetry(self):
+        self.request('measure')
+        latest = self.request('telemetry')
+        self.assertEqual(latest['battery']['value'],
+                         self.device.memory[-1].stateOfCharge)
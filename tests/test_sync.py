@@ -0,0 +1,134 @@
+import os
+import math
+import sqlite3
+import tempfile
+import unittest
+
+from protocol import GLMSyncContainer
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport
+from sync import MeasurementStore, syncMeasurements, indexRuns, SCHEMA
+from tests.support import LoopTestCase
+
+
+class SyncTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(memorySize=50, seed=0)
+        self.glm = PeripheralController(SimulatedTransport(self.device))
+        self.addCleanup(self.glm.transport.close)
+        self.store = MeasurementStore()
+        self.addCleanup(self.store.close)
+        self.serialNumber = self.device.deviceInfo.serialNumber
+
+    def take(self, count):
+        return [self.device.press() for i in range(count)]
+
+    def sync(self, clear=False):
+        return self.wait(syncMeasurements(self.glm, self.store, clear))
+
+    def indices(self, containers):
+        return [c.measurementListIndex for c in containers]
+
+    def test_incremental(self):
+        taken = self.take(10)
+        self.assertEqual(self.sync(), taken)
+        self.assertEqual(self.sync(), [])
+        taken = self.take(3)
+        self.assertEqual(self.sync(), taken)
+        self.assertEqual(self.store.count(self.serialNumber), 13)
+
+    def test_wraparound(self):
+        self.device.nextIndex = 240
+        self.take(10)
+        self.sync()
+        self.assertEqual(self.store.lastIndex(self.serialNumber), 249)
+        taken = self.take(12)
+        new = self.sync()
+        self.assertEqual(self.indices(new),
+                         list(range(250, 256)) + list(range(6)))
+        self.assertEqual(new, taken)
+        self.assertEqual(self.store.lastIndex(self.serialNumber), 5)
+        self.assertEqual(self.sync(), [])
+
+    def test_wraparound_at_255(self):
+        self.device.nextIndex = 246
+        self.take(10)
+        self.sync()
+        self.assertEqual(self.store.lastIndex(self.serialNumber), 255)
+        taken = self.take(4)
+        self.assertEqual(self.indices(taken), [0, 1, 2, 3])
+        self.assertEqual(self.sync(), taken)
+        self.assertEqual(self.store.lastIndex(self.serialNumber), 3)
+        self.assertEqual(self.store.measurements(self.serialNumber),
+                         self.device.memory)
+
+    def test_reused_index(self):
+        # after a full cycle an index holds a new measurement
+        self.take(3)
+        self.sync()
+        later = self.device.clock() + 60
+        self.device.clock = lambda: later
+        self.device.memory = []
+        self.device.nextIndex = 1
+        taken = self.take(1)
+        self.assertEqual(self.sync(), taken)
+        self.assertEqual(self.store.count(self.serialNumber), 4)
+
+    def test_clear(self):
+        self.device.nextIndex = 253
+        taken = self.take(5)
+        # a first sync has no last index to go by, so it goes in index order
+        self.assertEqual(sorted(self.indices(self.sync(clear=True))),
+                         sorted(self.indices(taken)))
+        self.assertEqual(self.device.memory, [])
+        self.assertEqual(self.store.count(self.serialNumber), 5)
+
+    def test_invalid_record(self):
+        # an error reading, say, has no result: NaN is stored as NULL
+        invalid = self.device.press()._replace(result=float('nan'))
+        invalid = GLMSyncContainer.fromBytes(invalid.toBytes())
+        self.device.memory[-1] = invalid
+        new = self.sync(clear=True)
+        self.assertEqual(len(new), 1)
+        self.assertTrue(math.isnan(new[0].result))
+        self.assertEqual(self.device.memory, [])
+        self.assertTrue(math.isnan(
+            self.store.newest(self.serialNumber).result))
+        taken = self.take(2)
+        self.assertEqual(self.sync(clear=True), taken)
+        self.assertEqual(self.store.count(self.serialNumber), 3)
+
+    def test_duplicates(self):
+        taken = self.take(2)
+        records = [(c, c.toBytes()) for c in taken]
+        self.assertEqual(self.store.add(self.serialNumber, records), 2)
+        self.assertEqual(self.store.add(self.serialNumber, records), 0)
+        self.assertEqual(self.sync(), [])
+
+    def test_index_runs(self):
+        self.assertEqual(indexRuns([0, 1, 2, 253, 254, 255]),
+                         [(0, 2), (253, 255)])
+        self.assertEqual(indexRuns([]), [])
+
+
+class MigrationTest(unittest.TestCase):
+    def test_unversioned_store(self):
+        old = SCHEMA.replace('result REAL,', 'result REAL NOT NULL,') \
+            .replace('ON CONFLICT IGNORE', '')
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        db = sqlite3.connect(path)
+        db.execute(old)
+        db.execute('INSERT INTO measurements VALUES (1, 2, 3, 1, 4.5, ?, 0)',
+                   (bytes(33),))
+        db.commit()
+        db.close()
+        store = MeasurementStore(path)
+        self.addCleanup(store.close)
+        self.assertEqual(store.count(1), 1)
+        invalid = GLMSyncContainer.fromBytes(bytes(33))._replace(
+                result=float('nan'), measurementListIndex=3)
+        self.assertEqual(store.add(1, [(invalid, invalid.toBytes())]), 1)
+        self.assertEqual(store.count(1), 2)
@@ -0,0 +1,116 @@
+import asyncio
+import unittest
+
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport
+from telemetry import BATTERY, RSSI, TEMPERATURE, Ring, Series, Telemetry
+from tests.support import LoopTestCase
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class SeriesTest(unittest.TestCase):
+    def test_ring(self):
+        ring = Ring(3)
+        self.assertIsNone(ring.last())
+        for i in range(5):
+            ring.append(i)
+        self.assertEqual((list(ring), len(ring), ring.last()),
+                         ([2, 3, 4], 3, 4))
+
+    def test_series(self):
+        series = Series(capacity=4, resolutions=(60.,), interval=10.)
+        for t, value in ((0., 50), (1., 50), (2., 49), (15., 49), (61., 40)):
+            series.add(t, value)
+        # the repeated reading within interval is not kept
+        self.assertEqual([p.value for p in series.query()], [50, 49, 49, 40])
+        first, second = series.query(resolution=60.)
+        self.assertEqual(first, (0., 4, 49, 50, 49.5))
+        self.assertEqual(second, (60., 1, 40, 40, 40.))
+        self.assertEqual(series.query(since=10., until=20.), [(15., 49)])
+
+
+class ThresholdTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()  # for the quiet log
+        self.clock = FakeClock()
+        self.alerts = []
+        self.telemetry = Telemetry(clock=self.clock,
+                                   onAlert=self.alerts.append)
+
+    def feed(self, metric, values, deviceId='A'):
+        for value in values:
+            self.clock.now += 1.
+            self.telemetry.record(deviceId, metric, value)
+        return [alert.value for alert in self.alerts]
+
+    def test_below(self):
+        self.telemetry.warn(BATTERY, below=20)
+        self.assertEqual(self.feed(BATTERY, [50, 20, 19, 18]), [19])
+        self.assertEqual(self.feed(BATTERY, [21, 19]), [19, 19])
+
+    def test_hysteresis(self):
+        threshold = self.telemetry.warn(BATTERY, below=20, hysteresis=5)
+        self.assertEqual(self.feed(BATTERY, [30, 19]), [19])
+        # hovering around the threshold does not alert again
+        self.assertEqual(self.feed(BATTERY, [21, 19, 24, 18]), [19])
+        self.assertEqual(self.feed(BATTERY, [25, 19]), [19, 19])
+        alert = self.alerts[-1]
+        self.assertEqual((alert.deviceId, alert.metric, alert.threshold,
+                          alert.time), ('A', BATTERY, threshold,
+                                        self.clock.now))
+
+    def test_above(self):
+        self.telemetry.warn(TEMPERATURE, above=40, hysteresis=2)
+        self.assertEqual(self.feed(TEMPERATURE, [35, 41, 39, 42, 37, 41]),
+                         [41, 41])
+
+    def test_devices(self):
+        self.telemetry.warn(BATTERY, below=20, hysteresis=5)
+        self.feed(BATTERY, [10], 'A')
+        self.feed(BATTERY, [10], 'B')
+        self.feed(TEMPERATURE, [10], 'B')
+        self.assertEqual([a.deviceId for a in self.alerts], ['A', 'B'])
+        self.assertEqual(list(self.telemetry.alerts), self.alerts)
+
+
+class DeviceTelemetryTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(latency=.001, seed=0)
+        self.glm = PeripheralController(SimulatedTransport(self.device))
+        self.addCleanup(self.glm.transport.close)
+        self.telemetry = Telemetry(rssiInterval=.005)
+
+    def test_containers(self):
+        self.telemetry.warn(BATTERY, below=20)
+        self.telemetry.attach(self.glm, 'A')
+        self.wait(self.glm.turnOnAutoSync())
+        self.device.stateOfCharge = 10
+        self.device.press()
+        self.sleep(.02)
+        self.assertEqual([a.value for a in self.telemetry.alerts], [9])
+        latest = self.telemetry.latest()['A']
+        self.assertEqual(latest[BATTERY].value, 9)
+        self.assertEqual(latest[TEMPERATURE].value,
+                         self.device.memory[-1].temperature)
+
+    def test_rssi(self):
+        self.telemetry.warn(RSSI, below=-80, hysteresis=5)
+        self.device.rssi = -60
+        poller = self.telemetry.watch(self.glm, 'A')
+        self.addCleanup(poller.cancel)
+        self.sleep(.03)
+        self.assertEqual(len(self.telemetry.alerts), 0)
+        self.device.rssi = -100
+        self.sleep(.03)
+        self.assertEqual(len(self.telemetry.alerts), 1)
+        self.assertGreater(len(self.telemetry.query('A', RSSI)), 5)
+        self.glm.transport.disconnect()
+        self.wait(asyncio.wait_for(poller, 1., loop=self.loop))
@@ -0,0 +1,92 @@
+import random
+
+from protocol import Command, GLMUploadResult
+from controller import PeripheralController
+from simulator import SimulatedGLM, SimulatedTransport, SUCCESS
+from upload import Uploader, UploadError, BLOCK_NUMBERS
+from tests.support import LoopTestCase
+
+
+class UploadTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = SimulatedGLM(latency=.001, seed=0)
+        self.glm = PeripheralController(SimulatedTransport(self.device),
+                                        maxInFlight=BLOCK_NUMBERS)
+        self.addCleanup(self.glm.transport.close)
+        rng = random.Random(0)
+        self.data = bytes(rng.randrange(256) for i in range(40 * 10))
+        self.sent = []  # (blockNumber, data) of every block the device saw
+
+    def failing(self, failures):
+        """
+        Make the device reject the block with the given data failures[data]
+        times.
+        """
+        accept = self.device.handlers[Command.UploadBlock]
+
+        def handler(request):
+            self.sent.append((request.blockNumber, request.chunkData))
+            if failures.get(request.chunkData, 0):
+                failures[request.chunkData] -= 1
+                return SUCCESS, GLMUploadResult(
+                        1, request.blockNumber).toBytes()
+            return accept(request)
+        self.device.handlers[Command.UploadBlock] = handler
+
+    def chunk(self, i):
+        return self.data[10*i:10*(i+1)]
+
+    def received(self):
+        return b''.join(data for number, blockType, data in
+                        self.device.uploads)
+
+    def test_upload(self):
+        uploader = Uploader(self.data, chunkSize=10, window=8)
+        progress = self.wait(uploader.upload(self.glm))
+        self.assertTrue(progress.done)
+        self.assertEqual((progress.bytes, progress.blocks, progress.retries),
+                         (len(self.data), 40, 0))
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual([number for number, blockType, data in
+                          self.device.uploads],
+                         [i % BLOCK_NUMBERS for i in range(40)])
+
+    def test_retry(self):
+        self.failing({self.chunk(0): 4})
+        uploader = Uploader(self.data, chunkSize=10, window=16)
+        progress = self.wait(uploader.upload(self.glm))
+        self.assertEqual(progress.retries, 4)
+        self.assertEqual(sorted(data for number, blockType, data in
+                                self.device.uploads),
+                         sorted(self.chunk(i) for i in range(40)))
+        # nothing past the first 16 blocks went out before block 0 was in,
+        # so no block number was ever used by two blocks at once
+        last = max(i for i, (number, data) in enumerate(self.sent)
+                   if data == self.chunk(0))
+        first16 = [self.chunk(i) for i in range(BLOCK_NUMBERS)]
+        self.assertTrue(all(data in first16
+                            for number, data in self.sent[:last]))
+        accepted = [data for number, blockType, data in self.device.uploads]
+        self.assertLess(accepted.index(self.chunk(0)),
+                        accepted.index(self.chunk(16)))
+
+    def test_no_new_blocks_while_retrying(self):
+        self.failing({self.chunk(3): 2})
+        uploader = Uploader(self.data, chunkSize=10, window=4)
+        self.wait(uploader.upload(self.glm))
+        retried = [i for i, (number, data) in enumerate(self.sent)
+                   if data == self.chunk(3)]
+        # between the first failure and the last retry, only retries
+        # and blocks already in flight were sent
+        newer = [self.chunk(i) for i in range(7, 40)]
+        self.assertFalse(any(data in newer for number, data in
+                             self.sent[retried[0]:retried[-1]]))
+        self.assertEqual(self.received()[:40], self.data[:40])
+
+    def test_give_up(self):
+        self.failing({self.chunk(1): 10})
+        uploader = Uploader(self.data, chunkSize=10, window=4, maxRetries=2)
+        with self.assertRaises(UploadError):
+            self.wait(uploader.upload(self.glm))
+        self.assertFalse(uploader.done)
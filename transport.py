@@ -0,0 +1,135 @@
+import abc
+import asyncio
+
+from log import log
+from framing import FRAGMENT_SIZE
+
+"""
+Transports carry MT protocol fragments between a PeripheralController and a
+device.  CoreBluetoothTransport (bluetooth.py) drives a BLE peripheral from
+Grand Central Dispatch threads; StreamTransport runs entirely on the asyncio
+loop thread over any asyncio stream, with no cross-thread hops.
+"""
+
+
+class Transport(abc.ABC):
+    """
+    The transport interface.  The controller attaches itself with attach()
+    and then writes fragments with write().  In return the transport calls
+    the controller's
+
+        transportReady(error=None)      once fragments may be written
+        didReceive(fragment, error=None)  for each fragment from the device
+        didWrite(error=None)            once per write with response
+        didReadRSSI(rssi, error=None)   in answer to readRSSI()
+        didDisconnect(error)            when the link goes away
+
+    and calls its sendChunk() when write-without-response capacity frees up.
+    schedule() runs a callable in the transport's own execution context.
+    maximumWriteLength() bounds the size of a fragment, header included; it
+    is read once the transport is ready.  readRSSI() asks for the signal
+    strength, returning False if the transport cannot measure it.
+    """
+    def __init__(self):
+        self.controller = None
+
+    def attach(self, controller):
+        self.controller = controller
+
+    @abc.abstractmethod
+    def write(self, fragment, withResponse=True):
+        pass
+
+    def supportsWriteWithoutResponse(self):
+        return False
+
+    def canWriteWithoutResponse(self):
+        return True
+
+    def maximumWriteLength(self):
+        return FRAGMENT_SIZE + 1
+
+    def readRSSI(self):
+        return False
+
+    @abc.abstractmethod
+    def schedule(self, cb):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamTransport(Transport):
+    """
+    StreamTransport carries fragments over an asyncio (reader, writer) pair,
+    each prefixed with a length byte, e.g. a TCP or Unix socket to a BLE
+    bridge or to a simulated device (see simulator.py).  A write with
+    response is confirmed as soon as it is handed to the stream.  mtu is the
+    largest fragment the far end accepts.  Must be used from the loop thread.
+    """
+    def __init__(self, reader, writer, loop=None, mtu=FRAGMENT_SIZE+1):
+        super().__init__()
+        self.loop = loop or asyncio.get_event_loop()
+        self.reader = reader
+        self.writer = writer
+        self.mtu = min(mtu, 255)  # fragments carry a length byte
+        self.task = None
+
+    def attach(self, controller):
+        super().attach(controller)
+        self.task = self.loop.create_task(self.run())
+
+    @asyncio.coroutine
+    def run(self):
+        self.controller.transportReady()
+        error = None
+        try:
+            while True:
+                length = (yield from self.reader.readexactly(1))[0]
+                fragment = yield from self.reader.readexactly(length)
+                self.controller.didReceive(fragment)
+        except asyncio.IncompleteReadError:
+            error = 'Connection closed'
+        except asyncio.CancelledError:
+            error = 'Transport closed'
+        except Exception as e:
+            error = e
+        log(0, 'Disconnected %s %s' % (self, error))
+        self.writer.close()
+        self.controller.didDisconnect(error)
+
+    def write(self, fragment, withResponse=True):
+        self.writer.write(bytes([len(fragment)]))
+        self.writer.write(fragment)
+        if withResponse:
+            self.loop.call_soon(self.controller.didWrite, None)
+
+    def supportsWriteWithoutResponse(self):
+        return True
+
+    def maximumWriteLength(self):
+        return self.mtu
+
+    def schedule(self, cb):
+        self.loop.call_soon(cb)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+@asyncio.coroutine
+def open_connection(host=None, port=None, path=None, loop=None,
+                    mtu=FRAGMENT_SIZE+1):
+    """
+    Connect a StreamTransport to a TCP address or, given path, a Unix
+    socket.
+    """
+    if path is not None:
+        reader, writer = yield from asyncio.open_unix_connection(path,
+                                                                 loop=loop)
+    else:
+        reader, writer = yield from asyncio.open_connection(host, port,
+                                                            loop=loop)
+    return StreamTransport(reader, writer, loop, mtu)
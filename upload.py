@@ -0,0 +1,200 @@
+import io
+import time
+import asyncio
+import collections
+from collections import namedtuple
+
+from log import log
+from protocol import StatusError
+from framing import MAX_FRAGMENTS
+
+"""
+Streaming upload over command 0x3b (uploadBlock).  An Uploader splits a file,
+bytes or an iterator of bytes into blocks numbered modulo 16, keeps several
+of them in flight, retries the ones the device rejects, and picks up where it
+left off when called again on a new connection.
+"""
+
+BLOCK_NUMBERS = 16  # blockNumber is four bits
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadProgress(namedtuple('UploadProgress', 'bytes, blocks, retries, '
+                                'throughput, done')):
+    pass
+
+
+class Block:
+    def __init__(self, sequence, data):
+        self.sequence = sequence
+        self.blockNumber = sequence % BLOCK_NUMBERS
+        self.data = data
+        self.attempts = 0
+
+
+def chunks(source, size):
+    """
+    Yield successive size-byte pieces of source: bytes, a binary file object,
+    or an iterable of bytes.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    if hasattr(source, 'read'):
+        while True:
+            data = source.read(size)
+            if not data:
+                return
+            yield data
+    buffer = bytearray()
+    for data in source:
+        buffer += data
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+class Uploader:
+    """
+    Uploader sends source as a sequence of blocks of blockType.  Up to window
+    blocks are in flight at once (by default as many as the controller
+    pipelines), all within 16 of the oldest unconfirmed block, so their
+    block numbers stay distinct.  A block the device answers with a nonzero
+    uploadErrorCode or a StatusError, or does not answer in time, is sent
+    again, up to maxRetries times; no new blocks are sent until it is
+    confirmed.  Any other exception, such as a disconnect, propagates
+    from upload() with the unconfirmed blocks kept; call upload() again with
+    the reconnected controller to resume.  progress, if given, is called
+    with an UploadProgress after each confirmed block.
+    """
+    def __init__(self, source, blockType=0, chunkSize=None, window=None,
+                 maxRetries=5, progress=None):
+        self.source = source
+        self.blockType = blockType
+        self.chunkSize = chunkSize
+        self.window = window
+        self.maxRetries = maxRetries
+        self.progress = progress
+        self.chunks = None
+        self.unconfirmed = collections.deque()
+        self.sequence = 0
+        self.exhausted = False
+        self.bytes = 0
+        self.blocks = 0
+        self.retries = 0
+        self.busyTime = 0.
+        self.busySince = None
+
+    @property
+    def done(self):
+        return self.exhausted and not self.unconfirmed
+
+    def throughput(self):
+        """ Confirmed bytes per second spent in upload(). """
+        busyTime = self.busyTime
+        if self.busySince is not None:
+            busyTime += time.monotonic() - self.busySince
+        return self.bytes / busyTime if busyTime else 0.
+
+    def status(self):
+        return UploadProgress(self.bytes, self.blocks, self.retries,
+                              self.throughput(), self.done)
+
+    @asyncio.coroutine
+    def negotiateChunkSize(self, glm):
+        """
+        The largest chunk that fits the device's receive payload, the length
+        byte and MAX_FRAGMENTS fragments, less two bytes of block header.
+        """
+        payloadSize = yield from glm.payloadSize()
+        return min(payloadSize.RXPayloadSize, 255,
+                   MAX_FRAGMENTS * glm.framer.fragmentSize - 4) - 2
+
+    def fill(self, window):
+        while len(self.unconfirmed) < window and not self.exhausted:
+            if self.unconfirmed and self.sequence >= \
+                    self.unconfirmed[0].sequence + BLOCK_NUMBERS:
+                return  # its blockNumber would be the oldest block's
+            try:
+                data = next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+            else:
+                self.unconfirmed.append(Block(self.sequence, data))
+                self.sequence += 1
+
+    @asyncio.coroutine
+    def upload(self, glm):
+        """
+        Send the rest of the source through glm.  Returns an UploadProgress.
+        """
+        if self.chunks is None:
+            if self.chunkSize is None:
+                self.chunkSize = yield from self.negotiateChunkSize(glm)
+            self.chunks = chunks(self.source, self.chunkSize)
+        window = min(self.window or glm.max_in_flight, BLOCK_NUMBERS)
+        loop = asyncio.get_event_loop()
+        inFlight = {}  # future -> Block
+        self.busySince = time.monotonic()
+        try:
+            while True:
+                self.fill(window)
+                sending = set(inFlight.values())
+                retrying = False
+                for i in range(min(window, len(self.unconfirmed))):
+                    block = self.unconfirmed[i]
+                    if block.attempts > 1 or \
+                            block.attempts and block not in sending:
+                        retrying = True
+                    elif not block.attempts and retrying:
+                        break  # no new blocks until the retries are in
+                    if block not in sending:
+                        block.attempts += 1
+                        inFlight[loop.create_task(glm.uploadBlock(
+                            block.blockNumber, self.blockType,
+                            block.data))] = block
+                if not inFlight:
+                    return self.status()
+                finished, pending = yield from asyncio.wait(
+                        inFlight, return_when=asyncio.FIRST_COMPLETED)
+                for future in finished:
+                    self.settle(inFlight.pop(future), future)
+        except Exception:
+            # let the controller finish with the blocks still in flight, and
+            # keep any the device confirmed
+            if inFlight:
+                yield from asyncio.wait(inFlight)
+                for future, block in inFlight.items():
+                    try:
+                        self.settle(block, future)
+                    except Exception:
+                        pass
+            raise
+        finally:
+            self.busyTime += time.monotonic() - self.busySince
+            self.busySince = None
+
+    def settle(self, block, future):
+        try:
+            result = future.result()
+        except (StatusError, asyncio.TimeoutError) as e:
+            error = e
+        else:
+            if result.uploadErrorCode == 0 and \
+                    result.blockNumber == block.blockNumber:
+                self.unconfirmed.remove(block)
+                self.bytes += len(block.data)
+                self.blocks += 1
+                if self.progress is not None:
+                    self.progress(self.status())
+                return
+            error = 'upload error %d' % result.uploadErrorCode
+        if block.attempts > self.maxRetries:
+            raise UploadError('Block %d failed %d times: %s' %
+                              (block.sequence, block.attempts, error))
+        log(1, 'Retrying block %d: %s' % (block.sequence, error))
+        self.retries += 1